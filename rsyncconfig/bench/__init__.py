@@ -0,0 +1,52 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmarks for the rsyncconfig package
+
+Each benchmark module provides a get_benchmarks() function returning a list of
+(name, setup, func) tuples.  setup is called once and its return value is
+passed to every timed call of func.  A module may also provide a get_sizes()
+function returning a list of (name, bytes) tuples measuring memory use, and a
+get_expectations() function returning a list of (faster, slower, ratio)
+tuples, each asserting that the benchmark named faster takes at most ratio
+times as long as the one named slower.
+'''
+
+import timeit
+
+from . import filter
+from . import spider
+from . import fstree
+from . import pathtable
+from . import startup
+
+def get_benchmarks():
+    return (filter.get_benchmarks() + spider.get_benchmarks() +
+            fstree.get_benchmarks() + pathtable.get_benchmarks() +
+            startup.get_benchmarks())
+
+def get_sizes():
+    return pathtable.get_sizes()
+
+def get_expectations():
+    return spider.get_expectations()
+
+def run_benchmark(setup, func, repeat=3, number=1):
+    '''Time func, returning the best time of repeat runs in seconds
+    '''
+    arg = setup()
+    timer = timeit.Timer(lambda: func(arg))
+    return min(timer.repeat(repeat=repeat, number=number)) / number
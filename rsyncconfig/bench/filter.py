@@ -0,0 +1,183 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmarks for the rsyncconfig.filter module
+'''
+
+import os
+from stat import *
+
+from rsyncconfig.filter import FilterRule, FilterRuleset
+
+from . import synthetic
+
+
+FILE_STAT = os.stat(__file__)
+assert S_ISREG(FILE_STAT.st_mode)
+
+DIR_STAT = os.stat(os.path.dirname(__file__))
+assert S_ISDIR(DIR_STAT.st_mode)
+
+'A mix of the kinds of rules found in typical filter files.'
+RULES = [
+    '- .git/',
+    '- *.o',
+    '- *.pyc',
+    '- /build/***',
+    '- node_modules/',
+    '+ src/**/*.[ch]',
+    '- /tmp/',
+    '+ /home/*/Documents/***',
+    '- *~',
+    '- cache/**/*.tmp',
+]
+
+
+def make_paths(count):
+    '''Generate count deterministic relative paths of varying depth
+    '''
+    names = ['src', 'lib', 'foo', 'bar.c', 'baz.h', 'main.o', 'README',
+             'notes.txt', 'cache', 'data.tmp', 'Documents', 'x.pyc']
+    paths = []
+    for i in range(count):
+        depth = 1 + i % 5
+        parts = [names[(i // (j + 1) + j) % len(names)] for j in range(depth)]
+        paths.append('/'.join(parts))
+    return paths
+
+'The shape of the mixed tree whose paths are matched against generated rules.'
+SYNTHETIC_TREE = dict(depth=3, dirs=5, files=8, names='mixed')
+
+def synthetic_paths():
+    '''Return the paths of a synthetic tree, and a stat for each
+    '''
+    paths = []
+    stats = []
+    for path, is_dir, _ in synthetic.generate_tree(**SYNTHETIC_TREE):
+        paths.append(path)
+        stats.append(DIR_STAT if is_dir else FILE_STAT)
+    return paths, stats
+
+
+def _setup_rules():
+    rules = [FilterRule(line.split(' ', 1)[1]) for line in RULES]
+    return rules, make_paths(1000)
+
+def _bench_rule_match(args):
+    rules, paths = args
+    for rule in rules:
+        for path in paths:
+            rule.match(path, FILE_STAT)
+
+def _setup_ruleset():
+    return FilterRuleset('\n'.join(RULES)), make_paths(1000)
+
+def _bench_ruleset_apply(args):
+    ruleset, paths = args
+    for path in paths:
+        ruleset.apply(path, FILE_STAT)
+        ruleset.apply(path, DIR_STAT)
+
+def _setup_apply_many():
+    paths = make_paths(1000) * 2
+    stats = [FILE_STAT] * 1000 + [DIR_STAT] * 1000
+    return FilterRuleset('\n'.join(RULES)), paths, stats
+
+def _setup_large_apply_many():
+    ruleset, paths = _setup_large_ruleset()
+    # Compile the rules' expressions for joined paths
+    ruleset.apply_many(paths[:1], [FILE_STAT])
+    ruleset.apply_many(paths[:1], [DIR_STAT])
+    return ruleset, paths * 2, [FILE_STAT] * 1000 + [DIR_STAT] * 1000
+
+def _bench_ruleset_apply_many(args):
+    ruleset, paths, stats = args
+    ruleset.apply_many(paths, stats)
+
+def _setup_large_ruleset():
+    lines = []
+    for i in range(50):
+        lines.extend(rule.replace('*', 'x{0}*'.format(i), 1) for rule in RULES)
+    return FilterRuleset('\n'.join(lines + RULES)), make_paths(1000)
+
+def _setup_literal_ruleset():
+    lines = []
+    for i in range(170):
+        lines.append('- name{0}'.format(i))
+        lines.append('- *.ext{0}'.format(i))
+        lines.append('- /dir{0}/sub/'.format(i))
+    return FilterRuleset('\n'.join(lines + RULES)), make_paths(1000)
+
+def _setup_cached_ruleset():
+    '''A large ruleset with a decision cache which holds every path, already
+    filled, as when the same paths are matched over and over
+    '''
+    ruleset, paths = _setup_large_ruleset()
+    ruleset = FilterRuleset(str(ruleset), cache_size=len(paths) * 2)
+    _bench_ruleset_apply((ruleset, paths))
+    return ruleset, paths
+
+def _setup_generated_rules():
+    rules = [FilterRule(line.split(' ', 1)[1])
+             for line in synthetic.generate_rules(50)]
+    return (rules,) + synthetic_paths()
+
+def _bench_generated_rule_match(args):
+    rules, paths, stats = args
+    for rule in rules:
+        for path, stat_t in zip(paths, stats):
+            rule.match(path, stat_t)
+
+def _setup_generated_ruleset():
+    ruleset = FilterRuleset('\n'.join(synthetic.generate_rules(1000)))
+    return (ruleset,) + synthetic_paths()
+
+def _bench_generated_ruleset_apply(args):
+    ruleset, paths, stats = args
+    for path, stat_t in zip(paths, stats):
+        ruleset.apply(path, stat_t)
+
+def _setup_generated_apply_many():
+    args = _setup_generated_ruleset()
+    _bench_ruleset_apply_many(args)
+    return args
+
+def _bench_ruleset_build(_):
+    FilterRuleset('\n'.join(RULES * 10))
+
+
+def get_benchmarks():
+    return [
+        ('filter.FilterRule.match', _setup_rules, _bench_rule_match),
+        ('filter.FilterRuleset.apply', _setup_ruleset, _bench_ruleset_apply),
+        ('filter.FilterRuleset.apply_many', _setup_apply_many,
+         _bench_ruleset_apply_many),
+        ('filter.FilterRuleset.apply (510 rules)', _setup_large_ruleset,
+         _bench_ruleset_apply),
+        ('filter.FilterRuleset.apply_many (510 rules)',
+         _setup_large_apply_many, _bench_ruleset_apply_many),
+        ('filter.FilterRuleset.apply (520 literal rules)',
+         _setup_literal_ruleset, _bench_ruleset_apply),
+        ('filter.FilterRuleset.apply (510 rules, cached)',
+         _setup_cached_ruleset, _bench_ruleset_apply),
+        ('filter.FilterRule.match (50 generated rules)',
+         _setup_generated_rules, _bench_generated_rule_match),
+        ('filter.FilterRuleset.apply (1000 generated rules)',
+         _setup_generated_ruleset, _bench_generated_ruleset_apply),
+        ('filter.FilterRuleset.apply_many (1000 generated rules)',
+         _setup_generated_apply_many, _bench_ruleset_apply_many),
+        ('filter.FilterRuleset.__init__', lambda: None, _bench_ruleset_build),
+    ]
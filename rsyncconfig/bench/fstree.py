@@ -0,0 +1,98 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmarks for the rsyncconfig.fstree module
+
+These add the entries of a synthetic tree to an FSTree in the order a Spider
+would, without touching the disk.
+'''
+
+import itertools
+from stat import S_IFDIR, S_IFREG
+
+from rsyncconfig.filter import FilterRuleset
+from rsyncconfig.fstree import FSTree
+from rsyncconfig.spider import EntryStat
+
+from . import synthetic
+
+'The shape of the mixed tree added, of 8590 entries.'
+TREE = dict(depth=4, dirs=5, files=10, names='mixed')
+
+
+def _setup_entries():
+    return [(path, EntryStat(S_IFDIR if is_dir else S_IFREG, size, 0))
+            for path, is_dir, size in synthetic.generate_tree(**TREE)]
+
+def _add_entries(fstree, entries):
+    for path, stat_t in entries:
+        fstree.add_path(path, stat_t, False)
+
+def _bench_add_path(entries):
+    _add_entries(FSTree(), entries)
+
+def _setup_filtered():
+    return (_setup_entries(),
+            FilterRuleset('\n'.join(synthetic.generate_rules(200))))
+
+def _bench_add_path_filtered(args):
+    entries, filters = args
+    fstree = FSTree()
+    fstree.set_filters(filters)
+    _add_entries(fstree, entries)
+
+def _setup_refilter():
+    '''Fill a tree, returning it with an endless alternation of two
+    different sets of generated rules
+    '''
+    fstree = FSTree()
+    _add_entries(fstree, _setup_entries())
+    rulesets = [FilterRuleset('\n'.join(synthetic.generate_rules(200,
+                                                                 seed=seed)))
+                for seed in (1, 2)]
+    return fstree, itertools.cycle(rulesets)
+
+def _setup_edit():
+    '''Fill a tree, returning it with an endless alternation of a set of
+    generated rules and the same rules with the middle one changed, as when
+    editing the filters
+    '''
+    fstree = FSTree()
+    _add_entries(fstree, _setup_entries())
+    rules = list(synthetic.generate_rules(200))
+    edited = list(rules)
+    edited[100] = '- /edited/**'
+    rulesets = [FilterRuleset('\n'.join(rules)),
+                FilterRuleset('\n'.join(edited))]
+    return fstree, itertools.cycle(rulesets)
+
+def _bench_update_totals(args):
+    fstree, rulesets = args
+    fstree.set_filters(next(rulesets))
+    while fstree.update_totals():
+        pass
+
+
+def get_benchmarks():
+    return [
+        ('fstree.FSTree.add_path', _setup_entries, _bench_add_path),
+        ('fstree.FSTree.add_path (200 generated rules)', _setup_filtered,
+         _bench_add_path_filtered),
+        ('fstree.FSTree.update_totals (200 generated rules)',
+         _setup_refilter, _bench_update_totals),
+        ('fstree.FSTree.update_totals (one of 200 rules edited)',
+         _setup_edit, _bench_update_totals),
+    ]
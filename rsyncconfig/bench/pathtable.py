@@ -0,0 +1,122 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmarks for the rsyncconfig.pathtable module
+
+These compare a PathTable with a dictionary keyed by full path, which is how
+FSTree used to find directories, on a deep synthetic tree of 29523 paths.
+Under CPython 2.7, the table takes about 17 bytes per path against 270 for
+the dictionary, and looking up a path at depth 9 takes about 8 us against
+0.3 us for a dictionary hit.
+'''
+
+import sys
+
+from rsyncconfig.pathtable import PathTable
+
+
+def make_deep_paths(depth=9, fanout=3):
+    '''Generate the paths of a tree of the given depth and fanout, parents
+    before children, as a spider would
+    '''
+    paths = []
+    def walk(prefix, level):
+        for i in range(fanout):
+            path = '{0}directory_{1}'.format(prefix, i)
+            paths.append(path)
+            if level < depth:
+                walk(path + '/', level + 1)
+    walk('', 1)
+    return paths
+
+def build_table(paths):
+    table = PathTable()
+    lookup = table.lookup
+    for path in paths:
+        parent, _, name = path.rpartition('/')
+        table.add(lookup(parent), name)
+    return table
+
+def build_dict(paths):
+    nodes = {}
+    for node, path in enumerate(paths):
+        nodes[path] = node
+    return nodes
+
+def table_size(table):
+    '''Return the approximate number of bytes used by a PathTable
+    '''
+    return (sys.getsizeof(table.parent) + sys.getsizeof(table.name) +
+            sys.getsizeof(table._slots) + sys.getsizeof(table._names) +
+            sys.getsizeof(table._name_ids) +
+            sum(sys.getsizeof(name) for name in table._names))
+
+def dict_size(nodes):
+    '''Return the approximate number of bytes used by a dictionary of paths
+    '''
+    return sys.getsizeof(nodes) + sum(sys.getsizeof(path) +
+                                      sys.getsizeof(node)
+                                      for path, node in nodes.iteritems())
+
+
+def _bench_build_table(paths):
+    build_table(paths)
+
+def _bench_build_dict(paths):
+    build_dict(paths)
+
+def _setup_table():
+    paths = make_deep_paths()
+    return build_table(paths), paths
+
+def _bench_table_lookup(args):
+    table, paths = args
+    lookup = table.lookup
+    for path in paths:
+        lookup(path)
+
+def _bench_table_get_path(args):
+    table, paths = args
+    get_path = table.get_path
+    for node in xrange(1, len(table) + 1):
+        get_path(node)
+
+def _setup_dict():
+    paths = make_deep_paths()
+    return build_dict(paths), paths
+
+def _bench_dict_lookup(args):
+    nodes, paths = args
+    for path in paths:
+        nodes.get(path)
+
+
+def get_benchmarks():
+    return [
+        ('PathTable.add, deep tree', make_deep_paths, _bench_build_table),
+        ('dict of paths, deep tree', make_deep_paths, _bench_build_dict),
+        ('PathTable.lookup, deep tree', _setup_table, _bench_table_lookup),
+        ('dict of paths lookup, deep tree', _setup_dict, _bench_dict_lookup),
+        ('PathTable.get_path, deep tree', _setup_table,
+         _bench_table_get_path),
+    ]
+
+def get_sizes():
+    paths = make_deep_paths()
+    return [
+        ('PathTable, deep tree', table_size(build_table(paths))),
+        ('dict of paths, deep tree', dict_size(build_dict(paths))),
+    ]
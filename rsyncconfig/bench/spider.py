@@ -0,0 +1,180 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmarks for the rsyncconfig.spider module
+'''
+
+import os
+import time
+
+from rsyncconfig import spider
+from rsyncconfig.filter import FilterRuleset
+from rsyncconfig.spider import Spider, ParallelSpider, ProcessSpider
+from rsyncconfig.snapshot import Snapshot
+
+from . import synthetic
+
+
+class NullTree(object):
+    '''An fstree which discards everything added to it
+    '''
+    def add_path(self, path, stat_t, scanning=True):
+        pass
+
+    def update_path(self, path, stat_t, scanning=False):
+        pass
+
+    def remove_path(self, path):
+        pass
+
+
+def get_tree():
+    '''Return the path of the synthetic tree the crawls are timed on,
+    creating it on first use
+    '''
+    return synthetic.get_tree(depth=3, dirs=6, files=20, max_size=0)
+
+
+def _bench_crawl(kwargs):
+    Spider(NullTree(), get_tree(), **kwargs).join()
+
+def _bench_parallel_crawl(kwargs):
+    ParallelSpider(NullTree(), get_tree(), **kwargs).join()
+
+'Filters which exclude nothing in the synthetic tree but match every entry.'
+FILTERS = '\n'.join(['- *.o', '- /build/***', '+ dir*/**/file[0-9]*'] +
+                     ['- *.ext{0}'.format(i) for i in range(50)])
+
+def _filtered_kwargs(**kwargs):
+    kwargs['filters'] = FilterRuleset(FILTERS)
+    return kwargs
+
+class _FilteringTree(NullTree):
+    '''An fstree which applies filters to each file added, like a Spider
+    with filters inlined would
+    '''
+    def __init__(self, filters):
+        self.filters = filters
+        self.prefix = len(get_tree()) + 1
+
+    def add_path(self, path, stat_t, scanning=True):
+        self.filters.apply(path[self.prefix:], stat_t)
+
+def _bench_filtered_crawl(kwargs):
+    tree = _FilteringTree(kwargs['filters'])
+    Spider(tree, get_tree(), **kwargs).join()
+
+def _bench_process_crawl(kwargs):
+    ProcessSpider(NullTree(), get_tree(), **kwargs).join()
+
+def _with_latency(func, seconds=0.001):
+    '''Wrap a crawl benchmark so that listing a directory takes at least the
+    given time, like on a network filesystem.
+    '''
+    def slow_scandir(path):
+        time.sleep(seconds)
+        return original(path)
+    def bench(kwargs):
+        spider.scandir = slow_scandir
+        try:
+            func(kwargs)
+        finally:
+            spider.scandir = original
+    original = spider.scandir
+    return bench
+
+def _bench_crawl_listdir(kwargs):
+    original = spider.scandir
+    spider.scandir = None
+    try:
+        _bench_crawl(kwargs)
+    finally:
+        spider.scandir = original
+
+def _setup_snapshot():
+    '''Save a snapshot of the synthetic tree, returning the arguments for a
+    Spider which rescans it
+    '''
+    cache = synthetic.make_temp_dir()
+    snapshot = Snapshot(get_tree(), os.path.join(cache, 'snapshot'))
+    Spider(NullTree(), get_tree(), snapshot=snapshot).join()
+    return dict(snapshot=snapshot)
+
+'The shape of the mixed tree crawled with generated rules, of 8590 entries.'
+MIXED_TREE = dict(depth=4, dirs=5, files=10, names='mixed')
+
+def _setup_synthetic():
+    '''Generated rules, after one including every directory, as otherwise
+    they exclude most of the tree before it is crawled
+    '''
+    filters = FilterRuleset('\n'.join(['+ */'] +
+                                      synthetic.generate_rules(200)))
+    return dict(root=synthetic.get_tree(**MIXED_TREE), filters=filters)
+
+def _bench_synthetic_crawl(kwargs):
+    Spider(NullTree(), kwargs['root'], filters=kwargs['filters']).join()
+
+
+def get_benchmarks():
+    benchmarks = [
+        ('spider.Spider (listdir)', dict, _bench_crawl_listdir),
+    ]
+    if spider.scandir is not None:
+        benchmarks += [
+            ('spider.Spider (scandir)', dict, _bench_crawl),
+            ('spider.Spider (scandir, lazy_stat)',
+             lambda: dict(lazy_stat=True), _bench_crawl),
+        ]
+    for workers in (1, 4, 8):
+        benchmarks.append(('spider.ParallelSpider ({0} workers)'.format(workers),
+                           lambda workers=workers: dict(workers=workers),
+                           _bench_parallel_crawl))
+    benchmarks += [
+        ('spider.Spider (filtered)', _filtered_kwargs, _bench_filtered_crawl),
+        ('spider.ProcessSpider (filtered)', _filtered_kwargs,
+         _bench_process_crawl),
+    ]
+    benchmarks.append(('spider.Spider (unchanged snapshot)', _setup_snapshot,
+                       _bench_crawl))
+    benchmarks.append(('spider.Spider (mixed tree, 200 generated rules)',
+                       _setup_synthetic, _bench_synthetic_crawl))
+    if spider.scandir is not None:
+        benchmarks.append(('spider.Spider (1 ms/dir latency)', dict,
+                           _with_latency(_bench_crawl)))
+        benchmarks.append(('spider.Spider (unchanged snapshot, '
+                           '1 ms/dir latency)', _setup_snapshot,
+                           _with_latency(_bench_crawl)))
+        for workers in (4, 16):
+            benchmarks.append((
+                'spider.ParallelSpider ({0} workers, 1 ms/dir latency)'.format(
+                    workers),
+                lambda workers=workers: dict(workers=workers),
+                _with_latency(_bench_parallel_crawl)))
+    return benchmarks
+
+def get_expectations():
+    '''A rescan of an unchanged tree from its snapshot lists nothing, so it
+    should beat crawling the tree comfortably, and by far once listing is slow
+    '''
+    if spider.scandir is None:
+        return [('spider.Spider (unchanged snapshot)',
+                 'spider.Spider (listdir)', 0.75)]
+    return [
+        ('spider.Spider (unchanged snapshot)', 'spider.Spider (scandir)',
+         0.75),
+        ('spider.Spider (unchanged snapshot, 1 ms/dir latency)',
+         'spider.Spider (1 ms/dir latency)', 0.25),
+    ]
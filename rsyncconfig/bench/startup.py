@@ -0,0 +1,60 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Benchmarks of the time taken to start a Python process and import parts of
+the rsyncconfig package, as a script or worker process would
+
+Each runs a fresh interpreter, so nothing is cached between runs.  The time
+to start an interpreter which imports nothing is included for comparison.
+'''
+
+import os
+import sys
+import imp
+import subprocess
+
+import rsyncconfig
+
+def _run(statement):
+    env = dict(os.environ)
+    paths = [os.path.dirname(
+        os.path.dirname(os.path.abspath(rsyncconfig.__file__)))]
+    if env.get('PYTHONPATH'):
+        paths.append(env['PYTHONPATH'])
+    env['PYTHONPATH'] = os.pathsep.join(paths)
+    subprocess.check_call([sys.executable, '-c', statement], env=env)
+
+def _setup(statement):
+    return lambda: statement
+
+
+def get_benchmarks():
+    benchmarks = [
+        ('start python', _setup('pass'), _run),
+        ('import rsyncconfig.filter', _setup('import rsyncconfig.filter'),
+         _run),
+        ('import rsyncconfig.spider', _setup('import rsyncconfig.spider'),
+         _run),
+        ('import rsyncconfig.cli', _setup('import rsyncconfig.cli'), _run),
+    ]
+    try:
+        imp.find_module('gtk')
+    except ImportError:
+        pass
+    else:
+        benchmarks.append(('import rsyncconfig.gui',
+                           _setup('import rsyncconfig.gui'), _run))
+    return benchmarks
@@ -0,0 +1,187 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Deterministic synthetic trees and filter rules for the benchmarks
+
+A tree is described by its depth, the number of subdirectories and files in
+each directory, a seed, and a name distribution: 'uniform' names the entries
+dir0, dir1, ... and file0, file1, ..., and 'mixed' draws them from weighted
+lists of stems and extensions, like a source tree.  The same description
+always gives the same tree, on any Python, as only random.random() is used.
+Trees are written to tmpfs where there is one, so that crawls measure the
+code rather than the disk.
+'''
+
+import os
+import atexit
+import random
+import shutil
+import bisect
+import tempfile
+
+'Weighted stems of the names in a mixed tree.'
+STEMS = [('main', 4), ('util', 4), ('test', 6), ('index', 2), ('README', 2),
+         ('Makefile', 1), ('config', 3), ('data', 3), ('x', 2), ('build', 1),
+         ('a_rather_long_generated_file_name', 1), ('cache', 1)]
+'Weighted extensions of the file names in a mixed tree.'
+EXTENSIONS = [('.c', 10), ('.h', 6), ('.o', 8), ('.py', 6), ('.pyc', 4),
+              ('.txt', 5), ('.tmp', 2), ('', 5), ('~', 1), ('.tar.gz', 1)]
+'Weighted directory names of a mixed tree.'
+DIR_NAMES = [('src', 6), ('lib', 4), ('include', 2), ('build', 2),
+             ('.git', 1), ('node_modules', 1), ('cache', 1), ('docs', 2),
+             ('tmp', 1), ('Documents', 1)]
+
+'The directory synthetic trees are made in: tmpfs if possible.'
+TMPFS = '/dev/shm'
+
+
+class _Weighted(object):
+    '''Picks from (value, weight) pairs with a random.Random
+    '''
+    def __init__(self, pairs):
+        self.values = [value for value, _ in pairs]
+        self.cumulative = []
+        total = 0
+        for _, weight in pairs:
+            total += weight
+            self.cumulative.append(total)
+
+    def pick(self, rng):
+        return self.values[bisect.bisect_right(
+            self.cumulative, rng.random() * self.cumulative[-1])]
+
+
+def _pick_index(rng, count):
+    return min(int(rng.random() * count), count - 1)
+
+def generate_tree(depth=3, dirs=6, files=20, names='uniform', seed=0,
+                  max_size=65536):
+    '''Yield a (relative path, is_dir, size) tuple for each entry of a
+    synthetic tree, parents before children, depth first.
+
+    Each directory above the given depth has dirs subdirectories, and every
+    directory has files files, of sizes up to max_size bytes.  Names within
+    a directory are made unique by numbering repeats.
+    '''
+    rng = random.Random(seed)
+    stems = _Weighted(STEMS)
+    extensions = _Weighted(EXTENSIONS)
+    dir_names = _Weighted(DIR_NAMES)
+
+    def unique(name, seen):
+        count = seen.get(name, 0)
+        seen[name] = count + 1
+        if count:
+            return '{0}{1}'.format(name, count)
+        return name
+
+    def walk(prefix, level):
+        seen = {}
+        for i in xrange(files):
+            if names == 'uniform':
+                name = 'file{0}'.format(i)
+            else:
+                name = unique(stems.pick(rng) + extensions.pick(rng), seen)
+            yield prefix + name, False, _pick_index(rng, max_size + 1)
+        if level < depth:
+            for i in xrange(dirs):
+                if names == 'uniform':
+                    name = 'dir{0}'.format(i)
+                else:
+                    name = unique(dir_names.pick(rng), seen)
+                yield prefix + name, True, 0
+                for entry in walk(prefix + name + '/', level + 1):
+                    yield entry
+    return walk('', 0)
+
+def make_tree(root, **spec):
+    '''Create a synthetic tree, as described by the keyword arguments of
+    generate_tree(), under root.  Files are sparse, so their sizes cost
+    nothing to write.
+    '''
+    for path, is_dir, size in generate_tree(**spec):
+        path = os.path.join(root, path)
+        if is_dir:
+            os.mkdir(path)
+        else:
+            with open(path, 'wb') as f:
+                f.truncate(size)
+
+def make_temp_dir():
+    '''Make a temporary directory, in tmpfs if possible, which is removed
+    when the benchmarks finish
+    '''
+    if os.path.isdir(TMPFS) and os.access(TMPFS, os.W_OK):
+        path = tempfile.mkdtemp(dir=TMPFS)
+    else:
+        path = tempfile.mkdtemp()
+    atexit.register(shutil.rmtree, path, True)
+    return path
+
+_trees = {}
+
+def get_tree(**spec):
+    '''Return the root of a synthetic tree, as described by the keyword
+    arguments of generate_tree(), creating it on first use
+    '''
+    key = tuple(sorted(spec.items()))
+    root = _trees.get(key)
+    if root is None:
+        root = _trees[key] = make_temp_dir()
+        make_tree(root, **spec)
+    return root
+
+
+'The kinds of generated rules, with weights, as in typical filter files.'
+RULE_KINDS = [('name', 4), ('extension', 6), ('anchored_dir', 3),
+              ('dir', 3), ('glob', 2), ('deep', 2), ('class', 1),
+              ('subtree', 1)]
+
+def generate_rules(count, include_ratio=0.2, seed=0):
+    '''Return a list of count deterministic filter rule lines, drawing
+    their patterns from the names of mixed trees, so that some of them
+    match.  About include_ratio of them are include rules.
+    '''
+    rng = random.Random(seed)
+    kinds = _Weighted(RULE_KINDS)
+    stems = _Weighted(STEMS)
+    extensions = _Weighted(EXTENSIONS)
+    dir_names = _Weighted(DIR_NAMES)
+    rules = []
+    for i in xrange(count):
+        kind = kinds.pick(rng)
+        if kind == 'name':
+            pattern = stems.pick(rng) + extensions.pick(rng)
+        elif kind == 'extension':
+            pattern = '*' + (extensions.pick(rng) or '.ext{0}'.format(i))
+        elif kind == 'anchored_dir':
+            pattern = '/{0}/{1}/'.format(dir_names.pick(rng),
+                                         dir_names.pick(rng))
+        elif kind == 'dir':
+            pattern = dir_names.pick(rng) + '/'
+        elif kind == 'glob':
+            pattern = '{0}*{1}'.format(stems.pick(rng)[:2],
+                                       extensions.pick(rng))
+        elif kind == 'deep':
+            pattern = '{0}/**/{1}'.format(dir_names.pick(rng),
+                                          stems.pick(rng) + '*')
+        elif kind == 'class':
+            pattern = '[a-m]{0}?'.format(stems.pick(rng)[1:3])
+        else:
+            pattern = '/{0}/***'.format(dir_names.pick(rng))
+        action = '+' if rng.random() < include_ratio else '-'
+        rules.append('{0} {1}'.format(action, pattern))
+    return rules
@@ -0,0 +1,239 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Evaluates a filter file against a tree without a display
+
+The paths a filter file includes are written out as they are found, one per
+line, in a form which can be passed to rsync --files-from.  This module must
+not import gtk, so that it can be used on servers and in cron jobs.
+'''
+
+import os
+import sys
+import stat
+import errno
+import optparse
+from gettext import gettext as _
+
+import regex
+
+from .filter import FilterRuleset
+from .spider import Spider
+
+'Exit status when some directories could not be read, as rsync uses.'
+EXIT_PARTIAL = 23
+
+USAGE = _('%prog [options] ROOT FILTER_FILE')
+DESCRIPTION = _('Crawl the tree at ROOT and write out the paths, relative to '
+                'ROOT, which the rsync filter rules in FILTER_FILE include.  '
+                'A FILTER_FILE of - reads the rules from standard input.')
+
+class PathPrinter(object):
+    '''
+    An fstree which writes out each path added to it, according to whether
+    one or two FilterRulesets include it.
+
+    Paths must be added parent first, depth first, as a Spider adds them.
+    The inclusion of the directories above the current path is kept on a
+    stack, so the memory used depends on the depth of the tree rather than
+    its size.  A path beneath an excluded directory is excluded, as rsync
+    never looks inside one.
+
+    mode is 'included' or 'excluded', to write the paths filters includes or
+    excludes, or 'diff' to write the paths whose inclusion differs between
+    previous and filters, prefixed with '+ ' if filters includes them and
+    '- ' if previous does.
+    '''
+    def __init__(self, out, root, filters, mode='included', previous=None,
+                 separator='\n'):
+        self.out = out
+        self.filters = filters
+        self.mode = mode
+        self.previous = previous
+        self.separator = separator
+        self._prefix = len(os.path.join(root, ''))
+        # (relative path, included by filters, included by previous) of the
+        # directories above the path being added
+        self._stack = [('', True, True)]
+
+    def add_path(self, path, stat_t, scanning=True):
+        rel_path = path[self._prefix:]
+        parent = rel_path.rpartition('/')[0]
+        stack = self._stack
+        while len(stack) > 1 and stack[-1][0] != parent:
+            stack.pop()
+        _, parent_included, parent_previous = stack[-1]
+
+        included = parent_included and self.filters.apply(rel_path, stat_t)
+        if self.previous is not None:
+            previous = parent_previous and self.previous.apply(rel_path,
+                                                               stat_t)
+        else:
+            previous = included
+        if stat.S_ISDIR(stat_t.st_mode):
+            stack.append((rel_path, included, previous))
+
+        if self.mode == 'included':
+            if included:
+                self._write(rel_path)
+        elif self.mode == 'excluded':
+            if not included:
+                self._write(rel_path)
+        elif included != previous:
+            self._write(('+ ' if included else '- ') + rel_path)
+
+    def _write(self, line):
+        self.out.write(line)
+        self.out.write(self.separator)
+
+
+class _Crawler(Spider):
+    '''Crawls a tree for the command line, in the calling thread.
+
+    A directory which can't be read is reported and skipped rather than
+    ending the crawl.  Entries are only stat()ed where scandir can't give
+    their type, as nothing but the type is looked at.
+    '''
+    def __init__(self, fstree, path, filters, err):
+        Spider.__init__(self, fstree, path, filters, lazy_stat=True,
+                        start=False)
+        self.err = err
+        self.failed = False
+
+    def _skip_dir(self, dir_path, e):
+        if e.errno == errno.EPIPE:
+            raise e
+        self.err.write('{0}: {1}\n'.format(dir_path, e.strerror))
+        self.failed = True
+
+
+class _AnyRuleset(object):
+    '''Includes what any of several FilterRulesets include.
+    '''
+    def __init__(self, *rulesets):
+        self.rulesets = rulesets
+
+    def apply(self, path, stat):
+        return any(ruleset.apply(path, stat) for ruleset in self.rulesets)
+
+
+def read_filters(filename, stdin=sys.stdin):
+    '''Read a FilterRuleset from a file, or from stdin if filename is -.
+
+    The file is parsed a line at a time.  As the rules are only evaluated,
+    rules made redundant by an earlier rule with the same pattern are
+    dropped.  A regex.error from a bad pattern is given the filename, unless
+    it is in a merge file, as an EnvironmentError has.
+    '''
+    try:
+        if filename == '-':
+            return FilterRuleset(stdin, dedupe=True)
+        with open(filename) as f:
+            return FilterRuleset(f, dedupe=True)
+    except regex.error, e:
+        if getattr(e, 'filename', None) is None:
+            e.filename = filename
+        raise
+
+def report_parse(err, filename, stats):
+    '''Write out what parsing a filter file found.
+    '''
+    err.write(_('{0}: {1} lines, {2} rules, {3} duplicates and {4} shadowed '
+                'rules dropped, parsed in {5:.3f}s\n').format(
+                    filename, stats.lines, stats.rules, stats.duplicates,
+                    stats.shadowed, stats.seconds))
+
+def report_pattern_error(err, prog, e):
+    '''Write out a regex.error from a bad pattern in a filter file.
+    '''
+    err.write('{0}: {1}: {2}\n'.format(prog, e.filename, e))
+
+def get_parser():
+    parser = optparse.OptionParser(usage=USAGE, description=DESCRIPTION)
+    parser.set_defaults(mode='included')
+    parser.add_option('-e', '--excluded', action='store_const',
+                      dest='mode', const='excluded',
+                      help=_('write the excluded paths instead'))
+    parser.add_option('-d', '--diff', metavar='OLD_FILTER_FILE',
+                      help=_('write the paths whose inclusion differs from '
+                             'under the rules in OLD_FILTER_FILE, prefixed '
+                             'with "+ " if newly included or "- " if newly '
+                             'excluded'))
+    parser.add_option('-0', '--null', action='store_true', default=False,
+                      help=_('end each path with a NUL rather than a '
+                             'newline, as rsync --from0 expects'))
+    parser.add_option('-v', '--verbose', action='store_true', default=False,
+                      help=_('report the number of rules read, and of '
+                             'redundant rules dropped, on standard error'))
+    return parser
+
+def main(argv=None, stdin=sys.stdin, stdout=sys.stdout, stderr=sys.stderr):
+    '''Run the command line, returning the exit status.
+    '''
+    parser = get_parser()
+    options, args = parser.parse_args(argv)
+    if len(args) != 2:
+        parser.error(_('expected ROOT and FILTER_FILE'))
+    root, filter_file = args
+
+    try:
+        filters = read_filters(filter_file, stdin)
+        previous = None
+        if options.diff is not None:
+            previous = read_filters(options.diff, stdin)
+            options.mode = 'diff'
+        if not stat.S_ISDIR(os.stat(root).st_mode):
+            raise OSError(errno.ENOTDIR, os.strerror(errno.ENOTDIR), root)
+    except EnvironmentError, e:
+        stderr.write('{0}: {1}: {2}\n'.format(parser.get_prog_name(),
+                                              e.filename, e.strerror))
+        return 1
+    except regex.error, e:
+        report_pattern_error(stderr, parser.get_prog_name(), e)
+        return 1
+    if options.verbose:
+        report_parse(stderr, filter_file, filters.parse_stats)
+        if previous is not None:
+            report_parse(stderr, options.diff, previous.parse_stats)
+
+    # Reads the per-directory files of any dir-merge rules as it goes
+    filters = filters.for_tree(root)
+    if previous is not None:
+        previous = previous.for_tree(root)
+    printer = PathPrinter(stdout, root, filters, options.mode, previous,
+                          '\0' if options.null else '\n')
+    if previous is not None:
+        crawl_filters = _AnyRuleset(filters, previous)
+    else:
+        crawl_filters = filters
+    crawler = _Crawler(printer, root, crawl_filters, stderr)
+    try:
+        crawler.crawl()
+        stdout.flush()
+    except EnvironmentError, e:
+        if e.errno != errno.EPIPE:
+            raise e
+        # The reader has gone away, as with head.
+        return 0
+    except regex.error, e:
+        # A per-directory file of a dir-merge rule has a bad pattern
+        report_pattern_error(stderr, parser.get_prog_name(), e)
+        return 1
+    except KeyboardInterrupt:
+        return 130
+    if crawler.failed:
+        return EXIT_PARTIAL
+    return 0
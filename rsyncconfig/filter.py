@@ -14,48 +14,582 @@
 # You should have received a copy of the GNU General Public License
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
+import os
+import time
+import errno
 import regex
+import bisect
+import threading
+import difflib
 from stat import *
+from collections import OrderedDict
+
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
 class FilterRuleset(object):
-    def __init__(self, filters):
+    def __init__(self, filters, cache_size=0, dedupe=False, line_type=None):
         '''
         split string and store in list of FilterRules
+
+        filters may also be an iterable of lines, such as a file object, which
+        is read a line at a time rather than held in memory.
+
+        A merge rule ('merge FILE' or '. FILE') is replaced by the rules in
+        FILE, which is read through merge_cache.  A dir-merge rule
+        ('dir-merge FILE' or ': FILE') stays in rules as a DirMergeFilter,
+        which matches nothing itself; its per-directory files are only read
+        when the ruleset is applied through a FilterStack, as for_tree()
+        returns.  If line_type is given, as it is for a merge file with the
+        '-' or '+' modifier, every line other than a comment is a pattern
+        for a rule of that class.
+
+        If dedupe is true, a rule with the same pattern as an earlier rule is
+        dropped, as the earlier rule matches every path it would.  This
+        doesn't change what is included, only the rule indices and text.
+        parse_stats is a ParseStats recording what was dropped.
+
+        If cache_size is given, the deciding rule index of up to that many of
+        the most recently matched (path, is_dir) pairs is kept, so matching a
+        path again is a dictionary lookup.  The rules can't change once
+        parsed, so the cache never goes stale; an edited ruleset is a new
+        FilterRuleset, which can take over the still valid part of the old
+        one's cache with inherit_cache().  The cache is guarded by a lock, as
+        a ruleset may be shared by the threads crawling a tree.
         '''
+        self.cache_size = cache_size
+        self._cache_lock = threading.Lock()
+        self.clear_cache()
+        start = time.time()
+        if isinstance(filters, basestring):
+            lines = filters.splitlines()
+        else:
+            lines = (line.rstrip('\r\n') for line in filters)
+        self.parse_stats = stats = ParseStats()
+        self.dedupe = dedupe
+        # The include flag of the first rule with each pattern
+        self._patterns = {}
         self.rules = [];
-        for s in filters.splitlines():
+        # The rule, or merge rule, of each line, which give the text back
+        self._lines = []
+        for s in lines:
+            stats.lines += 1
+            if line_type is not None:
+                if s and s[0] not in ';#':
+                    self._add_line(line_type, s)
+                continue
             secs = s.split(' ', 1)
             if len(secs) == 2:
-                if secs[0] == 'include':
-                    self.rules.append(IncludeFilter(secs[1]))
-                elif secs[0] == '+':
-                    self.rules.append(PlusFilter(secs[1]))
-                elif secs[0] == 'exclude':
-                    self.rules.append(ExcludeFilter(secs[1]))
-                elif secs[0] == '-':
-                    self.rules.append(MinusFilter(secs[1]))
+                rule_type = RULE_TYPES.get(secs[0])
+                if rule_type is not None:
+                    self._add_line(rule_type, secs[1])
+                    continue
+                merge = parse_merge_rule(s)
+                if merge is None:
+                    rule = NullFilter(s)
+                    self.rules.append(rule)
+                    self._lines.append(rule)
+                elif isinstance(merge, DirMergeFilter):
+                    if merge.exclude_self:
+                        self._add_rule(MinusFilter(merge.name))
+                    self.rules.append(merge)
+                    self._lines.append(merge)
                 else:
-                    self.rules.append(NullFilter(s))
+                    ruleset = merge_cache.load(merge.filename,
+                                               merge.line_type)
+                    if ruleset is None:
+                        raise IOError(errno.ENOENT,
+                                      os.strerror(errno.ENOENT),
+                                      merge.filename)
+                    for rule in ruleset.rules:
+                        self._add_rule(rule)
+                    self._lines.append(merge)
+        del self._patterns
+        self.dir_merges = [(index, rule) for index, rule
+                           in enumerate(self.rules)
+                           if isinstance(rule, DirMergeFilter)]
+        stats.rules = len(self.rules)
+        self._dir_index = RuleIndex(self.rules, True)
+        self._file_index = RuleIndex(self.rules, False)
+        stats.seconds = time.time() - start
+
+    def _add_line(self, rule_type, pattern):
+        '''
+        add a rule of the given class for a line, unless it is a duplicate
+        '''
+        if self._is_duplicate(rule_type.include, pattern):
+            return
+        rule = rule_type(pattern)
+        self.rules.append(rule)
+        self._lines.append(rule)
+
+    def _add_rule(self, rule):
+        '''
+        add a rule read from a merge file, unless it is a duplicate
+        '''
+        if (isinstance(rule, (IncludeFilter, ExcludeFilter)) and
+                self._is_duplicate(rule.include, rule.exp)):
+            return
+        self.rules.append(rule)
+
+    def _is_duplicate(self, include, pattern):
+        '''
+        check whether an earlier rule has the same pattern, counting the rule
+        as dropped if so and dropping duplicates
+        '''
+        if not self.dedupe:
+            return False
+        first = self._patterns.get(pattern)
+        if first is None:
+            self._patterns[pattern] = include
+            return False
+        if first == include:
+            self.parse_stats.duplicates += 1
+        else:
+            self.parse_stats.shadowed += 1
+        return True
 
     def __str__(self):
         '''
         iterate over filter list and return newline separated string of filters
         '''
-        return '\n'.join(map(str, self.rules))
+        return '\n'.join(map(str, self._lines))
+
+    def __reduce__(self):
+        '''
+        pickle as the text of the rules, which is much smaller than the
+        compiled regular expressions and rule index
+        '''
+        return (self.__class__, (str(self), self.cache_size))
+
+    def for_tree(self, root):
+        '''
+        Return something to apply the rules with while crawling the tree at
+        root: a FilterStack if there are dir-merge rules, which reads their
+        files from the tree, or else the ruleset itself.
+        '''
+        if self.dir_merges:
+            return FilterStack(self, root)
+        return self
+
+    def clear_cache(self):
+        '''
+        empty the decision cache and reset its hit and miss counters
+        '''
+        with self._cache_lock:
+            if self.cache_size > 0:
+                self._cache = OrderedDict()
+            else:
+                self._cache = None
+            self.cache_hits = 0
+            self.cache_misses = 0
+
+    def inherit_cache(self, previous):
+        '''
+        Copy the decisions cached by previous, an earlier version of the
+        ruleset, which still hold: those made by a rule before the first one
+        which differs.
+        '''
+        if self._cache is None or previous._cache is None:
+            return
+        first_changed = self.diff(previous).first_changed
+        if first_changed is None:
+            first_changed = len(self.rules)
+        with previous._cache_lock:
+            cached = previous._cache.items()
+        with self._cache_lock:
+            for key, index in cached:
+                if index is not None and index < first_changed:
+                    self._store(key, index)
+
+    def diff(self, previous):
+        '''
+        Compare the rules with those of previous, an earlier version of the
+        ruleset, returning a RulesetDiff.  Rules are compared by their text.
+        '''
+        old = [str(rule) for rule in previous.rules]
+        new = [str(rule) for rule in self.rules]
+        # Most edits touch a few lines, so only the lines between the common
+        # prefix and suffix are handed to the (quadratic) sequence matcher.
+        prefix = 0
+        limit = min(len(old), len(new))
+        while prefix < limit and old[prefix] == new[prefix]:
+            prefix += 1
+        suffix = 0
+        limit -= prefix
+        while suffix < limit and old[-1 - suffix] == new[-1 - suffix]:
+            suffix += 1
+        matcher = difflib.SequenceMatcher(None,
+                                          old[prefix:len(old) - suffix],
+                                          new[prefix:len(new) - suffix],
+                                          autojunk=False)
+        inserted = []
+        removed = []
+        modified = []
+        for tag, i1, i2, j1, j2 in matcher.get_opcodes():
+            i1 += prefix
+            i2 += prefix
+            j1 += prefix
+            j2 += prefix
+            if tag == 'replace':
+                common = min(i2 - i1, j2 - j1)
+                modified.extend(zip(range(i1, i1 + common),
+                                    range(j1, j1 + common)))
+                removed.extend(range(i1 + common, i2))
+                inserted.extend(range(j1 + common, j2))
+            elif tag == 'delete':
+                removed.extend(range(i1, i2))
+            elif tag == 'insert':
+                inserted.extend(range(j1, j2))
+        return RulesetDiff(inserted, removed, modified)
 
     def apply(self, path, stat):
         '''
-        iterate over filter list and check match (filtered in/out)
+        find the first rule which matches and check match (filtered in/out)
         '''
-        for rule in self.rules:
-             match, result = rule.apply(path, stat)
-             if match:
-                return result
-        return True
+        index = self.match_index(path, stat)
+        if index is None:
+            return True
+        return self.rules[index].include
+
+    def apply_many(self, paths, stats):
+        '''
+        Apply the ruleset to a batch of paths with corresponding stats, such as
+        a directory listing or a whole file list.  Returns a NumPy boolean
+        array if NumPy is available, or a list of booleans otherwise.
+
+        The rules are evaluated one at a time over the whole batch, each only
+        against the paths which no earlier rule has decided, as described
+        for RuleIndex.first_matches().  The decision cache isn't used.
+        '''
+        results = [True] * len(paths)
+        dirs = []
+        files = []
+        for i, stat in enumerate(stats):
+            if '\n' in paths[i]:
+                # Decided on its own, as match_type_index() explains.
+                index = self.match_index(paths[i], stat)
+                if index is not None:
+                    results[i] = self.rules[index].include
+            elif S_ISDIR(stat.st_mode):
+                dirs.append(i)
+            else:
+                files.append(i)
+        for indices, rule_index in ((dirs, self._dir_index),
+                                    (files, self._file_index)):
+            matches = rule_index.first_matches([paths[i] for i in indices])
+            for i, index in zip(indices, matches):
+                if index is not None:
+                    results[i] = self.rules[index].include
+        if numpy is not None:
+            return numpy.array(results, dtype=bool)
+        return results
+
+    def match_index(self, path, stat):
+        '''
+        Return the index of the first rule which matches the given path, or
+        None if no rule matches.
+        '''
+        return self.match_type_index(path, S_ISDIR(stat.st_mode))
+
+    def match_type_index(self, path, is_dir):
+        '''
+        Like match_index(), but takes a boolean indicating whether the path is
+        a directory rather than a stat result.
+        '''
+        if self._cache is None:
+            return self._match_type_index(path, is_dir)
+        key = (path, is_dir)
+        with self._cache_lock:
+            try:
+                # Taken out to be put back as the most recently used
+                index = self._cache.pop(key)
+            except KeyError:
+                self.cache_misses += 1
+            else:
+                self.cache_hits += 1
+                self._cache[key] = index
+                return index
+        # Matched without the lock, so that threads can match at once
+        index = self._match_type_index(path, is_dir)
+        with self._cache_lock:
+            self._store(key, index)
+        return index
+
+    def _store(self, key, index):
+        '''
+        cache a decision, evicting the least recently used if the cache is
+        full; the cache lock must be held
+        '''
+        if len(self._cache) >= self.cache_size:
+            self._cache.popitem(last=False)
+        self._cache[key] = index
+
+    def _match_type_index(self, path, is_dir):
+        if '\n' in path:
+            # The fast paths of RuleIndex don't model how '^' and '$' behave
+            # around newlines, so fall back to trying each rule in turn.
+            for index, rule in enumerate(self.rules):
+                if rule.match_type(path, is_dir):
+                    return index
+            return None
+        if is_dir:
+            return self._dir_index.first_match(path)
+        else:
+            return self._file_index.first_match(path)
+
+class ParseStats(object):
+    '''
+    What parsing a FilterRuleset found: the number of lines read and rules
+    kept, and, if duplicates were dropped, the number of rules dropped as
+    duplicates of an earlier rule with the same pattern and action, and as
+    shadowed by an earlier rule with the same pattern and the opposite
+    action.  seconds is the time taken to parse the rules and build the rule
+    index.
+    '''
+    def __init__(self):
+        self.lines = 0
+        self.rules = 0
+        self.duplicates = 0
+        self.shadowed = 0
+        self.seconds = 0.0
+
+    def __repr__(self):
+        return ('{0}(lines={1}, rules={2}, duplicates={3}, shadowed={4}, '
+                'seconds={5:.3f})'.format(self.__class__.__name__, self.lines,
+                                          self.rules, self.duplicates,
+                                          self.shadowed, self.seconds))
+
+class RulesetDiff(object):
+    '''
+    The differences between two versions of a FilterRuleset.
+
+    inserted lists the indices of new rules, removed the indices of old
+    rules which are gone, and modified (old index, new index) pairs of rules
+    which were replaced.  first_changed is the index of the first rule which
+    differs, or None if the rules are the same: a path decided by an earlier
+    rule is decided the same way by both versions.
+    '''
+    def __init__(self, inserted, removed, modified):
+        self.inserted = inserted
+        self.removed = removed
+        self.modified = modified
+        changed = inserted + removed + [new for _, new in modified]
+        if changed:
+            self.first_changed = min(changed)
+        else:
+            self.first_changed = None
+
+    def __nonzero__(self):
+        return self.first_changed is not None
+
+'Characters which have a special meaning in a translated pattern.'
+_SPECIAL = regex.compile(r'[][*?\\()+{}|^$]')
+
+class RuleIndex(object):
+    '''
+    Finds the first of a list of rules that matches a path of a given type.
+
+    Rules whose patterns are plain strings are sorted into hash tables so that
+    they cost a dictionary lookup per path rather than a regular expression
+    search.  An unanchored pattern matches the end of the path, so 'foo', '*.o'
+    and '**/foo' are all looked up by path suffix, one table per suffix length.
+    An anchored pattern such as '/foo/bar' is looked up by the entire path.
+    The remaining rules are combined into one regular expression.  The first
+    matching rule is the lowest index among the hits from all of them.
+    '''
+    def __init__(self, rules, is_dir):
+        self._is_dir = is_dir
+        self._always = None
+        self._exact = {}
+        suffixes = {}
+        fallback = []
+        for index, rule in enumerate(rules):
+            if rule.regexp(is_dir) is None:
+                continue
+            exp = rule.exp.rstrip('/')
+            if exp.startswith('/'):
+                literal = exp[1:]
+            else:
+                literal = exp.lstrip('*')
+            if exp.endswith('/***') or _SPECIAL.search(literal):
+                fallback.append((index, rule))
+            elif exp.startswith('/'):
+                self._exact.setdefault(literal, index)
+            elif not literal:
+                # Every path ends with the empty string.
+                if self._always is None:
+                    self._always = index
+            else:
+                table = suffixes.setdefault(len(literal), {})
+                table.setdefault(literal, index)
+        self._suffixes = sorted(suffixes.items())
+        self._fallback = fallback
+        if fallback:
+            self._first_fallback = fallback[0][0]
+        else:
+            self._first_fallback = None
+        self._regexp = combine_rules(fallback, is_dir)
+
+    def first_match(self, path):
+        '''
+        Return the index of the first rule matching path, or None.
+        '''
+        best = self._first_literal(path)
+        if self._regexp is None or (best is not None and
+                                    best < self._first_fallback):
+            return best
+        matchobj = self._regexp.match(path)
+        if matchobj is not None:
+            index = int(matchobj.lastgroup[1:])
+            if best is None or index < best:
+                best = index
+        return best
+
+    def first_matches(self, paths):
+        '''
+        Return a list of the index of the first rule matching each of paths,
+        which must not contain newlines, or None.
+
+        The hash tables are looked up for every path first.  Then each of the
+        other rules, in order, is searched for in the paths it could still
+        decide -- those which no earlier rule matches -- joined by newlines,
+        so that the regular expression engine scans them in one call rather
+        than being called once per path.  Each rule's expression is
+        translated so that it can't match across a newline, other than
+        through a character class such as [^a]; the paths a match spans are
+        checked one at a time.  The joined paths are rebuilt without those
+        which have been decided once half of them have been.
+        '''
+        best = map(self._first_literal, paths)
+        # The number of paths decided by a hash table before each rule
+        literal = sorted(index for index in best if index is not None)
+        pending = range(len(paths))
+        text = None
+        decided = 0
+        decided_at_join = 0
+        for rule_index, rule in self._fallback:
+            if text is None:
+                pending = [i for i in pending
+                           if best[i] is None or best[i] > rule_index]
+                if not pending:
+                    break
+                text = '\n'.join([paths[i] for i in pending])
+                starts = [0]
+                for i in pending:
+                    starts.append(starts[-1] + len(paths[i]) + 1)
+                decided_at_join = decided + bisect.bisect(literal, rule_index)
+            search = rule.regexp(self._is_dir).search
+            for matchobj in rule.line_regexp(self._is_dir).finditer(text):
+                first = bisect.bisect(starts, matchobj.start()) - 1
+                last = bisect.bisect(starts, matchobj.end()) - 1
+                for line in xrange(first, last + 1):
+                    i = pending[line]
+                    if best[i] is not None and best[i] <= rule_index:
+                        continue
+                    if first != last and search(paths[i]) is None:
+                        continue
+                    if best[i] is None:
+                        decided += 1
+                    best[i] = rule_index
+            if (decided + bisect.bisect(literal, rule_index) - decided_at_join
+                    > len(pending) // 2):
+                text = None
+        return best
+
+    def _first_literal(self, path):
+        '''
+        Return the index of the first rule in the hash tables which matches
+        path, or None.
+        '''
+        best = self._always
+        index = self._exact.get(path)
+        if index is not None and (best is None or index < best):
+            best = index
+        length = len(path)
+        for suffix_length, table in self._suffixes:
+            if suffix_length > length:
+                break
+            index = table.get(path[-suffix_length:])
+            if index is not None and (best is None or index < best):
+                best = index
+        return best
+
+def combine_rules(indexed_rules, is_dir):
+    '''
+    Combine the patterns of the given (index, rule) pairs into a single regular
+    expression which matches paths of the given type.  Each rule becomes one
+    alternative in a named group (r0, r1, ...) named after its index.  Every
+    alternative is anchored at the start of the path and has to scan for its
+    own match, so the regular expression engine exhausts one rule before
+    trying the next and the group which matches is always that of the first
+    matching rule.  Returns None if none of the rules can match.
+    '''
+    alternatives = []
+    for index, rule in indexed_rules:
+        regexp = rule.regexp(is_dir)
+        if regexp is not None:
+            alternatives.append('(?P<r{0}>.*?(?:{1}))'.format(index,
+                                                             regexp.pattern))
+    if not alternatives:
+        return None
+    return regex.compile('\\A(?:' + '|'.join(alternatives) + ')',
+                         flags=regex.DOTALL | regex.MULTILINE)
+
+_GLOB_TOKENS = regex.compile('((^/)|(\/\*\*\*$)|(\*\*)|(\*)|(\?)|(\.))',
+                             flags=regex.MULTILINE)
+
+def compile_pattern(pattern, is_dir, lines=False):
+    '''
+    Translate an rsync filter pattern into a compiled regular expression which
+    matches paths of the given type (directory or not).  Returns None if the
+    pattern can never match that type of path, as is the case for a pattern
+    with a trailing slash and a file.
+
+    If lines is true, the wildcards don't match newlines, so that the
+    expression can be searched for in many paths joined by newlines.
+    '''
+    if pattern.endswith("/") and not is_dir:
+        return None
+    exp = pattern.rstrip("/")
+    if lines:
+        segment = '[^/\n]'
+        flags = regex.MULTILINE
+    else:
+        segment = '[^/]'
+        flags = regex.DOTALL | regex.MULTILINE
+
+    def callback(matchobj):
+        mtch = matchobj.group(0)
+        if mtch == '*':
+            return segment + '*'
+        elif mtch == '**':
+            return '.*'
+        elif mtch == '/***':
+            if is_dir:
+                return '(?:/.*)?'
+            else:
+                return '(?:/.*)'
+        elif mtch == '?':
+            return segment
+        elif mtch == '/':
+            return '^'
+        elif mtch == '.':
+            return '\.'
+        else:
+            return mtch
+
+    exp = _GLOB_TOKENS.sub(callback, exp) + '$'
+    return regex.compile(exp, flags=flags)
 
 class FilterRule(object):
     def __init__(self, pattern):
         self.exp = pattern
+        # Translate the pattern once, up front, rather than on every match.
+        self._dir_regexp = compile_pattern(pattern, True)
+        self._file_regexp = compile_pattern(pattern, False)
 
     def match(self, path, stat):
         '''
@@ -87,39 +621,37 @@ class FilterRule(object):
         assert not path.endswith('/')
         assert not path.startswith('/')
 
-        exp = self.exp
+        return self.match_type(path, S_ISDIR(stat.st_mode))
 
-        if exp.endswith("/") and not(S_ISDIR(stat.st_mode)):
-            return False
-        else:
-            exp = exp.rstrip("/")
-
-        def callback(matchobj):
-            mtch = matchobj.group(0)
-            if mtch == '*':
-                return '[^/]*'
-            elif mtch == '**':
-                return '.*'
-            elif regex.search('\/\*\*\*', mtch):
-                if S_ISDIR(stat.st_mode):
-                    return '(?:/.*)?'
-                else:
-                    return '(?:/.*)'
-            elif mtch == '?':
-                return '[^/]'
-            elif mtch == '/':
-                return '^'
-            elif mtch == '.':
-                return '\.'
-            else:
-                return mtch
+    def match_type(self, path, is_dir):
+        '''
+        Like match(), but takes a boolean indicating whether the path is a
+        directory rather than a stat result.
+        '''
+        regexp = self.regexp(is_dir)
+        return regexp is not None and regexp.search(path) is not None
 
-        exp = regex.sub('((^/)|(\/\*\*\*$)|(\*\*)|(\*)|(\?)|(\.))',
-                        callback, exp, flags=regex.MULTILINE)
-        exp = exp + '$'
+    def regexp(self, is_dir):
+        '''
+        Return the compiled regular expression used to match paths of the given
+        type, or None if the rule cannot match that type of path.
+        '''
+        if is_dir:
+            return self._dir_regexp
+        else:
+            return self._file_regexp
 
-        regexp = regex.compile(exp, flags=regex.DOTALL | regex.MULTILINE)
-        return bool(regexp.search(path))
+    def line_regexp(self, is_dir):
+        '''
+        Like regexp(), but the expression is compiled, on first use, by
+        compile_pattern() with lines set.
+        '''
+        try:
+            return self._line_regexps[is_dir]
+        except AttributeError:
+            self._line_regexps = (compile_pattern(self.exp, False, True),
+                                  compile_pattern(self.exp, True, True))
+            return self._line_regexps[is_dir]
 
     def apply(self, path, stat):
         return False, False
@@ -128,6 +660,8 @@ class FilterRule(object):
         return self.exp
 
 class ExcludeFilter(FilterRule):
+    include = False
+
     def apply(self, path, stat):
         if self.match(path, stat):
             return True, False
@@ -142,6 +676,8 @@ class MinusFilter(ExcludeFilter):
         return '- ' + self.exp
 
 class IncludeFilter(FilterRule):
+    include = True
+
     def apply(self, path, stat):
         if self.match(path, stat):
             return True, True
@@ -156,4 +692,259 @@ class PlusFilter(IncludeFilter):
         return '+ ' + self.exp
 
 class NullFilter(FilterRule):
-    pass
+    def __init__(self, line):
+        # Unrecognized lines never match, so there is nothing to compile.
+        self.exp = line
+        self._dir_regexp = self._file_regexp = None
+
+'The rule classes by the keyword which starts a line.'
+RULE_TYPES = {
+    'include': IncludeFilter,
+    '+': PlusFilter,
+    'exclude': ExcludeFilter,
+    '-': MinusFilter,
+}
+
+class MergeFilter(NullFilter):
+    '''
+    A merge rule, which reads rules from another file.  The rules of a merge
+    file take the place of the rule when it is parsed; a dir-merge rule's
+    files are read from each directory of the tree as it is crawled.
+
+    The modifiers '-' and '+' make every line of the file an exclude or
+    include pattern, 'n' keeps the rules of a per-directory file from
+    applying beneath its directory, and 'e' excludes the per-directory
+    files themselves.
+    '''
+    def __init__(self, line, filename, modifiers):
+        NullFilter.__init__(self, line)
+        self.filename = filename
+        if '-' in modifiers:
+            self.line_type = MinusFilter
+        elif '+' in modifiers:
+            self.line_type = PlusFilter
+        else:
+            self.line_type = None
+        self.inherit = 'n' not in modifiers
+        self.exclude_self = 'e' in modifiers
+
+class DirMergeFilter(MergeFilter):
+    def __init__(self, line, filename, modifiers):
+        MergeFilter.__init__(self, line, filename, modifiers)
+        # Only files in the crawled tree are read, not in the parents of its
+        # root as rsync does for a path such as /.rsync-filter.
+        self.name = os.path.basename(filename)
+
+_MERGE_RULE = regex.compile(
+    r'(?:(?P<keyword>merge|dir-merge)(?:,(?P<long>[-+ne]+))?|'
+    r'(?P<short>[.:])(?P<modifiers>[-+ne]*)) (?P<filename>.+)\Z')
+
+def parse_merge_rule(line):
+    '''
+    Return a MergeFilter or DirMergeFilter for a merge or dir-merge rule, or
+    None if the line is not one.
+    '''
+    matchobj = _MERGE_RULE.match(line)
+    if matchobj is None:
+        return None
+    modifiers = matchobj.group('long') or matchobj.group('modifiers') or ''
+    if '-' in modifiers and '+' in modifiers:
+        return None
+    if matchobj.group('keyword') == 'dir-merge' or \
+            matchobj.group('short') == ':':
+        rule_type = DirMergeFilter
+    else:
+        rule_type = MergeFilter
+    return rule_type(line, matchobj.group('filename'), modifiers)
+
+'The number of parsed merge files kept by merge_cache.'
+MERGE_CACHE_SIZE = 4096
+
+class MergeCache(object):
+    '''
+    Parsed merge files, keyed by the device, inode and mtime of the file, so
+    that each file is parsed again only once it changes, however many
+    rulesets and directories use it.  The least recently used files are
+    dropped once there are more than size.  A MergeCache can be shared
+    between threads.
+    '''
+    def __init__(self, size=MERGE_CACHE_SIZE):
+        self.size = size
+        self.hits = 0
+        self.misses = 0
+        self._rulesets = OrderedDict()
+        self._lock = threading.Lock()
+        # The keys of the files each thread is parsing, to catch merge files
+        # which merge each other
+        self._parsing = threading.local()
+
+    def clear(self):
+        '''
+        empty the cache and reset its hit and miss counters
+        '''
+        with self._lock:
+            self._rulesets.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def load(self, filename, line_type=None):
+        '''
+        Return a FilterRuleset of the rules in filename, or None if there is
+        no such file.  line_type is as for FilterRuleset.  A regex.error from
+        a bad pattern is given the filename of the innermost file it is in,
+        as an EnvironmentError has.
+        '''
+        try:
+            f = open(filename, 'rb')
+        except EnvironmentError, e:
+            if e.errno in (errno.ENOENT, errno.ENOTDIR):
+                return None
+            raise e
+        with f:
+            st = os.fstat(f.fileno())
+            key = (st.st_dev, st.st_ino, st.st_mtime, line_type)
+            with self._lock:
+                ruleset = self._rulesets.pop(key, None)
+                if ruleset is not None:
+                    self.hits += 1
+                    self._rulesets[key] = ruleset
+                    return ruleset
+                self.misses += 1
+            parsing = self._parsing.__dict__.setdefault('keys', set())
+            if key in parsing:
+                raise IOError(errno.ELOOP, 'merge files merge each other',
+                              filename)
+            parsing.add(key)
+            try:
+                ruleset = FilterRuleset(f, line_type=line_type)
+            except regex.error, e:
+                if getattr(e, 'filename', None) is None:
+                    e.filename = filename
+                raise
+            finally:
+                parsing.discard(key)
+        with self._lock:
+            if len(self._rulesets) >= self.size:
+                self._rulesets.popitem(last=False)
+            self._rulesets[key] = ruleset
+        return ruleset
+
+'The cache merge and dir-merge rules read their files through.'
+merge_cache = MergeCache()
+
+class FilterStack(object):
+    '''
+    Applies a FilterRuleset with dir-merge rules to the paths of the tree at
+    root, relative to root, as a crawl finds them.
+
+    The per-directory files of the dir-merge rules are read from each
+    directory the first time a path in it is applied.  The rules in effect
+    in a directory are those of its parent, with the rules of its own files
+    put first at the place of each dir-merge rule, as rsync does.  As with
+    rsync, the patterns of a per-directory file are matched against paths
+    relative to its directory.  dir-merge rules within a per-directory file
+    are ignored.
+
+    The rules of the directories from the root down to the last one applied
+    are kept on a stack, which is popped and pushed as the crawl moves
+    between directories.  A crawl goes depth first, so each directory's
+    files are read once, and applying a path costs one lookup in the
+    ruleset plus one in each per-directory file in effect.  Each thread has
+    a stack of its own, so a FilterStack can be shared by the threads of a
+    ParallelSpider.
+    '''
+    def __init__(self, filters, root):
+        self.filters = filters
+        self.root = root
+        self._local = threading.local()
+
+    def __reduce__(self):
+        return (self.__class__, (self.filters, self.root))
+
+    def apply(self, path, stat):
+        return self.dir_ruleset(path.rpartition('/')[0]).apply(path, stat)
+
+    def dir_ruleset(self, rel_dir):
+        '''
+        Return the rules in effect in the directory at rel_dir, relative to
+        root, as a DirRuleset.
+        '''
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            empty = DirRuleset(self.filters,
+                               [(index, []) for index, _
+                                in self.filters.dir_merges])
+            stack = self._local.stack = [('', self._enter(empty, ''))]
+        top_dir, top = stack[-1]
+        while top_dir != rel_dir and len(stack) > 1 and \
+                not rel_dir.startswith(top_dir + '/'):
+            stack.pop()
+            top_dir, top = stack[-1]
+        if top_dir == rel_dir:
+            return top
+        current = top_dir
+        for name in rel_dir[len(top_dir) + 1 if top_dir else 0:].split('/'):
+            current = current + '/' + name if current else name
+            top = self._enter(top, current)
+            stack.append((current, top))
+        return top
+
+    def _enter(self, parent, rel_dir):
+        '''
+        Return the rules in effect in rel_dir, given those of its parent.
+        '''
+        dir_path = os.path.join(self.root, rel_dir)
+        prefix = len(rel_dir) + 1 if rel_dir else 0
+        merges = []
+        inherited = []
+        changed = False
+        for (index, entries), inherit, (_, rule) in zip(
+                parent.merges, parent.inherited, self.filters.dir_merges):
+            changed = changed or entries is not inherit
+            ruleset = merge_cache.load(os.path.join(dir_path, rule.name),
+                                       rule.line_type)
+            if ruleset is None:
+                merges.append((index, inherit))
+                inherited.append(inherit)
+                continue
+            changed = True
+            entries = [(prefix, ruleset)] + inherit
+            merges.append((index, entries))
+            inherited.append(entries if rule.inherit else inherit)
+        if not changed:
+            return parent
+        return DirRuleset(self.filters, merges, inherited)
+
+class DirRuleset(object):
+    '''
+    The rules in effect in one directory, for a FilterStack.
+
+    merges holds, for the index of each dir-merge rule, a list of the
+    (prefix, FilterRuleset) pairs of the per-directory files in effect, in
+    order, where prefix is the length of the path of the file's directory
+    to strip from a path before matching it.  inherited holds the lists
+    which apply to subdirectories.
+    '''
+    def __init__(self, filters, merges, inherited=None):
+        self.filters = filters
+        self.merges = merges
+        if inherited is None:
+            inherited = [entries for _, entries in merges]
+        self.inherited = inherited
+
+    def apply(self, path, stat):
+        is_dir = S_ISDIR(stat.st_mode)
+        # The dir-merge rules themselves never match, so the first matching
+        # rule of the ruleset only has to be compared with the per-directory
+        # rules which come before it.
+        index = self.filters.match_type_index(path, is_dir)
+        for merge_index, entries in self.merges:
+            if index is not None and index < merge_index:
+                break
+            for prefix, ruleset in entries:
+                match = ruleset.match_type_index(path[prefix:], is_dir)
+                if match is not None:
+                    return ruleset.rules[match].include
+        if index is None:
+            return True
+        return self.filters.rules[index].include
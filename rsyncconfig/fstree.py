@@ -15,9 +15,12 @@
 
 import os
 import stat
+import bisect
+from array import array
+from collections import namedtuple
 
-import gobject
-import gtk
+from rsyncconfig.spider import EntryStat
+from rsyncconfig.pathtable import PathTable, ROOT
 
 'The full file path relative to the root.'
 COL_PATH = 0
@@ -25,37 +28,537 @@ COL_PATH = 0
 COL_STAT = 1
 'Whether the subtree of the path is currently being spidered.'
 COL_SPIDERING = 2
+'Whether the path is included by the filters, given its ancestors.'
+COL_INCLUDED = 3
+'The Totals of the path and everything beneath it.'
+COL_TOTALS = 4
+
+'Node flag set while the subtree of the node is being spidered.'
+FLAG_SPIDERING = 1
+
+'The decision of a node which no rule matches.'
+NO_MATCH = -1
+'The decision of a node which has not yet been matched against the filters.'
+UNDECIDED = -2
+
+'The counted state of a node whose totals are not in its parent\'s sums.'
+NOT_COUNTED = -1
+
+'How many new rules are tried in turn before matching a node afresh.'
+NEWER_RULES_TRIED = 8
+
+'What the filters would send of a path and everything beneath it.'
+Totals = namedtuple('Totals', 'included_bytes included_files excluded_bytes')
 
 class FSTree(object):
     '''
     Maintains a tree representation of the filesystem provided by a spider.
+
+    Each path is a node of a PathTable, numbered in the order it was added,
+    and the metadata of the nodes is kept in parallel arrays of mode, size,
+    mtime and flags, which comes to a few tens of bytes per entry.  Full paths
+    and stat records are built when asked for.  store is an FSTreeModel view
+    of the tree for a gtk.TreeView, which is only created, and gtk only
+    imported, when it is first asked for.  The children of a directory are
+    only sorted by name once the view asks for them, which happens when its
+    row is expanded.
+
+    Once given filters by set_filters(), the tree caches the rule which
+    decides each node.  Rules are known by an id which they keep for as long
+    as their text is unchanged, and each node records the ids handed out
+    when it was decided, so that after a change of filters only the rules
+    new since then need trying on it: a node decided by a rule which is
+    still there is decided the same way unless a new rule before it matches,
+    and a node no rule matched can only be matched by a new rule.  Only a
+    node whose rule has gone is matched afresh.  The nodes decided by each
+    rule, and those no rule matched, are kept in lists, so that a change of
+    filters hands update_totals() only the lists of the rules which were
+    removed or now follow a new rule, leaving the nodes decided by earlier
+    rules alone.  Each node is decided as it is added, so that the totals
+    below count it, and decided again after a change of filters by
+    update_totals(), or sooner if the view asks about it.
+
+    The tree also keeps Totals of what the filters would send: the bytes and
+    number of the included files, and the bytes of the excluded ones.  Each
+    directory holds the sums of the totals of its children, and each node
+    records whether it was counted as included or excluded in its parent's
+    sums.  Whenever a node is added, changed, removed or decided differently,
+    the difference is added to the sums of its ancestors, turning into
+    excluded bytes above an excluded directory, so the totals are never
+    summed again from scratch.  After a change of filters, update_totals()
+    must be called until it returns False to bring the totals up to date.
     '''
     def __init__(self):
-        self.store = gtk.TreeStore(gobject.TYPE_STRING, 
-                                   object,
-                                   gobject.TYPE_BOOLEAN)
-        self.store.set_sort_column_id(COL_PATH, gtk.SORT_ASCENDING)
-        self._dirs = {}
+        self._paths = PathTable()
+        self._mode = array('I', [stat.S_IFDIR])
+        self._size = array('d', [0])
+        self._mtime = array('d', [0])
+        self._flags = array('B', [0])
+        self._decision = array('i', [NO_MATCH])
+        self._decided_at = array('I', [0])
+        # The sums of the totals of the children of each directory node, and
+        # whether each node is counted as included (1) or excluded (0) in
+        # its parent's sums
+        self._included_bytes = array('d', [0])
+        self._included_files = array('d', [0])
+        self._excluded_bytes = array('d', [0])
+        self._counted = array('b', [1])
+        self.filters = None
+        # The id of each rule of the filters, the index of each id, and the
+        # next id to hand out.  _decision holds the id of the rule deciding
+        # each node and _decided_at the next id at the time.
+        self._rule_ids = []
+        self._rule_index = {}
+        self._next_rule_id = 0
+        # The indices of the rules with at least a given id
+        self._newer_rules = {}
+        # The nodes decided by each rule id, or NO_MATCH, which may include
+        # nodes since decided otherwise or removed, and the next id at the
+        # time each list was last handed to update_totals()
+        self._decided_by = {}
+        self._listed_since = {}
+        # The lists of nodes update_totals() is to decide again
+        self._stale = []
+        # The children of each directory node, in the order they were added,
+        # and the position of each node in its parent's array of children
+        self._children = {}
+        self._child_index = array('i', [0])
+        # The children of each node the view has asked for, as a pair of
+        # lists of names and nodes sorted by name
+        self._sorted = {ROOT: ([], [])}
+        # The directory most recently added to, as spiders add the entries
+        # of a directory together
+        self._last_dir = ('', ROOT)
+        self._store = None
+
+    def __len__(self):
+        '''Return the number of paths in the tree.
+        '''
+        return len(self._paths)
+
+    @property
+    def store(self):
+        '''The FSTreeModel presenting the tree.
+        '''
+        if self._store is None:
+            from rsyncconfig.treemodel import FSTreeModel
+            self._store = FSTreeModel(self)
+        return self._store
+
+    def _notify(self, method, *args):
+        '''Call a method of the store, if there is one.
+        '''
+        if self._store is not None:
+            getattr(self._store, method)(*args)
 
     def add_path(self, path, stat_t, scanning=True):
         '''Add a path and metadata to the store.
+
+        Adding a path which is already present updates it instead, as a
+        Watcher and the spider feeding it may both report a new entry.  A path
+        whose directory isn't in the store is ignored, as the Watcher may have
+        removed the directory since the spider found the path.
         '''
-        basedir, _ = os.path.split(path)
-        if basedir:
-            parent = self._dirs[basedir]
+        basedir, name = os.path.split(path)
+        parent = self._lookup_dir(basedir)
+        if parent is None:
+            return
+        node = self._paths.child(parent, name)
+        if node is not None:
+            self._update_node(node, stat_t, scanning)
+            return
+        node = self._paths.add(parent, name)
+        flags = FLAG_SPIDERING if scanning else 0
+        children = self._children.get(parent)
+        if children is None:
+            children = self._children[parent] = array('i')
+        if node == len(self._mode):
+            self._mode.append(stat_t.st_mode)
+            self._size.append(stat_t.st_size)
+            self._mtime.append(stat_t.st_mtime)
+            self._flags.append(flags)
+            self._decision.append(UNDECIDED)
+            self._decided_at.append(0)
+            self._child_index.append(len(children))
+            self._included_bytes.append(0)
+            self._included_files.append(0)
+            self._excluded_bytes.append(0)
+            self._counted.append(NOT_COUNTED)
         else:
-            parent = None
-        iter = self.store.append(parent, (path, stat_t, scanning))
-        if stat.S_ISDIR(stat_t):
-            # XXX: Is keeping around iters costly?
-            self._dirs[path] = iter
+            # The node number of a removed path is being reused.
+            self._set_stat(node, stat_t)
+            self._flags[node] = flags
+            self._decision[node] = UNDECIDED
+            self._child_index[node] = len(children)
+            self._included_bytes[node] = 0
+            self._included_files[node] = 0
+            self._excluded_bytes[node] = 0
+            self._counted[node] = NOT_COUNTED
+        children.append(node)
+        self.get_decision(node)
 
-    def update_path(self, path, stat, scanning=False):
+        sorted_children = self._sorted.get(parent)
+        if sorted_children is not None:
+            names, nodes = sorted_children
+            index = bisect.bisect(names, name)
+            names.insert(index, name)
+            nodes.insert(index, node)
+            self._notify('node_inserted', node)
+        if (len(children) == 1 and parent != ROOT and
+                self._paths.parent[parent] in self._sorted):
+            self._notify('node_has_child_toggled', parent)
+
+    def update_path(self, path, stat_t, scanning=False):
         '''Update a path's metadata.
+
+        If a directory has become something else, its contents are removed.
+        Paths which aren't in the store are ignored.
         '''
-        pass
+        node = self._paths.lookup(path)
+        if node is not None:
+            self._update_node(node, stat_t, scanning)
+
+    def _update_node(self, node, stat_t, scanning):
+        if (stat.S_ISDIR(self._mode[node]) and
+                not stat.S_ISDIR(stat_t.st_mode)):
+            for child in list(self._children.get(node, ())):
+                self._remove_node(child)
+        self._count(node, NOT_COUNTED)
+        if stat.S_ISDIR(self._mode[node]) != stat.S_ISDIR(stat_t.st_mode):
+            self._decision[node] = UNDECIDED
+        self._set_stat(node, stat_t)
+        self._count(node, self._includes(self.get_decision(node)))
+        if scanning:
+            self._flags[node] |= FLAG_SPIDERING
+        else:
+            self._flags[node] &= ~FLAG_SPIDERING
+        if self._paths.parent[node] in self._sorted:
+            self._notify('node_changed', node)
 
     def remove_path(self, path):
-        '''Remove a path from the store.
+        '''Remove a path, and everything beneath it, from the store.
+
+        Paths which aren't in the store are ignored.
+        '''
+        node = self._paths.lookup(path)
+        if node is not None and node != ROOT:
+            self._remove_node(node)
+
+    def _set_stat(self, node, stat_t):
+        self._mode[node] = stat_t.st_mode
+        self._size[node] = stat_t.st_size
+        self._mtime[node] = stat_t.st_mtime
+
+    def _remove_node(self, node):
+        '''Remove a node and its subtree, telling the view if it's shown.
+        '''
+        self._count(node, NOT_COUNTED)
+        parent = self._paths.parent[node]
+        sorted_children = self._sorted.get(parent)
+        if sorted_children is not None:
+            tree_path = self.tree_path(node)
+            names, nodes = sorted_children
+            index = bisect.bisect_left(names, self._paths.get_name(node))
+            del names[index]
+            del nodes[index]
+
+        # Swap the last of the parent's children into the node's place.
+        children = self._children[parent]
+        index = self._child_index[node]
+        last = children.pop()
+        if last != node:
+            children[index] = last
+            self._child_index[last] = index
+        if not children:
+            del self._children[parent]
+
+        stack = [node]
+        while stack:
+            descendant = stack.pop()
+            stack.extend(self._children.pop(descendant, ()))
+            self._sorted.pop(descendant, None)
+            self._paths.remove(descendant)
+        self._last_dir = ('', ROOT)
+
+        if sorted_children is not None:
+            self._notify('node_deleted', tree_path)
+            if (not children and parent != ROOT and
+                    self._paths.parent[parent] in self._sorted):
+                self._notify('node_has_child_toggled', parent)
+
+    def _lookup_dir(self, path):
+        '''Return the node of the directory at path, or None if there is no
+        directory there.
+        '''
+        last_path, node = self._last_dir
+        if path != last_path:
+            node = self._paths.lookup(path)
+            if node is None or not stat.S_ISDIR(self._mode[node]):
+                return None
+            self._last_dir = (path, node)
+        return node
+
+    def get_path(self, node):
+        '''Return the path of a node relative to the root.
+        '''
+        return self._paths.get_path(node)
+
+    def get_stat(self, node):
+        '''Return a stat record for a node.
+        '''
+        return EntryStat(self._mode[node], self._size[node],
+                         self._mtime[node])
+
+    def get_parent(self, node):
+        '''Return the parent node of a node, or ROOT.
+        '''
+        return self._paths.parent[node]
+
+    def is_spidering(self, node):
+        return bool(self._flags[node] & FLAG_SPIDERING)
+
+    def set_filters(self, filters):
+        '''Set the FilterRuleset the nodes are decided by.
+
+        The filters are compared with the previous ones by
+        FilterRuleset.diff().  Nodes decided by a rule before the first new
+        one are left alone; the others are decided again a batch at a time
+        by update_totals(), trying only the new rules unless the rule which
+        decided them has gone.  The view must be redrawn to show the new
+        decisions.
+        '''
+        previous = self.filters
+        self.filters = filters
+        rules = filters.rules if filters is not None else []
+        if previous is not None and filters is not None:
+            diff = filters.diff(previous)
+            changed = set(diff.inserted)
+            changed.update(new for _, new in diff.modified)
+            lost = set(diff.removed)
+            lost.update(old for old, _ in diff.modified)
+        else:
+            changed = set(xrange(len(rules)))
+            lost = set(xrange(len(self._rule_ids)))
+        kept = iter([rule_id for index, rule_id in enumerate(self._rule_ids)
+                     if index not in lost])
+        rule_ids = []
+        for index in xrange(len(rules)):
+            if index in changed:
+                rule_ids.append(self._next_rule_id)
+                self._next_rule_id += 1
+            else:
+                rule_ids.append(next(kept))
+        for index in lost:
+            rule_id = self._rule_ids[index]
+            self._listed_since.pop(rule_id, None)
+            self._queue_stale(rule_id)
+        self._rule_ids = rule_ids
+        self._rule_index = dict((rule_id, index)
+                                for index, rule_id in enumerate(rule_ids))
+        self._newer_rules = {}
+        if changed:
+            for rule_id in [NO_MATCH] + rule_ids[min(changed) + 1:]:
+                self._listed_since[rule_id] = self._next_rule_id
+                self._queue_stale(rule_id)
+
+    def _queue_stale(self, rule_id):
+        '''Hand the nodes decided by a rule id to update_totals().
+        '''
+        nodes = self._decided_by.pop(rule_id, None)
+        if nodes:
+            self._stale.append(nodes)
+
+    def get_decision(self, node):
+        '''Return the index of the rule which decides a node, or NO_MATCH if
+        none matches or there are no filters.
+        '''
+        rule_id = self._decision[node]
+        decided_at = self._decided_at[node]
+        if rule_id == UNDECIDED or (rule_id != NO_MATCH and
+                                    rule_id not in self._rule_index):
+            decision = self._match(node)
+        elif decided_at != self._next_rule_id:
+            decision = self._match_newer(node, rule_id, decided_at)
+        else:
+            return self._rule_index.get(rule_id, NO_MATCH)
+        new_id = self._rule_ids[decision] if decision != NO_MATCH else NO_MATCH
+        if new_id != rule_id or \
+                decided_at < self._listed_since.get(new_id, 0):
+            self._decision[node] = new_id
+            nodes = self._decided_by.get(new_id)
+            if nodes is None:
+                nodes = self._decided_by[new_id] = array('i')
+            nodes.append(node)
+        self._decided_at[node] = self._next_rule_id
+        included = self._includes(decision)
+        if included != self._counted[node]:
+            self._count(node, included)
+        return decision
+
+    def _match(self, node):
+        '''Return the index of the first rule which matches a node, or
+        NO_MATCH.
+        '''
+        if self.filters is None:
+            return NO_MATCH
+        index = self.filters.match_type_index(self._paths.get_path(node),
+                                              stat.S_ISDIR(self._mode[node]))
+        return NO_MATCH if index is None else index
+
+    def _match_newer(self, node, rule_id, decided_at):
+        '''Return the index of the rule which decides a node, given the id
+        of the rule which decided it, which is still there, or NO_MATCH, and
+        the next rule id at the time.
+
+        Only the rules added since, and before the deciding rule, can decide
+        the node differently.
+        '''
+        newer = self._newer_rules.get(decided_at)
+        if newer is None:
+            newer = self._newer_rules[decided_at] = [
+                index for index, other in enumerate(self._rule_ids)
+                if other >= decided_at]
+        if rule_id == NO_MATCH:
+            decision = NO_MATCH
+            end = len(newer)
+        else:
+            decision = self._rule_index[rule_id]
+            end = bisect.bisect_left(newer, decision)
+        if end > NEWER_RULES_TRIED:
+            return self._match(node)
+        if end:
+            path = self._paths.get_path(node)
+            is_dir = stat.S_ISDIR(self._mode[node])
+            rules = self.filters.rules
+            for index in newer[:end]:
+                if rules[index].match_type(path, is_dir):
+                    return index
+        return decision
+
+    def _includes(self, decision):
+        '''Return whether a decision includes the node.
+        '''
+        return decision == NO_MATCH or self.filters.rules[decision].include
+
+    def is_included(self, node):
+        '''Return whether a node is included by the filters.
+
+        A node is only included if its parent is, as rsync doesn't look
+        inside excluded directories.
+        '''
+        rules = self.filters.rules if self.filters is not None else ()
+        while node != ROOT:
+            decision = self.get_decision(node)
+            if decision != NO_MATCH and not rules[decision].include:
+                return False
+            node = self._paths.parent[node]
+        return True
+
+    def _totals(self, node, counted):
+        '''Return the totals of a node as they are counted in its parent's
+        sums, given whether it is counted as included.
+        '''
+        if counted == NOT_COUNTED:
+            return 0, 0, 0
+        if stat.S_ISDIR(self._mode[node]):
+            totals = (self._included_bytes[node], self._included_files[node],
+                      self._excluded_bytes[node])
+        else:
+            totals = (self._size[node], 1, 0)
+        if counted:
+            return totals
+        return 0, 0, totals[0] + totals[2]
+
+    def _count(self, node, counted):
+        '''Change whether a node is counted as included, excluded, or
+        NOT_COUNTED, adding the difference to its ancestors' sums.
+        '''
+        old = self._totals(node, self._counted[node])
+        self._counted[node] = counted
+        new = self._totals(node, counted)
+        included_bytes = new[0] - old[0]
+        included_files = new[1] - old[1]
+        excluded_bytes = new[2] - old[2]
+        parent = self._paths.parent[node]
+        while included_bytes or included_files or excluded_bytes:
+            self._included_bytes[parent] += included_bytes
+            self._included_files[parent] += included_files
+            self._excluded_bytes[parent] += excluded_bytes
+            counted = self._counted[parent]
+            if parent == ROOT or counted == NOT_COUNTED:
+                break
+            if not counted:
+                excluded_bytes += included_bytes
+                included_bytes = included_files = 0
+            parent = self._paths.parent[parent]
+
+    def get_totals(self, node=ROOT):
+        '''Return the Totals of a node and everything beneath it, or of the
+        whole tree.
+
+        As with is_included(), nothing beneath an excluded directory is
+        included.  The totals may be out of date until update_totals() has
+        finished after a change of filters.
+        '''
+        totals = self._totals(node, 1 if self.is_included(node) else 0)
+        return Totals(totals[0], int(totals[1]), totals[2])
+
+    def update_totals(self, max_nodes=1000):
+        '''Decide up to max_nodes nodes which may be decided differently
+        since the filters last changed, updating the totals.
+
+        Returns True if there are nodes left to decide, so that this can be
+        run a batch at a time from an idle callback.
+        '''
+        parents = self._paths.parent
+        stale = self._stale
+        while stale and max_nodes > 0:
+            nodes = stale[-1]
+            while nodes and max_nodes > 0:
+                node = nodes.pop()
+                max_nodes -= 1
+                # Removed nodes have no parent
+                if parents[node] != -1:
+                    self.get_decision(node)
+            if not nodes:
+                stale.pop()
+        return bool(stale)
+
+    def has_children(self, node):
+        return node in self._children
+
+    def count_children(self, node):
+        return len(self._children.get(node, ()))
+
+    def sorted_children(self, node):
+        '''Return a list of the child nodes of a node, sorted by name.
+
+        The list is built the first time it's asked for, and kept sorted as
+        children are added from then on.
+        '''
+        sorted_children = self._sorted.get(node)
+        if sorted_children is None:
+            pairs = sorted((self._paths.get_name(child), child)
+                           for child in self._children.get(node, ()))
+            sorted_children = ([name for name, _ in pairs],
+                               [child for _, child in pairs])
+            self._sorted[node] = sorted_children
+        return sorted_children[1]
+
+    def child_index(self, node):
+        '''Return the position of a node among its siblings sorted by name.
+        '''
+        parent = self._paths.parent[node]
+        self.sorted_children(parent)
+        names = self._sorted[parent][0]
+        return bisect.bisect_left(names, self._paths.get_name(node))
+
+    def tree_path(self, node):
+        '''Return the gtk.TreeModel path of a node.
         '''
-        pass
+        indices = []
+        while node != ROOT:
+            indices.append(self.child_index(node))
+            node = self._paths.parent[node]
+        indices.reverse()
+        return tuple(indices)
@@ -18,12 +18,39 @@ import locale
 import gettext
 from gettext import gettext as _
 
+import pygtk
+pygtk.require('2.0')
 import gtk
+import gobject
+import regex
 
 from . import GETTEXT_DOMAIN, get_pofile_dir
 from .filter import FilterRuleset
-from .fstree import FSTree
+from .fstree import FSTree, COL_PATH, COL_INCLUDED, COL_TOTALS
+from .treemodel import QueuedFSTree
 from .spider import Spider
+from .snapshot import Snapshot
+from . import watch
+
+'Milliseconds after the last edit of the filters before they are applied.'
+FILTER_EDIT_DELAY = 300
+'Milliseconds between updates of the transfer totals.'
+TOTALS_INTERVAL = 250
+'The most nodes decided again per update of the totals after a filter edit.'
+TOTALS_BATCH = 5000
+
+def format_size(size):
+    '''Format a number of bytes for display, such as 1.5 MB
+    '''
+    for unit in ('bytes', 'KB', 'MB', 'GB'):
+        if size < 1024:
+            break
+        size /= 1024.0
+    else:
+        unit = 'TB'
+    if unit == 'bytes':
+        return _('{0:.0f} bytes').format(size)
+    return '{0:.1f} {1}'.format(size, unit)
 
 
 def init_i18n(lang=None):
@@ -58,6 +85,9 @@ def load_gui():
 
 class Application(object):
     def __init__(self):
+        # The spider and watcher run in threads of their own, which would
+        # otherwise be starved while the main loop holds the interpreter lock
+        gobject.threads_init()
         self.builder = load_gui()
         self.builder.connect_signals(self)
 
@@ -67,13 +97,73 @@ class Application(object):
         self.filter_file = None
         self.filter_view = self.builder.get_object('filter_textview')
         self.filters = FilterRuleset('')
+        # The timeout which applies edits of the filters, if one is pending
+        self._filter_edit_source = None
+        self.filter_view.get_buffer().connect('changed',
+                                              self.on_filter_buffer_changed)
+        self.statusbar = self.builder.get_object('main_statusbar')
+        self._filter_error_context = self.statusbar.get_context_id('filters')
+        # Why the edited filters can't be parsed, or None if they can
+        self._filter_error = None
         self.tree = None
-        self.fs_tree_view = None
+        self.fs_tree_view = self.builder.get_object('fstree_treeview')
+        self._init_fs_tree_view()
+        # Passes changes from the spider's thread to self.tree
+        self.tree_queue = None
         self.spider = None
+        # Keeps self.tree up to date after the spider is done, if supported
+        self.watcher = None
+        self._totals_context = self.statusbar.get_context_id('totals')
+        # The timeout which keeps the totals up to date, while there's a tree
+        self._totals_source = None
+        self._shown_totals = None
+
+    def _init_fs_tree_view(self):
+        '''Add the columns to the filesystem tree view
+        '''
+        column = gtk.TreeViewColumn(_('Name'))
+        # Required by the tree view's fixed_height_mode
+        column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+        column.set_fixed_width(300)
+        cell = gtk.CellRendererText()
+        column.pack_start(cell, True)
+        column.set_cell_data_func(cell, self._render_name)
+        self.fs_tree_view.append_column(column)
+
+        column = gtk.TreeViewColumn(_('Included'))
+        column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+        column.set_fixed_width(80)
+        cell = gtk.CellRendererToggle()
+        cell.set_property('activatable', False)
+        column.pack_start(cell, False)
+        column.set_cell_data_func(cell, self._render_included)
+        self.fs_tree_view.append_column(column)
+
+        column = gtk.TreeViewColumn(_('Transfer size'))
+        column.set_sizing(gtk.TREE_VIEW_COLUMN_FIXED)
+        column.set_fixed_width(100)
+        cell = gtk.CellRendererText()
+        cell.set_property('xalign', 1.0)
+        column.pack_start(cell, True)
+        column.set_cell_data_func(cell, self._render_totals)
+        self.fs_tree_view.append_column(column)
+
+    def _render_name(self, column, cell, model, iter):
+        cell.set_property('text',
+                          os.path.basename(model.get_value(iter, COL_PATH)))
+        cell.set_property('sensitive', model.get_value(iter, COL_INCLUDED))
+
+    def _render_included(self, column, cell, model, iter):
+        cell.set_property('active', model.get_value(iter, COL_INCLUDED))
+
+    def _render_totals(self, column, cell, model, iter):
+        totals = model.get_value(iter, COL_TOTALS)
+        cell.set_property('text', format_size(totals.included_bytes))
 
     def on_main_window_destroy(self, window):
         '''When the main window is closed, terminate the mainloop
         '''
+        self._stop_spider()
         gtk.main_quit()
 
     def on_file_new_menu_item_activate(self, menu_item):
@@ -139,7 +229,111 @@ class Application(object):
     def on_rootselect_filechooserbutton_file_set(self, button):
         '''Change the directory tree displayed to the one selected
         '''
-        pass
+        self.set_root(button.get_filename())
+
+    def set_root(self, root):
+        '''Display the directory tree under root, spidering it
+        '''
+        self._stop_spider()
+        self.tree = FSTree()
+        self.tree.set_filters(self.filters)
+        self.tree_queue = QueuedFSTree(self.tree, root)
+        self.fs_tree_view.set_model(self.tree.store)
+        sink = self.tree_queue
+        if watch.is_supported():
+            try:
+                self.watcher = watch.Watcher(
+                    self.tree_queue, root,
+                    overflow=lambda: gobject.idle_add(self._on_watch_overflow,
+                                                      root))
+                sink = self.watcher
+            except EnvironmentError:
+                # Out of inotify instances; the tree won't be kept live.
+                pass
+        self.spider = Spider(sink, root, snapshot=Snapshot(root))
+        self._shown_totals = None
+        self._totals_source = gobject.timeout_add(TOTALS_INTERVAL,
+                                                  self.update_totals)
+
+    def update_totals(self):
+        '''Show the totals of the tree in the status bar, after deciding a
+        batch of the rows the last change of filters may affect
+        '''
+        self.tree.update_totals(TOTALS_BATCH)
+        totals = self.tree.get_totals()
+        if totals != self._shown_totals:
+            self._shown_totals = totals
+            self.statusbar.pop(self._totals_context)
+            self.statusbar.push(self._totals_context,
+                                _('{0} in {1} files to transfer, {2} '
+                                  'excluded').format(
+                                      format_size(totals.included_bytes),
+                                      totals.included_files,
+                                      format_size(totals.excluded_bytes)))
+            # The totals of the rows shown may have changed too
+            self.fs_tree_view.queue_draw()
+        return True
+
+    def _on_watch_overflow(self, root):
+        '''Spider the tree again, as the watcher has missed changes to it
+        '''
+        if self.watcher is not None and self.watcher.root == root:
+            self.set_root(root)
+
+    def _stop_spider(self):
+        '''Stop the spider and watcher feeding the tree, if any
+        '''
+        # Close the queue first, as the spider may be blocked on it
+        if self.tree_queue is not None:
+            self.tree_queue.close()
+        if self.spider is not None:
+            self.spider.stop()
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher = None
+        if self._totals_source is not None:
+            gobject.source_remove(self._totals_source)
+            self._totals_source = None
+
+    def on_filter_buffer_changed(self, textbuffer):
+        '''Apply the edited filters once editing pauses
+        '''
+        if self._filter_edit_source is not None:
+            gobject.source_remove(self._filter_edit_source)
+        self._filter_edit_source = gobject.timeout_add(FILTER_EDIT_DELAY,
+                                                       self.apply_filter_edits)
+
+    def apply_filter_edits(self):
+        '''Parse the filters in the text view and show what they include
+
+        If the filters can't be parsed, the error is shown in the status bar
+        and the last good filters are kept.
+        '''
+        if self._filter_edit_source is not None:
+            gobject.source_remove(self._filter_edit_source)
+            self._filter_edit_source = None
+        textbuffer = self.filter_view.get_buffer()
+        text = textbuffer.get_text(textbuffer.get_start_iter(),
+                                   textbuffer.get_end_iter())
+        self.statusbar.pop(self._filter_error_context)
+        self._filter_error = None
+        try:
+            filters = FilterRuleset(text)
+        except (regex.error, EnvironmentError), e:
+            self._filter_error = _('Invalid filter: {0}').format(e)
+            self.statusbar.push(self._filter_error_context, self._filter_error)
+            return False
+        self.set_filters(filters)
+        return False
+
+    def set_filters(self, filters):
+        '''Use filters, redrawing the tree to show what they include
+        '''
+        diff = filters.diff(self.filters)
+        self.filters = filters
+        if self.tree is not None and diff:
+            self.tree.set_filters(filters)
+            self.fs_tree_view.queue_draw()
 
     def main(self, argv):
         self.window.show()
@@ -148,16 +342,49 @@ class Application(object):
     def read(self):
         '''Read the filter file
         '''
+        text = ''
+        filters = FilterRuleset('')
         if self.filter_file is not None:
             with open(self.filter_file, 'rb') as f:
+                try:
+                    # Parsed a line at a time, as generated filter files can
+                    # be very large
+                    filters = FilterRuleset(f)
+                except (regex.error, EnvironmentError):
+                    filters = None
+                # The text is shown as it is, so that saving it again
+                # doesn't rewrite the file
+                f.seek(0)
                 text = f.read()
-        else:
-            text = ''
-        self.filters = FilterRuleset(text)
         self.filter_view.get_buffer().set_text(text)
+        if filters is None:
+            # Show the error
+            self.apply_filter_edits()
+            return
+        # The filters are already parsed.
+        if self._filter_edit_source is not None:
+            gobject.source_remove(self._filter_edit_source)
+            self._filter_edit_source = None
+        self.statusbar.pop(self._filter_error_context)
+        self._filter_error = None
+        self.set_filters(filters)
 
     def save(self):
-        '''Save to the filter file
+        '''Save the filters to the filter file, as they were typed
+
+        Filters which can't be parsed aren't saved: the error is shown in the
+        status bar again, and the file is left as it was.
         '''
+        if self._filter_edit_source is not None:
+            # Shows the error, if there is one
+            self.apply_filter_edits()
+        elif self._filter_error is not None:
+            self.statusbar.pop(self._filter_error_context)
+            self.statusbar.push(self._filter_error_context, self._filter_error)
+        if self._filter_error is not None:
+            return
+        textbuffer = self.filter_view.get_buffer()
+        text = textbuffer.get_text(textbuffer.get_start_iter(),
+                                   textbuffer.get_end_iter())
         with open(self.filter_file, 'wb+') as f:
-            f.write(str(self.filters))
+            f.write(text)
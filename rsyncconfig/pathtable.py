@@ -0,0 +1,176 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Compact storage for a large number of relative paths
+'''
+
+from array import array
+
+'The node number of the root, whose path is the empty string.'
+ROOT = 0
+
+'Marks a slot of the edge table which has never been used.'
+_EMPTY = -1
+
+class PathTable(object):
+    '''
+    Stores a tree of paths as numbered nodes, each a (parent, name) pair.
+
+    Path components are interned, so each distinct name is stored once no
+    matter how many directories it appears in, and no prefix of a path is
+    stored more than once.  A node's path is rebuilt by walking up its
+    parents.  Looking up a path walks down from the root a component at a
+    time, like a trie.  The edges of the trie are kept in one open addressing
+    hash table of node numbers keyed by (parent, name), which costs a few
+    bytes per node rather than a dictionary per directory.
+
+    The numbers of removed nodes are reused by later additions.  Names are
+    never forgotten once interned.
+    '''
+    def __init__(self):
+        self.parent = array('i', [-1])
+        self.name = array('i', [0])
+        self._names = ['']
+        self._name_ids = {'': 0}
+        self._slots = array('i', [_EMPTY]) * 8
+        self._used = 0
+        self._free = array('i')
+
+    def __len__(self):
+        '''Return the number of nodes, not counting the root.
+        '''
+        return len(self.parent) - 1 - len(self._free)
+
+    def add(self, parent, name):
+        '''Add a node named name under parent, returning its node number.
+
+        The parent must not already have a child with that name.
+        '''
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            name_id = self._name_ids[name] = len(self._names)
+            self._names.append(name)
+        if self._free:
+            node = self._free.pop()
+            self.parent[node] = parent
+            self.name[node] = name_id
+        else:
+            node = len(self.parent)
+            self.parent.append(parent)
+            self.name.append(name_id)
+        if (self._used + 1) * 2 > len(self._slots):
+            self._resize(len(self._slots) * 2)
+        self._slots[self._find_slot(parent, name_id)] = node
+        self._used += 1
+        return node
+
+    def remove(self, node):
+        '''Remove a node.  Its children must also be removed before any more
+        nodes are added.
+        '''
+        slots = self._slots
+        mask = len(slots) - 1
+        hole = self._find_slot(self.parent[node], self.name[node])
+        slots[hole] = _EMPTY
+        # Shift back any later entries of the probe sequence which can move
+        # into the hole, so that lookups never stop short of them.
+        index = (hole + 1) & mask
+        while slots[index] != _EMPTY:
+            other = slots[index]
+            home = hash((self.parent[other], self.name[other])) & mask
+            if (index - home) & mask >= (index - hole) & mask:
+                slots[hole] = other
+                slots[index] = _EMPTY
+                hole = index
+            index = (index + 1) & mask
+        self.parent[node] = -1
+        self._free.append(node)
+        self._used -= 1
+
+    def child(self, parent, name):
+        '''Return the node number of the child of parent named name, or None.
+        '''
+        name_id = self._name_ids.get(name)
+        if name_id is None:
+            return None
+        node = self._slots[self._find_slot(parent, name_id)]
+        if node == _EMPTY:
+            return None
+        return node
+
+    def lookup(self, path):
+        '''Return the node number of a relative path, or None if it's absent.
+        '''
+        node = ROOT
+        if not path:
+            return node
+        # This is child() and _find_slot() inlined, as it's the hot loop.
+        name_ids = self._name_ids
+        parents = self.parent
+        names = self.name
+        slots = self._slots
+        mask = len(slots) - 1
+        for name in path.split('/'):
+            name_id = name_ids.get(name)
+            if name_id is None:
+                return None
+            parent = node
+            index = hash((parent, name_id)) & mask
+            while True:
+                node = slots[index]
+                if node == _EMPTY:
+                    return None
+                if names[node] == name_id and parents[node] == parent:
+                    break
+                index = (index + 1) & mask
+        return node
+
+    def get_name(self, node):
+        '''Return the last component of the path of a node.
+        '''
+        return self._names[self.name[node]]
+
+    def get_path(self, node):
+        '''Return the path of a node.
+        '''
+        names = []
+        while node != ROOT:
+            names.append(self._names[self.name[node]])
+            node = self.parent[node]
+        names.reverse()
+        return '/'.join(names)
+
+    def _find_slot(self, parent, name_id):
+        '''Return the slot holding the edge (parent, name_id), or the empty
+        slot where it belongs.
+        '''
+        slots = self._slots
+        mask = len(slots) - 1
+        index = hash((parent, name_id)) & mask
+        while True:
+            node = slots[index]
+            if node == _EMPTY or (self.name[node] == name_id and
+                                  self.parent[node] == parent):
+                return index
+            index = (index + 1) & mask
+
+    def _resize(self, size):
+        self._slots = array('i', [_EMPTY]) * size
+        for node in xrange(1, len(self.parent)):
+            if self.parent[node] == -1:
+                continue
+            self._slots[self._find_slot(self.parent[node],
+                                        self.name[node])] = node
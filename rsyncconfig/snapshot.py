@@ -0,0 +1,177 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Snapshots of crawled trees, which let a Spider skip unchanged directories
+'''
+
+import os
+import errno
+import struct
+import hashlib
+import tempfile
+import cPickle
+
+from rsyncconfig.spider import EntryStat
+
+'Bumped whenever the format of saved snapshots changes.'
+SNAPSHOT_VERSION = 1
+
+def get_cache_dir():
+    '''Return the directory snapshots are saved in
+
+    This follows the XDG Base Directory Specification.
+    '''
+    base = os.environ.get('XDG_CACHE_HOME')
+    if not base:
+        base = os.path.join(os.path.expanduser('~'), '.cache')
+    return os.path.join(base, 'rsyncconfig', 'snapshots')
+
+def get_snapshot_path(root):
+    '''Return the file the snapshot of the tree at root is saved in
+    '''
+    digest = hashlib.sha1(os.path.abspath(root)).hexdigest()
+    return os.path.join(get_cache_dir(), digest + '.pickle')
+
+
+class Snapshot(object):
+    '''
+    The state of a tree as of the last complete crawl of it.
+
+    For each directory crawled, a snapshot records the directory's inode
+    number, mtime and ctime, along with the names and the mode, size and
+    mtime of its entries.  Adding, removing or renaming an entry changes the
+    mtime of the directory containing it, so a directory whose inode, mtime
+    and ctime are unchanged need not be listed again.  Changes to the
+    contents of a file don't touch its directory, so the sizes and mtimes of
+    files in such a directory are as of the snapshot.
+
+    The entries of each directory are packed into a few strings, which keeps
+    large snapshots small both in memory and on disk.  What a crawl records
+    is kept apart from what was loaded until save() is called, so that an
+    interrupted crawl doesn't leave a partial snapshot behind.
+    '''
+    def __init__(self, root, filename=None):
+        '''Create an empty snapshot of the tree at root.
+
+        The snapshot is saved to filename, which defaults to a file in the
+        user's cache directory named after the root.
+        '''
+        self.root = root
+        if filename is None:
+            filename = get_snapshot_path(root)
+        self.filename = filename
+        self._dirs = {}
+        self._recorded = {}
+
+    def __len__(self):
+        '''Return the number of directories in the loaded snapshot.
+        '''
+        return len(self._dirs)
+
+    def load(self):
+        '''Load the last saved snapshot of the root, if there is one.
+
+        A missing, unreadable or outdated snapshot is treated as empty.
+        '''
+        try:
+            with open(self.filename, 'rb') as f:
+                version, root, dirs = cPickle.load(f)
+        except Exception:
+            # Missing, unreadable, truncated or otherwise corrupt.
+            return
+        if version == SNAPSHOT_VERSION and root == self.root:
+            self._dirs = dirs
+
+    def save(self):
+        '''Replace the snapshot with what has been recorded since the last
+        save() and write it out.
+        '''
+        self._dirs = self._recorded
+        self._recorded = {}
+        dirname = os.path.dirname(self.filename)
+        try:
+            os.makedirs(dirname)
+        except EnvironmentError, e:
+            if e.errno != errno.EEXIST:
+                raise e
+        # Write to a temporary file and rename it into place, so that a
+        # reader never sees a partially written snapshot.
+        fd, temp = tempfile.mkstemp(dir=dirname)
+        try:
+            with os.fdopen(fd, 'wb') as f:
+                cPickle.dump((SNAPSHOT_VERSION, self.root, self._dirs), f,
+                             cPickle.HIGHEST_PROTOCOL)
+            os.rename(temp, self.filename)
+        except:
+            os.unlink(temp)
+            raise
+
+    def is_current(self, rel_dir, st):
+        '''Return whether the directory at rel_dir, with the given stat, is
+        unchanged since the snapshot.
+        '''
+        record = self._dirs.get(rel_dir)
+        return record is not None and record[:3] == (st.st_ino, st.st_mtime,
+                                                     st.st_ctime)
+
+    def get(self, rel_dir):
+        '''Return a dictionary mapping the names of the entries of the
+        directory at rel_dir to EntryStats, as of the snapshot, or None if
+        the directory isn't in it.
+        '''
+        record = self._dirs.get(rel_dir)
+        if record is None:
+            return None
+        return unpack_entries(record[3])
+
+    def keep(self, rel_dir):
+        '''Record the directory at rel_dir as it is in the snapshot.
+        '''
+        self._recorded[rel_dir] = self._dirs[rel_dir]
+
+    def record(self, rel_dir, st, entries):
+        '''Record the stat and entries of the directory at rel_dir, where
+        entries is a dictionary mapping names to stats.
+        '''
+        self._recorded[rel_dir] = (st.st_ino, st.st_mtime, st.st_ctime,
+                                   pack_entries(entries))
+
+
+def pack_entries(entries):
+    '''Pack a dictionary mapping names to stats into a tuple of strings.
+    '''
+    names = list(entries)
+    count = len(names)
+    stats = [entries[name] for name in names]
+    return ('\0'.join(names),
+            struct.pack('={0}I'.format(count), *[st.st_mode for st in stats]),
+            struct.pack('={0}Q'.format(count), *[st.st_size for st in stats]),
+            struct.pack('={0}d'.format(count),
+                        *[st.st_mtime for st in stats]))
+
+def unpack_entries(packed):
+    '''Reverse pack_entries().
+    '''
+    names, modes, sizes, mtimes = packed
+    if not names and not modes:
+        return {}
+    names = names.split('\0')
+    count = len(names)
+    modes = struct.unpack('={0}I'.format(count), modes)
+    sizes = struct.unpack('={0}Q'.format(count), sizes)
+    mtimes = struct.unpack('={0}d'.format(count), mtimes)
+    return dict((names[i], EntryStat(modes[i], sizes[i], mtimes[i]))
+                for i in xrange(count))
@@ -14,40 +14,284 @@
 # along with this program.  If not, see <http://www.gnu.org/licenses/>.
 
 import os
+import sys
 import errno
 import stat
+import Queue
+import struct
 import threading
+import multiprocessing
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+class LazyStat(object):
+    '''A stand-in for the lstat() result of a directory entry.
+
+    The file type bits of st_mode are taken from the directory entry itself,
+    which on most filesystems doesn't require a system call.  The first access
+    to any other attribute calls lstat() on the entry.  Note that st_mode only
+    has the file type bits, not the permission bits.
+    '''
+    __slots__ = ('_entry', 'st_mode')
+
+    def __init__(self, entry):
+        self._entry = entry
+        if entry.is_dir(follow_symlinks=False):
+            self.st_mode = stat.S_IFDIR
+        elif entry.is_symlink():
+            self.st_mode = stat.S_IFLNK
+        elif entry.is_file(follow_symlinks=False):
+            self.st_mode = stat.S_IFREG
+        else:
+            # Devices, sockets and FIFOs
+            self.st_mode = entry.stat(follow_symlinks=False).st_mode
+
+    def __getattr__(self, name):
+        return getattr(self._entry.stat(follow_symlinks=False), name)
+
+
+class EntryStat(object):
+    '''The parts of a stat result that survive being sent between processes.
+
+    included records whether the entry is included by the spider's filters.
+    '''
+    __slots__ = ('st_mode', 'st_size', 'st_mtime', 'included')
+
+    def __init__(self, st_mode, st_size, st_mtime, included=True):
+        self.st_mode = st_mode
+        self.st_size = st_size
+        self.st_mtime = st_mtime
+        self.included = included
+
+    def __eq__(self, other):
+        return (isinstance(other, EntryStat) and
+                all(getattr(self, name) == getattr(other, name)
+                    for name in self.__slots__))
+
+    def __ne__(self, other):
+        return not self == other
+
+    def __repr__(self):
+        return '{0}({1!r}, {2!r}, {3!r}, {4!r})'.format(
+            self.__class__.__name__, self.st_mode, self.st_size, self.st_mtime,
+            self.included)
 
 
 class Spider(object):
-    def __init__(self, fstree, path):
+    def __init__(self, fstree, path, filters=None, lazy_stat=False,
+                 snapshot=None, start=True):
         '''Create a new Spider object.
 
         A newly-created Spider spawns a worker thread and begins traversing the
-        given path.
+        given path.  If start is false, no thread is started, and crawl()
+        traverses the path in the calling thread instead.
+
+        If a FilterRuleset is given as filters, directories it excludes are
+        added to the fstree but not descended into, as rsync never looks
+        inside an excluded directory.  A ruleset with dir-merge rules should
+        be given as filters.for_tree(path), so that the per-directory files
+        are read as the tree is crawled.
+
+        If lazy_stat is true and scandir is available, the fstree is passed
+        LazyStat objects, so entries are only stat()ed if something other than
+        their type is looked at.
+
+        A directory which can't be listed, as it is unreadable or has been
+        removed, is passed to _skip_dir() and the crawl carries on with the
+        rest of the tree.
+
+        If a Snapshot of the path is given, only the directories which have
+        changed since it was taken are listed; the entries of the others are
+        added to the fstree as the snapshot recorded them.  The snapshot is
+        saved once the crawl is complete.
         '''
         self.fstree = fstree
         self.path = path
+        self.filters = filters
+        self.lazy_stat = lazy_stat
+        self.snapshot = snapshot
         self.running = True
+        # Held while calling the fstree, so that stop() can wait for any call
+        # in progress
+        self._lock = threading.Lock()
 
-        self.thread = threading.Thread(name=repr(self), target=self.run)
-        self.thread.daemon = True
-        self.thread.start()
+        self.thread = None
+        if start:
+            self.thread = threading.Thread(name=repr(self), target=self.run)
+            self.thread.daemon = True
+            self.thread.start()
 
     def __repr__(self):
         return '{0}({1!r}, {2!r})'.format(self.__class__.__name__,
                                           self.fstree, self.path)
 
     def run(self):
-        self._process_dir(self.path)
+        if self.snapshot is None:
+            self._process_dir(self.path, '')
+        else:
+            self._rescan()
+
+    def crawl(self):
+        '''Traverse the path in the calling thread, returning once done, for
+        a Spider created with start=False.
+        '''
+        self.run()
+
+    def _process_dir(self, dir_path, rel_dir):
+        '''Add the contents of dir_path to the fstree, recursively.
+
+        rel_dir is the path of the directory relative to the root, which is
+        what the filters are matched against.
+        '''
+        try:
+            for path, rel_path, st in self._scan_dir(dir_path, rel_dir):
+                self._descend(path, rel_path, st)
+        except EnvironmentError, e:
+            self._skip_dir(dir_path, e)
+
+    def _descend(self, path, rel_path, st):
+        '''Crawl a subdirectory found by _process_dir().
+        '''
+        self._process_dir(path, rel_path)
+
+    def _skip_dir(self, dir_path, e):
+        '''Called with the EnvironmentError raised while crawling a directory
+        which can't be read, or has been removed.  The directory is skipped;
+        raise e to end the crawl instead.
+        '''
+        pass
+
+    def _scan_dir(self, dir_path, rel_dir, entries=None):
+        '''Add the entries of dir_path to the fstree.
 
-    def _process_dir(self, dir_path):
-        for path, st in self._dir_iter(dir_path):
+        Yields a (path, rel_path, stat) tuple for each subdirectory which should
+        be descended into, after it has been added.  The entries are listed
+        from the filesystem unless given as (name, path, stat) tuples.
+        '''
+        if entries is None:
+            entries = self._dir_iter(dir_path)
+        for name, path, st in entries:
+            if not self.running:
+                return
+            rel_path = rel_dir + '/' + name if rel_dir else name
             if stat.S_ISDIR(st.st_mode):
-                self._process_dir(path)
-            self.fstree.add_path(path, st)
+                if self.filters is None or self.filters.apply(rel_path, st):
+                    self._add_path(path, rel_path, st)
+                    yield path, rel_path, st
+                else:
+                    self._add_path(path, rel_path, st, False)
+            else:
+                self._add_path(path, rel_path, st)
+
+    def _add_path(self, path, rel_path, st, scanning=True):
+        with self._lock:
+            if not self.running:
+                return
+            if scanning:
+                self.fstree.add_path(path, st)
+            else:
+                self.fstree.add_path(path, st, False)
+
+    def _rescan(self):
+        self.snapshot.load()
+        self._rescan_dir(self.path, '', os.lstat(self.path))
+        if self.running:
+            self.snapshot.save()
+
+    def _rescan_dir(self, dir_path, rel_dir, dir_st):
+        '''Add the contents of dir_path to the fstree, recursively, listing
+        only the directories which have changed since the snapshot.
+        '''
+        try:
+            if self.snapshot.is_current(rel_dir, dir_st):
+                subdirs = self._add_recorded(dir_path, rel_dir)
+            else:
+                subdirs = self._scan_dir(dir_path, rel_dir,
+                                         self._recording_iter(dir_path,
+                                                              rel_dir,
+                                                              dir_st))
+            for path, rel_path, st in subdirs:
+                self._rescan_dir(path, rel_path, st)
+        except EnvironmentError, e:
+            self._skip_dir(dir_path, e)
+
+    def _add_recorded(self, dir_path, rel_dir):
+        '''Add the entries of dir_path recorded in the snapshot, which is
+        unchanged, to the fstree, and record it again.
+
+        The files are added together, as they need neither listing nor
+        filtering.  Returns an iterator over the subdirectories to descend
+        into, like _scan_dir(), which lstat()s them again, as the entries of
+        a directory can change without touching its parent.
+        '''
+        self.snapshot.keep(rel_dir)
+        prefix = os.path.join(dir_path, '')
+        names = []
+        with self._lock:
+            if not self.running:
+                return iter(())
+            add_path = self.fstree.add_path
+            for name, st in self.snapshot.get(rel_dir).iteritems():
+                if stat.S_ISDIR(st.st_mode):
+                    names.append(name)
+                else:
+                    add_path(prefix + name, st)
+        return self._scan_dir(dir_path, rel_dir,
+                              self._lstat_iter(prefix, names))
+
+    def _lstat_iter(self, prefix, names):
+        '''Yield a (name, path, stat) tuple for each of the names in the
+        directory at prefix which is still there.
+        '''
+        for name in names:
+            path = prefix + name
+            try:
+                st = os.lstat(path)
+            except EnvironmentError, e:
+                if e.errno == errno.ENOENT:
+                    continue
+                raise e
+            yield name, path, st
+
+    def _recording_iter(self, dir_path, rel_dir, dir_st):
+        '''Yield a (name, path, stat) tuple for each entry in dir_path,
+        recording them all in the snapshot once the directory is listed.
+        '''
+        entries = {}
+        for name, path, st in self._dir_iter(dir_path):
+            entries[name] = st
+            yield name, path, st
+        self.snapshot.record(rel_dir, dir_st, entries)
 
     def _dir_iter(self, dir_path):
+        '''Yield a (name, path, stat) tuple for each entry in dir_path.
+        '''
+        if scandir is None:
+            return self._listdir_iter(dir_path)
+        return self._scandir_iter(dir_path)
+
+    def _scandir_iter(self, dir_path):
+        for entry in scandir(dir_path):
+            if self.lazy_stat:
+                st = LazyStat(entry)
+            else:
+                try:
+                    st = entry.stat(follow_symlinks=False)
+                except EnvironmentError, e:
+                    if e.errno == errno.ENOENT:
+                        # Removed from the directory since it was listed.
+                        continue
+                    raise e
+            yield entry.name, entry.path, st
+
+    def _listdir_iter(self, dir_path):
         for name in os.listdir(dir_path):
             path = os.path.join(dir_path, name)
             try:
@@ -58,9 +302,265 @@ class Spider(object):
                     # since it was listed.
                     continue
                 raise e
-            yield path, stat
+            yield name, path, stat
 
     def stop(self):
         '''Terminate the data collection process
+
+        The crawl stops at the next directory entry.  Once this returns, the
+        fstree will not be called again, but the thread may still be finishing
+        a system call; use join() to wait for it.  If the fstree can block,
+        as a QueuedFSTree does when full, it must be unblocked first.
+        '''
+        with self._lock:
+            self.running = False
+
+    def join(self, timeout=None):
+        '''Wait up to timeout seconds (or forever, if None) for the crawl to
+        finish or, after stop(), to wind down.
+
+        Returns True if it has.
+        '''
+        if self.thread is None:
+            return True
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+
+class ParallelSpider(Spider):
+    '''A Spider which lists directories from several worker threads at once.
+
+    Directories are pulled from a shared queue, so that slow directories (on
+    a network filesystem, for example) don't hold up the rest of the crawl.
+    The fstree sees the same sequence of calls as with a Spider, other than
+    ordering: a directory is always added before its contents, but the
+    contents of different directories are interleaved.  Calls to the fstree
+    are serialized by the same lock as stop() takes, so it need not be
+    thread-safe.  An error in a worker other than a directory which can't be
+    read stops the crawl, and is raised again from run() once the workers
+    are done.
+    '''
+    def __init__(self, fstree, path, filters=None, lazy_stat=False,
+                 workers=4, start=True):
+        self.workers = workers
+        self._queue = Queue.Queue()
+        self._seen = set()
+        self._seen_lock = threading.Lock()
+        # The sys.exc_info() of the first error which ended a worker's crawl
+        self._error = None
+        Spider.__init__(self, fstree, path, filters, lazy_stat, start=start)
+
+    def run(self):
+        root = os.lstat(self.path)
+        self._seen.add((root.st_dev, root.st_ino))
+        self._queue.put((self.path, ''))
+        threads = []
+        for i in range(self.workers):
+            thread = threading.Thread(name='{0!r} worker {1}'.format(self, i),
+                                      target=self._work)
+            thread.daemon = True
+            thread.start()
+            threads.append(thread)
+        # Subdirectories are queued before the directory containing them is
+        # marked done, so this only returns once the whole tree is done.
+        self._queue.join()
+        for thread in threads:
+            self._queue.put(None)
+        for thread in threads:
+            thread.join()
+        if self._error is not None:
+            raise self._error[0], self._error[1], self._error[2]
+
+    def _work(self):
+        while True:
+            item = self._queue.get()
+            try:
+                if item is None:
+                    return
+                if self.running:
+                    self._process_dir(*item)
+            except Exception:
+                # Such as a bad pattern in a per-directory filter file.  The
+                # other workers stop, and the rest of the queue is drained
+                # without being crawled, so that run() returns.
+                with self._lock:
+                    if self._error is None:
+                        self._error = sys.exc_info()
+                    self.running = False
+            finally:
+                self._queue.task_done()
+
+    def _descend(self, path, rel_path, st):
+        if self._first_visit(st):
+            self._queue.put((path, rel_path))
+
+    def _first_visit(self, st):
+        '''Record that the directory with the given stat is being visited.
+
+        Returns False if it has already been seen, as happens with bind mounts.
         '''
-        self.running = False
+        key = (st.st_dev, st.st_ino)
+        with self._seen_lock:
+            if key in self._seen:
+                return False
+            self._seen.add(key)
+            return True
+
+
+class ProcessSpider(Spider):
+    '''A Spider which crawls in several worker processes at once.
+
+    The parent lists the root directory itself, then hands each top-level
+    subdirectory to a pool of worker processes.  Each worker crawls its
+    subdirectory and evaluates the filters locally, sending entries back in
+    batches.  A batch is a handful of strings -- the NUL-separated paths and
+    packed arrays of mode, size, mtime and whether the entry is included --
+    so the parent doesn't have to unpickle an object per entry.
+
+    The fstree is passed EntryStat objects, whose included attribute carries
+    the result of evaluating the filters.  A directory which can't be read
+    is skipped, but any other error in a worker ends the crawl once the
+    other shards are done, and is raised again from run().
+    '''
+    def __init__(self, fstree, path, filters=None, processes=None,
+                 batch_size=1000, start=True):
+        self.processes = processes or multiprocessing.cpu_count()
+        self.batch_size = batch_size
+        Spider.__init__(self, fstree, path, filters, start=start)
+
+    def run(self):
+        shards = list(self._scan_dir(self.path, ''))
+        if not shards or not self.running:
+            return
+        queue = multiprocessing.Queue()
+        pool = multiprocessing.Pool(self.processes, _init_shard_worker,
+                                    (queue, self.filters, self.batch_size))
+        try:
+            result = pool.map_async(_crawl_shard,
+                                    [(path, rel_path)
+                                     for path, rel_path, _ in shards])
+            remaining = len(shards)
+            while remaining and self.running:
+                try:
+                    batch = queue.get(timeout=0.1)
+                except Queue.Empty:
+                    continue
+                if batch is None:
+                    remaining -= 1
+                else:
+                    self._add_batch(batch)
+            if self.running:
+                # Re-raise any error which ended a shard early, such as a bad
+                # pattern in a per-directory filter file, rather than leave
+                # the rest of its entries silently missing.
+                result.get()
+        finally:
+            pool.terminate()
+
+    def _add_batch(self, batch):
+        paths, modes, sizes, mtimes, included = unpack_batch(batch)
+        for i, path in enumerate(paths):
+            if not self.running:
+                return
+            st = EntryStat(modes[i], sizes[i], mtimes[i], included[i])
+            scanning = st.included or not stat.S_ISDIR(st.st_mode)
+            Spider._add_path(self, path, None, st, scanning)
+
+    def _add_path(self, path, rel_path, st, scanning=True):
+        included = _is_included(self.filters, rel_path, st, scanning)
+        st = EntryStat(st.st_mode, st.st_size, st.st_mtime, included)
+        Spider._add_path(self, path, rel_path, st, scanning)
+
+
+def _is_included(filters, rel_path, st, scanning):
+    '''Whether an entry reported by Spider._scan_dir is included.
+
+    Directories are only descended into (scanning) if they are included.
+    '''
+    if stat.S_ISDIR(st.st_mode):
+        return scanning
+    return filters is None or filters.apply(rel_path, st)
+
+def pack_batch(paths, modes, sizes, mtimes, included):
+    '''Pack parallel lists describing a batch of entries into strings.
+    '''
+    count = len(paths)
+    return ('\0'.join(paths),
+            struct.pack('={0}I'.format(count), *modes),
+            struct.pack('={0}Q'.format(count), *sizes),
+            struct.pack('={0}d'.format(count), *mtimes),
+            struct.pack('={0}?'.format(count), *included))
+
+def unpack_batch(batch):
+    '''Reverse pack_batch(), returning a tuple of parallel sequences.
+    '''
+    paths, modes, sizes, mtimes, included = batch
+    paths = paths.split('\0')
+    count = len(paths)
+    return (paths,
+            struct.unpack('={0}I'.format(count), modes),
+            struct.unpack('={0}Q'.format(count), sizes),
+            struct.unpack('={0}d'.format(count), mtimes),
+            struct.unpack('={0}?'.format(count), included))
+
+
+class _BatchWriter(object):
+    '''An fstree which packs what is added to it into batches for a queue
+    '''
+    def __init__(self, queue, batch_size):
+        self.queue = queue
+        self.batch_size = batch_size
+        self._clear()
+
+    def _clear(self):
+        self.paths = []
+        self.modes = []
+        self.sizes = []
+        self.mtimes = []
+        self.included = []
+
+    def add_path(self, path, st, included=True):
+        self.paths.append(path)
+        self.modes.append(st.st_mode)
+        self.sizes.append(st.st_size)
+        self.mtimes.append(st.st_mtime)
+        self.included.append(included)
+        if len(self.paths) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.paths:
+            self.queue.put(pack_batch(self.paths, self.modes, self.sizes,
+                                      self.mtimes, self.included))
+            self._clear()
+
+
+class _ShardWalker(Spider):
+    '''Crawls one top-level subdirectory for a ProcessSpider, in the calling
+    thread.
+    '''
+    def __init__(self, writer, path, filters):
+        Spider.__init__(self, writer, path, filters, start=False)
+
+    def _add_path(self, path, rel_path, st, scanning=True):
+        self.fstree.add_path(path, st, _is_included(self.filters, rel_path, st,
+                                                    scanning))
+
+_shard_worker = None
+
+def _init_shard_worker(queue, filters, batch_size):
+    global _shard_worker
+    _shard_worker = (queue, filters, batch_size)
+
+def _crawl_shard(args):
+    '''Crawl one shard in a ProcessSpider worker process.
+    '''
+    path, rel_path = args
+    queue, filters, batch_size = _shard_worker
+    writer = _BatchWriter(queue, batch_size)
+    try:
+        _ShardWalker(writer, path, filters)._process_dir(path, rel_path)
+        writer.flush()
+    finally:
+        # Tell the parent that this shard is done.
+        queue.put(None)
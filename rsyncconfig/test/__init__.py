@@ -4,7 +4,13 @@ import doctest
 from . import filter
 from . import filterruleset
 from . import spider
+from . import pathtable
+from . import snapshot
+from . import watch
+from . import cli
+from . import headless
 from . import fstree
+from . import treemodel
 from . import gui
 
 loader = unittest.TestLoader()
@@ -14,7 +20,13 @@ def get_suite():
         filter.get_suite(),
         filterruleset.get_suite(),
         spider.get_suite(),
+        pathtable.get_suite(),
+        snapshot.get_suite(),
+        watch.get_suite(),
+        cli.get_suite(),
+        headless.get_suite(),
         fstree.get_suite(),
+        treemodel.get_suite(),
         gui.get_suite(),
         doctest.DocTestSuite('rsyncconfig.filter')
     ])
@@ -0,0 +1,160 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the rsyncconfig.cli module
+'''
+
+import os
+import errno
+import shutil
+import tempfile
+import unittest
+from StringIO import StringIO
+
+from rsyncconfig import cli
+
+
+class TestMain(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for d in ['a', 'a/b', 'c']:
+            os.mkdir(os.path.join(self.root, d))
+        for f in ['a/f.o', 'a/g', 'a/b/h', 'c/i.o', 'j']:
+            open(os.path.join(self.root, f), 'w').close()
+        self.filters = self.write_filters('new', '- *.o\n- b/\n')
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write_filters(self, name, text):
+        filename = os.path.join(self.root, name)
+        with open(filename, 'w') as f:
+            f.write(text)
+        return filename
+
+    def run_main(self, *args, **kwargs):
+        '''Run the command line on the tree, returning the exit status and
+        the sorted lines written to stdout.
+        '''
+        stdout = StringIO()
+        self.stderr = StringIO()
+        status = cli.main(list(args), stdin=StringIO(kwargs.get('stdin', '')),
+                          stdout=stdout, stderr=self.stderr)
+        separator = kwargs.get('separator', '\n')
+        return status, sorted(stdout.getvalue().split(separator)[:-1])
+
+    def test_included(self):
+        self.assertEqual((0, ['a', 'a/g', 'c', 'j', 'new']),
+                         self.run_main(self.root, self.filters))
+
+    def test_excluded(self):
+        '''Check that paths beneath an excluded directory aren't listed.
+        '''
+        self.assertEqual((0, ['a/b', 'a/f.o', 'c/i.o']),
+                         self.run_main('--excluded', self.root, self.filters))
+
+    def test_null(self):
+        self.assertEqual((0, ['a', 'a/g', 'c', 'j', 'new']),
+                         self.run_main('-0', self.root, self.filters,
+                                       separator='\0'))
+
+    def test_stdin(self):
+        self.assertEqual((0, ['a', 'a/b', 'a/b/h', 'a/f.o', 'a/g', 'j',
+                              'new']),
+                         self.run_main(self.root, '-', stdin='- /c/\n'))
+
+    def test_diff(self):
+        old = self.write_filters('old', '- /a/\n- new\n')
+        self.assertEqual((0, ['+ a', '+ a/g', '+ new', '- c/i.o']),
+                         self.run_main('--diff', old, self.root, self.filters))
+
+    def test_duplicates(self):
+        filters = self.write_filters('dup', '- *.o\n+ *.o\n- *.o\n- b/\n')
+        self.assertEqual((0, ['a', 'a/g', 'c', 'dup', 'j', 'new']),
+                         self.run_main('-v', self.root, filters))
+        self.assertTrue('2 rules, 1 duplicates and 1 shadowed' in
+                        self.stderr.getvalue())
+
+    def test_dir_merge(self):
+        self.write_filters('a/.rsync-filter', '- /g\n')
+        filters = self.write_filters('merge', ':e .rsync-filter\n- b/\n')
+        self.assertEqual((0, ['a', 'a/f.o', 'c', 'c/i.o', 'j', 'merge',
+                              'new']),
+                         self.run_main(self.root, filters))
+
+    def test_missing_filter_file(self):
+        status, lines = self.run_main(self.root,
+                                      os.path.join(self.root, 'missing'))
+        self.assertEqual((1, []), (status, lines))
+        self.assertTrue('missing' in self.stderr.getvalue())
+
+    def test_invalid_pattern(self):
+        filters = self.write_filters('bad', '- *.o\n- [\n')
+        status, lines = self.run_main(self.root, filters)
+        self.assertEqual((1, []), (status, lines))
+        self.assertTrue(self.stderr.getvalue().startswith(
+            '{0}: {1}: '.format(cli.get_parser().get_prog_name(), filters)))
+
+    def test_invalid_dir_merge_pattern(self):
+        '''Check that a bad pattern in a per-directory file found during
+        the crawl is reported with the name of the file.
+        '''
+        bad = self.write_filters('a/.rsync-filter', '- [\n')
+        filters = self.write_filters('merge', ': .rsync-filter\n')
+        status, _ = self.run_main(self.root, filters)
+        self.assertEqual(1, status)
+        self.assertTrue(bad in self.stderr.getvalue())
+
+    def test_missing_root(self):
+        status, _ = self.run_main(os.path.join(self.root, 'missing'),
+                                  self.filters)
+        self.assertEqual(1, status)
+
+    def test_unreadable_dir(self):
+        '''Check that the rest of the tree is listed if a directory can't be
+        read.
+        '''
+        unreadable = os.path.join(self.root, 'a', 'b')
+        os.chmod(unreadable, 0)
+        try:
+            if os.access(unreadable, os.R_OK):
+                # Running as root
+                return
+            status, lines = self.run_main(self.root, '/dev/null')
+        finally:
+            os.chmod(unreadable, 0o755)
+        self.assertEqual(cli.EXIT_PARTIAL, status)
+        self.assertEqual(['a', 'a/b', 'a/f.o', 'a/g', 'c', 'c/i.o', 'j',
+                          'new'], lines)
+        self.assertTrue(unreadable in self.stderr.getvalue())
+
+    def test_broken_pipe(self):
+        class ClosedPipe(object):
+            def write(self, data):
+                raise IOError(errno.EPIPE, os.strerror(errno.EPIPE))
+            flush = write
+        self.assertEqual(0, cli.main([self.root, self.filters],
+                                     stdout=ClosedPipe()))
+
+    def test_usage(self):
+        self.assertRaises(SystemExit, cli.main, [self.root])
+
+
+def get_suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestMain),
+    ])
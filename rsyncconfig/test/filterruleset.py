@@ -20,10 +20,19 @@ Tests for the rsyncconfig.filterruleset module
 '''
 
 import os
+import time
+import errno
+import pickle
+import shutil
+import tempfile
 import unittest
+import threading
+from StringIO import StringIO
 from stat import *
 
-from rsyncconfig.filter import FilterRuleset
+import regex
+
+from rsyncconfig.filter import FilterRuleset, FilterStack, merge_cache
 
 FILE_STAT = os.stat(__file__)
 assert S_ISREG(FILE_STAT.st_mode)
@@ -45,6 +54,10 @@ class TestFilterRuleset(unittest.TestCase):
         self.assertTrue(frs.apply('test/test2', FILE_STAT));
         self.assertTrue(frs.apply('test/test2', DIR_STAT));
 
+    def test_unparsable_comment(self):
+        frs = FilterRuleset(";exclude [unterminated\ninclude test2");
+        self.assertTrue(frs.apply('test2', FILE_STAT));
+
     def test_one_include_filter(self):
         frs = FilterRuleset("include test");
         self.assertTrue(frs.apply('test', FILE_STAT));
@@ -124,5 +137,426 @@ class TestFilterRuleset(unittest.TestCase):
         self.assertTrue(frs.apply('test2/test3', FILE_STAT));
         self.assertTrue(frs.apply('test2/test3', DIR_STAT));
 
+    def test_match_index(self):
+        frs = FilterRuleset("- *.o\n; comment\n+ foo/\n- foo\n+ *");
+        self.assertEqual(0, frs.match_index('foo/bar.o', FILE_STAT));
+        self.assertEqual(2, frs.match_index('foo', DIR_STAT));
+        self.assertEqual(3, frs.match_index('foo', FILE_STAT));
+        self.assertEqual(4, frs.match_index('bar', FILE_STAT));
+        self.assertEqual(None, FilterRuleset("").match_index('bar', DIR_STAT));
+
+    def test_first_match_wins(self):
+        frs = FilterRuleset("+ /a/b\n- b\n+ a/***\n- *");
+        self.assertTrue(frs.apply('a/b', FILE_STAT));
+        self.assertFalse(frs.apply('c/b', FILE_STAT));
+        self.assertTrue(frs.apply('x/a/c', FILE_STAT));
+        self.assertFalse(frs.apply('x/c', FILE_STAT));
+
+    def test_literal_rule_order(self):
+        frs = FilterRuleset("+ /keep/a.o\n- *.o\n+ a.o\n- /keep/b\n+ *\n- b");
+        self.assertTrue(frs.apply('keep/a.o', FILE_STAT));
+        self.assertFalse(frs.apply('x/a.o', FILE_STAT));
+        self.assertFalse(frs.apply('keep/b', FILE_STAT));
+        self.assertTrue(frs.apply('x/b', FILE_STAT));
+        self.assertEqual(4, frs.match_index('x/b', DIR_STAT));
+
+    def test_literal_rules_mixed_with_wildcards(self):
+        frs = FilterRuleset("- foo/***\n+ *.c\n- [a-c]*.c\n- .git/\n- /x");
+        self.assertFalse(frs.apply('bar/foo/baz.c', FILE_STAT));
+        self.assertTrue(frs.apply('bar/abc.c', FILE_STAT));
+        self.assertTrue(frs.apply('src/.git', FILE_STAT));
+        self.assertFalse(frs.apply('src/.git', DIR_STAT));
+        self.assertFalse(frs.apply('x', FILE_STAT));
+        self.assertTrue(frs.apply('y/x', FILE_STAT));
+
+    def test_newline_in_path(self):
+        '''Check that a path containing a newline is decided as trying each
+        rule in turn would
+        '''
+        frs = FilterRuleset("- /foo\n- *.o");
+        for path in ['foo\nbar', 'bar\nfoo', 'a.o\nb', 'b']:
+            expected = None
+            for index, rule in enumerate(frs.rules):
+                if rule.match(path, FILE_STAT):
+                    expected = index
+                    break
+            self.assertEqual(expected, frs.match_index(path, FILE_STAT))
+
+    def test_apply_many(self):
+        frs = FilterRuleset("- *.o\n+ foo/\n- foo\n; comment\n+ /a/***\n- *");
+        paths = ['x.o', 'foo', 'foo', 'a', 'a/b', 'b', 'a/b.o']
+        stats = [FILE_STAT, DIR_STAT, FILE_STAT, DIR_STAT, FILE_STAT,
+                 FILE_STAT, FILE_STAT]
+        expected = [frs.apply(path, stat) for path, stat in zip(paths, stats)]
+        self.assertEqual([False, True, False, True, True, False, False],
+                         expected)
+        self.assertEqual(expected, list(frs.apply_many(paths, stats)))
+
+    def test_apply_many_empty(self):
+        self.assertEqual([], list(FilterRuleset("- *").apply_many([], [])))
+        self.assertEqual([True, True], list(FilterRuleset("").apply_many(
+            ['a', 'b'], [FILE_STAT, DIR_STAT])))
+
+    def test_apply_many_newline(self):
+        frs = FilterRuleset("- /foo\n- *.o");
+        paths = ['foo\nbar', 'bar\nfoo', 'a.o\nb', 'b']
+        stats = [FILE_STAT] * len(paths)
+        self.assertEqual([frs.apply(path, FILE_STAT) for path in paths],
+                         list(frs.apply_many(paths, stats)))
+
+    def test_apply_many_order(self):
+        '''Check that the first matching rule decides, whether it is looked
+        up in a table or searched for in the joined paths
+        '''
+        frs = FilterRuleset("+ /a/b*\n- *.c\n+ b?.c\n- /a/**\n+ *")
+        paths = ['a/bx.c', 'a/x.c', 'bx.c', 'a/x', 'x', 'a/b/c']
+        stats = [FILE_STAT] * len(paths)
+        self.assertEqual([True, False, False, False, True, False],
+                         list(frs.apply_many(paths, stats)))
+
+    def test_apply_many_across_lines(self):
+        '''Check that a character class which matches a newline doesn't let
+        a rule match across the joined paths
+        '''
+        frs = FilterRuleset("- x[^a]y\n- z[^a]*w")
+        paths = ['ax', 'y', 'x', 'yz', 'w', 'xby', 'zbw', 'a']
+        stats = [FILE_STAT] * len(paths)
+        self.assertEqual([True, True, True, True, True, False, False, True],
+                         list(frs.apply_many(paths, stats)))
+
+class TestRulesetDiff(unittest.TestCase):
+    def diff(self, old, new):
+        diff = FilterRuleset(new).diff(FilterRuleset(old))
+        return diff.inserted, diff.removed, diff.modified, diff.first_changed
+
+    def test_unchanged(self):
+        diff = FilterRuleset('- a\n+ b').diff(FilterRuleset('- a\n+ b'))
+        self.assertFalse(diff)
+        self.assertEqual(None, diff.first_changed)
+
+    def test_inserted(self):
+        self.assertEqual(([1], [], [], 1),
+                         self.diff('- a\n+ b', '- a\n- c\n+ b'))
+
+    def test_removed(self):
+        self.assertEqual(([], [0], [], 0),
+                         self.diff('- a\n- c\n+ b', '- c\n+ b'))
+
+    def test_modified(self):
+        self.assertEqual(([], [], [(2, 2)], 2),
+                         self.diff('- a\n- b\n- c\n- d',
+                                   '- a\n- b\n- x\n- d'))
+
+    def test_replaced(self):
+        '''Check that rules replaced by more rules count as modified, then
+        inserted.
+        '''
+        self.assertEqual(([2], [], [(1, 1)], 1),
+                         self.diff('- a\n- b\n- d', '- a\n- x\n- y\n- d'))
+
+    def test_moved(self):
+        self.assertEqual(([2], [0], [], 0),
+                         self.diff('- a\n- b\n- c', '- b\n- c\n- a'))
+
+    def test_empty(self):
+        self.assertEqual(([0, 1], [], [], 0), self.diff('', '- a\n- b'))
+
+
+class TestDecisionCache(unittest.TestCase):
+    def test_uncached_by_default(self):
+        frs = FilterRuleset('- *.o')
+        frs.apply('a.o', FILE_STAT)
+        frs.apply('a.o', FILE_STAT)
+        self.assertEqual((0, 0), (frs.cache_hits, frs.cache_misses))
+
+    def test_hits(self):
+        frs = FilterRuleset('- *.o\n- foo/', cache_size=10)
+        self.assertFalse(frs.apply('a.o', FILE_STAT))
+        self.assertTrue(frs.apply('foo', FILE_STAT))
+        self.assertFalse(frs.apply('foo', DIR_STAT))
+        self.assertEqual((0, 3), (frs.cache_hits, frs.cache_misses))
+        self.assertFalse(frs.apply('a.o', FILE_STAT))
+        self.assertTrue(frs.apply('foo', FILE_STAT))
+        self.assertFalse(frs.apply('foo', DIR_STAT))
+        self.assertEqual((3, 3), (frs.cache_hits, frs.cache_misses))
+
+    def test_lru_eviction(self):
+        '''Check that the least recently used decision is the one evicted
+        '''
+        frs = FilterRuleset('- *.o', cache_size=2)
+        frs.match_type_index('a', False)
+        frs.match_type_index('b', False)
+        frs.match_type_index('a', False)
+        frs.match_type_index('c', False)
+        self.assertEqual((1, 3), (frs.cache_hits, frs.cache_misses))
+        frs.match_type_index('a', False)
+        self.assertEqual((2, 3), (frs.cache_hits, frs.cache_misses))
+        frs.match_type_index('b', False)
+        self.assertEqual((2, 4), (frs.cache_hits, frs.cache_misses))
+
+    def test_clear(self):
+        frs = FilterRuleset('- *.o', cache_size=2)
+        frs.match_type_index('a', False)
+        frs.clear_cache()
+        frs.match_type_index('a', False)
+        self.assertEqual((0, 1), (frs.cache_hits, frs.cache_misses))
+
+    def test_inherit(self):
+        '''Check that only decisions made before the first changed rule are
+        carried over to a new version of the ruleset.
+        '''
+        old = FilterRuleset('- *.o\n- *.a\n+ *.c', cache_size=10)
+        for path in ['x.o', 'x.a', 'x.c', 'x.h']:
+            old.match_type_index(path, False)
+        new = FilterRuleset('- *.o\n- *.c', cache_size=10)
+        new.inherit_cache(old)
+        self.assertEqual(0, new.match_type_index('x.o', False))
+        self.assertEqual(None, new.match_type_index('x.a', False))
+        self.assertEqual(1, new.match_type_index('x.c', False))
+        self.assertEqual(None, new.match_type_index('x.h', False))
+        self.assertEqual((1, 3), (new.cache_hits, new.cache_misses))
+
+    def test_threads(self):
+        '''Check that the cache stays consistent when shared by threads.
+        '''
+        frs = FilterRuleset('- *.o\n+ a*\n- *', cache_size=8)
+        paths = ['a{0}.o'.format(i % 20) for i in range(50)] + \
+                ['a{0}'.format(i % 20) for i in range(50)]
+        errors = []
+        def work():
+            try:
+                for _ in range(20):
+                    for path in paths:
+                        self.assertEqual(not path.endswith('.o'),
+                                         frs.apply(path, FILE_STAT))
+            except Exception, e:
+                errors.append(e)
+        threads = [threading.Thread(target=work) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual([], errors)
+        self.assertEqual(4 * 20 * len(paths),
+                         frs.cache_hits + frs.cache_misses)
+        self.assertTrue(len(frs._cache) <= 8)
+
+    def test_pickle(self):
+        '''Check that the cache size survives pickling, but not the cache.
+        '''
+        frs = FilterRuleset('- *.o', cache_size=10)
+        frs.match_type_index('a', False)
+        copy = pickle.loads(pickle.dumps(frs))
+        self.assertEqual(10, copy.cache_size)
+        copy.match_type_index('a', False)
+        self.assertEqual((0, 1), (copy.cache_hits, copy.cache_misses))
+
+
+class TestParser(unittest.TestCase):
+    def test_file(self):
+        '''Check that rules are read from a file object, with or without
+        line endings.
+        '''
+        frs = FilterRuleset(StringIO('- *.o\r\n+ a\n- b'))
+        self.assertEqual('- *.o\n+ a\n- b', str(frs))
+        self.assertEqual((3, 3), (frs.parse_stats.lines,
+                                  frs.parse_stats.rules))
+
+    def test_kept_by_default(self):
+        frs = FilterRuleset('- a\n- a\n+ a')
+        self.assertEqual('- a\n- a\n+ a', str(frs))
+        self.assertEqual((0, 0), (frs.parse_stats.duplicates,
+                                  frs.parse_stats.shadowed))
+
+    def test_dedupe(self):
+        frs = FilterRuleset(StringIO('- a\n+ b\nexclude a\n+ a\n'
+                                     '- b\n- a/\n'), dedupe=True)
+        self.assertEqual('- a\n+ b\n- a/', str(frs))
+        stats = frs.parse_stats
+        self.assertEqual((6, 3, 1, 2), (stats.lines, stats.rules,
+                                        stats.duplicates, stats.shadowed))
+
+    def test_dedupe_keeps_decisions(self):
+        '''Check that dropping duplicates doesn't change what is included.
+        '''
+        text = '- *.o\n+ a/\n- a/\n- *\n- *.o\n+ a/'
+        frs = FilterRuleset(text)
+        deduped = FilterRuleset(text, dedupe=True)
+        for path in ['a', 'b', 'x.o', 'a/x.o']:
+            for st in [FILE_STAT, DIR_STAT]:
+                self.assertEqual(frs.apply(path, st),
+                                 deduped.apply(path, st))
+
+    def test_comments_kept(self):
+        frs = FilterRuleset(';x y\n;x y', dedupe=True)
+        self.assertEqual(2, frs.parse_stats.rules)
+
+
+class MergeTestCase(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        merge_cache.clear()
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def write(self, rel_path, text):
+        path = os.path.join(self.root, rel_path)
+        if not os.path.isdir(os.path.dirname(path)):
+            os.makedirs(os.path.dirname(path))
+        with open(path, 'w') as f:
+            f.write(text)
+        return path
+
+
+class TestMerge(MergeTestCase):
+    def test_merge(self):
+        merged = self.write('merged', '- *.o\n+ a\n')
+        for keyword in ['merge', '.']:
+            frs = FilterRuleset('+ b.o\n{0} {1}\n- a'.format(keyword,
+                                                              merged))
+            self.assertEqual(['+ b.o', '- *.o', '+ a', '- a'],
+                             [str(rule) for rule in frs.rules])
+            self.assertEqual('+ b.o\n{0} {1}\n- a'.format(keyword, merged),
+                             str(frs))
+            self.assertTrue(frs.apply('b.o', FILE_STAT))
+            self.assertFalse(frs.apply('c.o', FILE_STAT))
+            self.assertTrue(frs.apply('a', FILE_STAT))
+
+    def test_modifiers(self):
+        merged = self.write('merged', '*.o\n# comment\n\n*.a\n')
+        frs = FilterRuleset('merge,- {0}\n.+ {0}'.format(merged))
+        self.assertEqual(['- *.o', '- *.a', '+ *.o', '+ *.a'],
+                         [str(rule) for rule in frs.rules])
+
+    def test_missing(self):
+        try:
+            FilterRuleset('. ' + os.path.join(self.root, 'missing'))
+        except IOError, e:
+            self.assertEqual(errno.ENOENT, e.errno)
+        else:
+            self.fail('No error for a missing merge file')
+
+    def test_loop(self):
+        a = os.path.join(self.root, 'a')
+        b = self.write('b', '. ' + a)
+        self.write('a', '- x\n. ' + b)
+        self.assertRaises(IOError, FilterRuleset, '. ' + a)
+
+    def test_invalid_pattern(self):
+        '''Check that a bad pattern is reported with the innermost file
+        '''
+        inner = self.write('inner', '- [')
+        outer = self.write('outer', '. ' + inner)
+        try:
+            FilterRuleset('. ' + outer)
+        except regex.error, e:
+            self.assertEqual(inner, e.filename)
+        else:
+            self.fail('No error for a bad pattern')
+
+    def test_cached(self):
+        merged = self.write('merged', '- *.o')
+        FilterRuleset('. ' + merged)
+        hits = merge_cache.hits
+        FilterRuleset('. ' + merged)
+        self.assertEqual(hits + 1, merge_cache.hits)
+
+    def test_changed(self):
+        merged = self.write('merged', '- *.o')
+        FilterRuleset('. ' + merged)
+        self.write('merged', '- *.a')
+        os.utime(merged, (0, time.time() + 10))
+        frs = FilterRuleset('. ' + merged)
+        self.assertEqual(['- *.a'], [str(rule) for rule in frs.rules])
+
+    def test_dedupe(self):
+        merged = self.write('merged', '- *.o\n+ a')
+        frs = FilterRuleset('- a\n. ' + merged + '\n- *.o', dedupe=True)
+        self.assertEqual(['- a', '- *.o'], [str(rule) for rule in frs.rules])
+        self.assertEqual((1, 1), (frs.parse_stats.duplicates,
+                                  frs.parse_stats.shadowed))
+
+
+class TestFilterStack(MergeTestCase):
+    def setUp(self):
+        MergeTestCase.setUp(self)
+        self.write('.rsync-filter', '- *.o\n- /top\n')
+        self.write('a/.rsync-filter', '+ a.o\n- /x\n')
+        self.write('a/b/.rsync-filter', '- *\n')
+        os.mkdir(os.path.join(self.root, 'c'))
+
+    def apply(self, filters, path, st=FILE_STAT):
+        return filters.apply(path, st)
+
+    def test_no_dir_merge(self):
+        frs = FilterRuleset('- *.o')
+        self.assertTrue(frs.for_tree(self.root) is frs)
+
+    def test_dir_merge(self):
+        stack = FilterRuleset('+ keep.o\n: .rsync-filter\n- y').for_tree(
+            self.root)
+        self.assertTrue(isinstance(stack, FilterStack))
+        self.assertFalse(stack.apply('f.o', FILE_STAT))
+        self.assertTrue(stack.apply('keep.o', FILE_STAT))
+        self.assertFalse(stack.apply('top', FILE_STAT))
+        self.assertFalse(stack.apply('y', FILE_STAT))
+        # Anchored to the directory of the file
+        self.assertTrue(stack.apply('c/top', FILE_STAT))
+        self.assertFalse(stack.apply('a/x', FILE_STAT))
+        self.assertTrue(stack.apply('x', FILE_STAT))
+        # The deeper file comes first
+        self.assertTrue(stack.apply('a/a.o', FILE_STAT))
+        self.assertFalse(stack.apply('a/f.o', FILE_STAT))
+        self.assertFalse(stack.apply('a/b/g', FILE_STAT))
+        self.assertTrue(stack.apply('a/b/keep.o', FILE_STAT))
+        self.assertTrue(stack.apply('a/g', FILE_STAT))
+        self.assertFalse(stack.apply('c/f.o', FILE_STAT))
+
+    def test_no_inherit(self):
+        stack = FilterRuleset('dir-merge,n .rsync-filter').for_tree(
+            self.root)
+        self.assertFalse(stack.apply('f.o', FILE_STAT))
+        self.assertTrue(stack.apply('a/f.o', FILE_STAT))
+        self.assertTrue(stack.apply('c/f.o', FILE_STAT))
+        self.assertFalse(stack.apply('a/x', FILE_STAT))
+        # Only its own file applies to a/b
+        self.assertFalse(stack.apply('a/b/a.o', FILE_STAT))
+
+    def test_exclude_self(self):
+        frs = FilterRuleset(':e .rsync-filter')
+        self.assertEqual(['- .rsync-filter', ':e .rsync-filter'],
+                         [str(rule) for rule in frs.rules])
+        self.assertEqual(':e .rsync-filter', str(frs))
+        self.assertFalse(frs.for_tree(self.root).apply('a/.rsync-filter',
+                                                       FILE_STAT))
+
+    def test_line_type(self):
+        self.write('c/.ignore', 'f\n')
+        stack = FilterRuleset(':- .ignore').for_tree(self.root)
+        self.assertFalse(stack.apply('c/f', FILE_STAT))
+        self.assertTrue(stack.apply('f', FILE_STAT))
+
+    def test_files_read_once(self):
+        stack = FilterRuleset(': .rsync-filter').for_tree(self.root)
+        for path in ['f', 'a/f', 'a/b/f', 'a/b/g', 'a/g', 'c/f']:
+            stack.apply(path, FILE_STAT)
+        self.assertEqual((0, 3), (merge_cache.hits, merge_cache.misses))
+
+    def test_pickle(self):
+        stack = FilterRuleset(': .rsync-filter').for_tree(self.root)
+        stack.apply('a/f.o', FILE_STAT)
+        copy = pickle.loads(pickle.dumps(stack))
+        self.assertFalse(copy.apply('a/x', FILE_STAT))
+
+
 def get_suite():
-    return unittest.TestLoader().loadTestsFromTestCase(TestFilterRuleset)
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestFilterRuleset),
+        loader.loadTestsFromTestCase(TestRulesetDiff),
+        loader.loadTestsFromTestCase(TestDecisionCache),
+        loader.loadTestsFromTestCase(TestParser),
+        loader.loadTestsFromTestCase(TestMerge),
+        loader.loadTestsFromTestCase(TestFilterStack),
+    ])
@@ -19,40 +19,29 @@ Tests for the rsyncconfig.fstree module
 
 import stat
 import unittest
-from contextlib import contextmanager
 
-from mock import patch, sentinel
+from mock import Mock
 
-from rsyncconfig.fstree import FSTree
+from rsyncconfig.filter import FilterRuleset
+from rsyncconfig.fstree import (FSTree, Totals, COL_PATH, COL_STAT,
+                                COL_SPIDERING, NO_MATCH)
+from rsyncconfig.spider import EntryStat
 
 
-@contextmanager
-def mocked_stat():
-    '''Context manager which mocks stat.S_ISDIR.
-    '''
-    def S_ISDIR(stat_t):
-        if stat_t is sentinel.file_stat:
-            return False
-        if stat_t is sentinel.dir_stat:
-            return True
-        raise Exception("mocked_stat doesn't support {0!r}".format(stat_t))
-
-    original_S_ISDIR = stat.S_ISDIR
-    stat.S_ISDIR = S_ISDIR
-    try:
-        yield
-    finally:
-        stat.S_ISDIR = original_S_ISDIR
-
-
-def store_to_list(tree_store):
+FILE_STAT = EntryStat(stat.S_IFREG | 0o644, 10, 1000.0)
+
+DIR_STAT = EntryStat(stat.S_IFDIR | 0o755, 4096, 2000.0)
+
+
+def store_to_list(tree_store, columns=(COL_PATH, COL_STAT, COL_SPIDERING)):
     '''Convert a gtk.TreeStore to an equivalent native data structure.
     '''
     def rows(items):
         if items is None:
             return
         for item in items:
-            yield tuple(item) + (list(rows(item.iterchildren())),)
+            yield (tuple(item[column] for column in columns) +
+                   (list(rows(item.iterchildren())),))
     return list(rows(tree_store))
 
 
@@ -63,49 +52,421 @@ class TestFSTree(unittest.TestCase):
     def test_add_single_file(self):
         '''Check that the FSTree updates correctly when a single file is added.
         '''
-        with mocked_stat():
-            self.fstree.add_path('foo', sentinel.file_stat, False)
-            self.assertEqual([('foo', sentinel.file_stat, False, [])],
-                             store_to_list(self.fstree.store))
+        self.fstree.add_path('foo', FILE_STAT, False)
+        self.assertEqual([('foo', FILE_STAT, False, [])],
+                         store_to_list(self.fstree.store))
 
     def test_add_two_files(self):
         '''Check that the FSTree updates correctly when two files are added.
 
         The FSTree should sort the files lexicographically by name.
         '''
-        with mocked_stat():
-            self.fstree.add_path('foo', sentinel.file_stat, False)
-            self.fstree.add_path('bar', sentinel.file_stat, False)
-            self.assertEqual([('bar', sentinel.file_stat, False, []),
-                              ('foo', sentinel.file_stat, False, [])],
-                             store_to_list(self.fstree.store))
+        self.fstree.add_path('foo', FILE_STAT, False)
+        self.fstree.add_path('bar', FILE_STAT, False)
+        self.assertEqual([('bar', FILE_STAT, False, []),
+                          ('foo', FILE_STAT, False, [])],
+                         store_to_list(self.fstree.store))
 
     def test_add_dir_with_file(self):
         '''Check that FSTree updates correctly with a dir containing a file.
 
         The file should be placed inside the directory.
         '''
-        with mocked_stat():
-            self.fstree.add_path('dir', sentinel.dir_stat)
-            self.fstree.add_path('dir/file', sentinel.file_stat, False)
-            self.assertEqual([('dir', sentinel.dir_stat, True, [
-                ('dir/file', sentinel.file_stat, False, []),
-            ])], store_to_list(self.fstree.store))
+        self.fstree.add_path('dir', DIR_STAT)
+        self.fstree.add_path('dir/file', FILE_STAT, False)
+        self.assertEqual([('dir', DIR_STAT, True, [
+            ('dir/file', FILE_STAT, False, []),
+        ])], store_to_list(self.fstree.store))
 
     def test_add_dir_with_files(self):
         '''Check that two files within a directory are handled properly.
 
         The files should be sorted lexicographically by name.
         '''
-        with mocked_stat():
-            self.fstree.add_path('dir', sentinel.dir_stat)
-            self.fstree.add_path('dir/foo', sentinel.file_stat, False)
-            self.fstree.add_path('dir/bar', sentinel.file_stat, False)
-            self.assertEqual([('dir', sentinel.dir_stat, True, [
-                ('dir/bar', sentinel.file_stat, False, []),
-                ('dir/foo', sentinel.file_stat, False, [])
-            ])], store_to_list(self.fstree.store))
+        self.fstree.add_path('dir', DIR_STAT)
+        self.fstree.add_path('dir/foo', FILE_STAT, False)
+        self.fstree.add_path('dir/bar', FILE_STAT, False)
+        self.assertEqual([('dir', DIR_STAT, True, [
+            ('dir/bar', FILE_STAT, False, []),
+            ('dir/foo', FILE_STAT, False, [])
+        ])], store_to_list(self.fstree.store))
+
+    def test_children_sorted_when_asked_for(self):
+        '''Check that a directory's children aren't sorted until the view asks.
+        '''
+        self.fstree.add_path('dir', DIR_STAT)
+        self.fstree.add_path('dir/foo', FILE_STAT, False)
+        dir_iter = self.fstree.store.get_iter((0,))
+        self.assertTrue(self.fstree.store.iter_has_child(dir_iter))
+        self.assertEqual(1, self.fstree.store.iter_n_children(dir_iter))
+        self.assertNotIn(self.fstree._paths.lookup('dir'), self.fstree._sorted)
+        self.fstree.store.iter_children(dir_iter)
+        self.assertIn(self.fstree._paths.lookup('dir'), self.fstree._sorted)
+
+    def test_row_inserted(self):
+        '''Check that the view is told where rows are inserted.
+        '''
+        inserted = []
+        self.fstree.store.connect('row-inserted', lambda model, path, iter:
+                                  inserted.append(path))
+        self.fstree.add_path('foo', FILE_STAT, False)
+        self.fstree.add_path('bar', FILE_STAT, False)
+        self.fstree.add_path('dir', DIR_STAT)
+        self.assertEqual([(0,), (0,), (1,)], inserted)
+
+    def test_row_inserted_in_expanded_dir(self):
+        '''Check that rows are only signalled once their parent is expanded.
+        '''
+        inserted = []
+        toggled = []
+        self.fstree.store.connect('row-inserted', lambda model, path, iter:
+                                  inserted.append(path))
+        self.fstree.store.connect('row-has-child-toggled',
+                                  lambda model, path, iter:
+                                  toggled.append(path))
+        self.fstree.add_path('dir', DIR_STAT)
+        self.fstree.add_path('dir/foo', FILE_STAT, False)
+        self.assertEqual([(0,)], inserted)
+        self.assertEqual([(0,)], toggled)
+        self.fstree.store.iter_children(self.fstree.store.get_iter((0,)))
+        self.fstree.add_path('dir/bar', FILE_STAT, False)
+        self.assertEqual([(0,), (0, 0)], inserted)
+
+    def test_get_path(self):
+        '''Check that paths are rebuilt from the names of their ancestors.
+        '''
+        self.fstree.add_path('a', DIR_STAT)
+        self.fstree.add_path('a/a', DIR_STAT)
+        self.fstree.add_path('a/a/a', FILE_STAT, False)
+        self.assertEqual('a/a/a', self.fstree.get_path(3))
+
+    def test_update_path(self):
+        self.fstree.add_path('dir', DIR_STAT)
+        self.fstree.add_path('dir/foo', FILE_STAT)
+        changed = EntryStat(FILE_STAT.st_mode, 20, 3000.0)
+        self.fstree.update_path('dir/foo', changed)
+        self.assertEqual([('dir', DIR_STAT, True, [
+            ('dir/foo', changed, False, []),
+        ])], store_to_list(self.fstree.store))
+
+    def test_update_dir_to_file(self):
+        '''Check that a directory replaced by a file loses its contents.
+        '''
+        self.fstree.add_path('dir', DIR_STAT)
+        self.fstree.add_path('dir/foo', FILE_STAT, False)
+        self.fstree.update_path('dir', FILE_STAT)
+        self.assertEqual([('dir', FILE_STAT, False, [])],
+                         store_to_list(self.fstree.store))
+
+    def test_add_existing(self):
+        '''Check that adding a path twice updates it.
+        '''
+        self.fstree.add_path('foo', FILE_STAT)
+        changed = EntryStat(FILE_STAT.st_mode, 20, 3000.0)
+        self.fstree.add_path('foo', changed, False)
+        self.assertEqual([('foo', changed, False, [])],
+                         store_to_list(self.fstree.store))
+
+    def test_remove_file(self):
+        self.fstree.add_path('foo', FILE_STAT, False)
+        self.fstree.add_path('bar', FILE_STAT, False)
+        self.fstree.add_path('baz', FILE_STAT, False)
+        self.fstree.remove_path('bar')
+        self.assertEqual([('baz', FILE_STAT, False, []),
+                          ('foo', FILE_STAT, False, [])],
+                         store_to_list(self.fstree.store))
+        self.assertEqual(2, len(self.fstree))
+
+    def test_remove_subtree(self):
+        '''Check that removing a directory removes everything beneath it.
+        '''
+        self.fstree.add_path('dir', DIR_STAT)
+        self.fstree.add_path('dir/sub', DIR_STAT)
+        self.fstree.add_path('dir/sub/foo', FILE_STAT, False)
+        self.fstree.add_path('dir/bar', FILE_STAT, False)
+        self.fstree.add_path('foo', FILE_STAT, False)
+        self.fstree.remove_path('dir')
+        self.assertEqual([('foo', FILE_STAT, False, [])],
+                         store_to_list(self.fstree.store))
+        self.assertEqual(1, len(self.fstree))
+        self.fstree.add_path('dir', DIR_STAT, False)
+        self.fstree.add_path('dir/foo', FILE_STAT, False)
+        self.assertEqual([('dir', DIR_STAT, False, [
+            ('dir/foo', FILE_STAT, False, []),
+        ]), ('foo', FILE_STAT, False, [])], store_to_list(self.fstree.store))
+
+    def test_remove_missing(self):
+        self.fstree.remove_path('foo')
+        self.fstree.update_path('foo', FILE_STAT)
+        self.assertEqual([], store_to_list(self.fstree.store))
+
+    def test_add_beneath_removed(self):
+        '''Check that a path whose directory has been removed is ignored.
+        '''
+        self.fstree.add_path('dir', DIR_STAT)
+        self.fstree.add_path('dir/foo', FILE_STAT)
+        self.fstree.remove_path('dir')
+        self.fstree.add_path('dir/bar', FILE_STAT)
+        self.fstree.add_path('foo', FILE_STAT)
+        self.fstree.add_path('foo/bar', FILE_STAT)
+        self.assertEqual([('foo', FILE_STAT, True, [])],
+                         store_to_list(self.fstree.store))
+
+    def test_row_deleted(self):
+        '''Check that the view is told about removals from expanded rows.
+        '''
+        deleted = []
+        toggled = []
+        self.fstree.store.connect('row-deleted', lambda model, path:
+                                  deleted.append(path))
+        self.fstree.store.connect('row-has-child-toggled',
+                                  lambda model, path, iter:
+                                  toggled.append(path))
+        self.fstree.add_path('dir', DIR_STAT)
+        self.fstree.add_path('dir/bar', FILE_STAT, False)
+        self.fstree.add_path('dir/foo', FILE_STAT, False)
+        self.fstree.store.iter_children(self.fstree.store.get_iter((0,)))
+        self.fstree.remove_path('dir/foo')
+        self.assertEqual([(0, 1)], deleted)
+        self.fstree.remove_path('dir/bar')
+        self.assertEqual([(0, 1), (0, 0)], deleted)
+        self.assertEqual([(0,), (0,)], toggled)
+
+
+class TestFSTreeFilters(unittest.TestCase):
+    def setUp(self):
+        self.fstree = FSTree()
+        for path, st in [('bar', DIR_STAT), ('bar/baz', FILE_STAT),
+                         ('bar/foo.o', FILE_STAT), ('foo', DIR_STAT),
+                         ('foo/bar', FILE_STAT), ('foo.o', FILE_STAT)]:
+            self.fstree.add_path(path, st)
+
+    def set_filters(self, text):
+        '''Set filters which count how many paths they and each of their
+        rules are matched against.
+        '''
+        filters = FilterRuleset(text)
+        filters.match_type_index = Mock(wraps=filters.match_type_index)
+        for rule in filters.rules:
+            rule.match_type = Mock(wraps=rule.match_type)
+        self.fstree.set_filters(filters)
+        return filters
+
+    def matches(self, filters):
+        return filters.match_type_index.call_count + sum(
+            rule.match_type.call_count for rule in filters.rules)
+
+    def included(self):
+        return sorted(self.fstree.get_path(node)
+                      for node in xrange(1, len(self.fstree) + 1)
+                      if self.fstree.is_included(node))
+
+    def test_no_filters(self):
+        self.assertEqual(['bar', 'bar/baz', 'bar/foo.o', 'foo', 'foo.o',
+                          'foo/bar'], self.included())
+
+    def test_excluded_dir(self):
+        '''Check that everything beneath an excluded directory is excluded.
+        '''
+        self.set_filters('- *.o\n- /bar/\n')
+        self.assertEqual(['foo', 'foo/bar'], self.included())
+
+    def test_decision(self):
+        self.set_filters('+ foo\n- *.o\n')
+        decisions = dict((self.fstree.get_path(node),
+                          self.fstree.get_decision(node))
+                         for node in xrange(1, len(self.fstree) + 1))
+        self.assertEqual({'bar': NO_MATCH, 'bar/baz': NO_MATCH,
+                          'bar/foo.o': 1, 'foo': 0, 'foo/bar': NO_MATCH,
+                          'foo.o': 1}, decisions)
+
+    def test_decisions_cached(self):
+        filters = self.set_filters('- *.o\n')
+        self.included()
+        calls = self.matches(filters)
+        self.assertEqual(len(self.fstree), calls)
+        self.included()
+        self.assertEqual(calls, self.matches(filters))
+
+    def test_only_later_rules_changed(self):
+        '''Check that only the new rule is tried on the nodes no rule
+        matched, and that only the node decided by the changed rule is matched
+        afresh.
+        '''
+        self.set_filters('- *.o\n- /foo/bar\n')
+        self.included()
+        filters = self.set_filters('- *.o\n- /bar/baz\n')
+        self.assertEqual(['bar', 'foo', 'foo/bar'], self.included())
+        self.assertEqual(1, filters.match_type_index.call_count)
+        self.assertEqual(0, filters.rules[0].match_type.call_count)
+        self.assertEqual(3, filters.rules[1].match_type.call_count)
+
+    def test_rule_removed(self):
+        '''Check that removing a rule only matches the nodes it decided.
+        '''
+        self.set_filters('- *.o\n- /foo/bar\n')
+        self.included()
+        filters = self.set_filters('- /foo/bar\n')
+        self.assertEqual(['bar', 'bar/baz', 'bar/foo.o', 'foo', 'foo.o'],
+                         self.included())
+        self.assertEqual(2, self.matches(filters))
+
+    def test_stale_nodes_only(self):
+        '''Check that update_totals() only visits the nodes decided by no
+        rule, or by a rule after the first new one.
+        '''
+        self.set_filters('- *.o\n- /foo/bar\n')
+        while self.fstree.update_totals():
+            pass
+        self.set_filters('- *.o\n- /foo/baz\n')
+        self.fstree.get_decision = Mock(wraps=self.fstree.get_decision)
+        while self.fstree.update_totals(1):
+            pass
+        self.assertEqual(4, self.fstree.get_decision.call_count)
+        self.assertEqual(['bar', 'bar/baz', 'foo', 'foo/bar'],
+                         self.included())
+
+    def test_repeated_changes(self):
+        '''Check that nodes are decided rightly when the filters change
+        again before update_totals() has got to them.
+        '''
+        self.set_filters('- *.o\n')
+        self.set_filters('+ bar/foo.o\n- *.o\n')
+        self.set_filters('+ bar/foo.o\n- *.o\n- baz\n')
+        self.fstree.update_totals(2)
+        self.set_filters('- bar\n+ bar/foo.o\n- *.o\n- baz\n')
+        self.assertEqual(['foo'], self.included())
+        self.set_filters('+ bar/foo.o\n- *.o\n- baz\n')
+        self.assertEqual(['bar', 'bar/foo.o', 'foo', 'foo/bar'],
+                         self.included())
+
+    def test_added_after_filters(self):
+        self.set_filters('- *.o\n')
+        self.fstree.add_path('bar/qux.o', FILE_STAT)
+        self.assertFalse('bar/qux.o' in self.included())
+
+    def test_updated_to_dir(self):
+        '''Check that a node is matched again when it becomes a directory.
+        '''
+        self.set_filters('- baz/\n')
+        self.assertTrue('bar/baz' in self.included())
+        self.fstree.update_path('bar/baz', DIR_STAT)
+        self.assertFalse('bar/baz' in self.included())
+
+
+class TestFSTreeTotals(unittest.TestCase):
+    def setUp(self):
+        self.fstree = FSTree()
+        for path, size in [('a', None), ('a/f.o', 1), ('a/g', 2),
+                           ('a/b', None), ('a/b/h', 4), ('a/b/i.o', 8),
+                           ('c', None), ('c/j', 16), ('k.o', 32)]:
+            self.add(path, size)
+
+    def add(self, path, size):
+        if size is None:
+            self.fstree.add_path(path, DIR_STAT)
+        else:
+            self.fstree.add_path(path, EntryStat(stat.S_IFREG | 0o644, size,
+                                                 1000.0))
+
+    def set_filters(self, text):
+        self.fstree.set_filters(FilterRuleset(text))
+        while self.fstree.update_totals(2):
+            pass
+
+    def summed(self, node=0):
+        '''Sum the totals beneath a node from scratch.
+        '''
+        fstree = self.fstree
+        included_bytes = included_files = excluded_bytes = 0
+        for other in xrange(1, len(fstree._mode)):
+            if fstree._paths.parent[other] == -1:
+                continue
+            if stat.S_ISDIR(fstree.get_stat(other).st_mode):
+                continue
+            ancestor = other
+            while ancestor not in (0, node):
+                ancestor = fstree.get_parent(ancestor)
+            if ancestor != node:
+                continue
+            size = fstree.get_stat(other).st_size
+            if fstree.is_included(other):
+                included_bytes += size
+                included_files += 1
+            else:
+                excluded_bytes += size
+        return Totals(included_bytes, included_files, excluded_bytes)
+
+    def check(self, expected):
+        self.assertEqual(expected, self.fstree.get_totals())
+        self.assertEqual(self.summed(), self.fstree.get_totals())
+        for node in xrange(1, len(self.fstree._mode)):
+            if self.fstree._paths.parent[node] != -1:
+                self.assertEqual(self.summed(node),
+                                 self.fstree.get_totals(node),
+                                 self.fstree.get_path(node))
+
+    def test_no_filters(self):
+        self.check(Totals(63, 6, 0))
+
+    def test_filters(self):
+        self.set_filters('- *.o')
+        self.check(Totals(22, 3, 41))
+
+    def test_excluded_dir(self):
+        self.set_filters('- *.o\n- b/')
+        self.check(Totals(18, 2, 45))
+        self.assertEqual(Totals(0, 0, 12),
+                         self.fstree.get_totals(self.fstree._paths.lookup(
+                             'a/b')))
+
+    def test_filters_changed(self):
+        self.set_filters('- b/')
+        self.check(Totals(51, 4, 12))
+        self.set_filters('- *.o\n- c/')
+        self.check(Totals(6, 2, 57))
+        self.set_filters('')
+        self.check(Totals(63, 6, 0))
+
+    def test_added_beneath_excluded(self):
+        self.set_filters('- b/')
+        self.add('a/b/l', 64)
+        self.add('a/b/m', None)
+        self.add('a/b/m/n', 128)
+        self.check(Totals(51, 4, 204))
+
+    def test_updated(self):
+        self.set_filters('- *.o')
+        self.fstree.update_path('a/g', EntryStat(stat.S_IFREG, 100, 0.0))
+        self.check(Totals(120, 3, 41))
+        # A directory which becomes a file loses its contents
+        self.fstree.update_path('a/b', EntryStat(stat.S_IFREG, 1000, 0.0))
+        self.check(Totals(1116, 3, 33))
+
+    def test_removed(self):
+        self.set_filters('- *.o')
+        self.fstree.remove_path('a/b')
+        self.check(Totals(18, 2, 33))
+        self.fstree.remove_path('k.o')
+        self.check(Totals(18, 2, 1))
+        # Removed node numbers are reused
+        self.add('a/p.o', 256)
+        self.add('q', 512)
+        self.check(Totals(530, 3, 257))
+
+    def test_decided_when_shown(self):
+        '''Check that deciding a node for the view updates the totals
+        before update_totals() gets to it.
+        '''
+        self.fstree.set_filters(FilterRuleset('- c/'))
+        self.fstree.is_included(self.fstree._paths.lookup('c'))
+        self.assertEqual(Totals(47, 5, 16), self.fstree.get_totals())
 
 
 def get_suite():
-    return unittest.TestLoader().loadTestsFromTestCase(TestFSTree)
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestFSTree),
+        loader.loadTestsFromTestCase(TestFSTreeFilters),
+        loader.loadTestsFromTestCase(TestFSTreeTotals),
+    ])
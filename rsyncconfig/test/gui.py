@@ -27,6 +27,7 @@ import gtk
 import mock
 
 from .. import gui
+from ..fstree import COL_PATH, COL_INCLUDED
 
 
 def gtk_spin():
@@ -123,6 +124,14 @@ class TestBasicGUIOperations(GUITestCase):
         '''
         self.assertNotEqual(self.app.window, None)
 
+    def test_threads_init(self):
+        '''Check that threads are enabled, for the spider and watcher
+        '''
+        with mock.patch('gobject.threads_init') as threads_init:
+            app = gui.Application()
+            app.window.destroy()
+            threads_init.assert_called_with()
+
     def test_window_destroy_callback(self):
         '''Check that the GTK+ mainloop ends when the window closes
         '''
@@ -242,6 +251,189 @@ class TestFileMenus(GUITestCase):
             main_quit.assert_called_once_with()
 
 
+class SpiderTestCase(GUITestCase):
+    '''Base class for test cases which spider the test directory
+    '''
+    def setUp(self):
+        GUITestCase.setUp(self)
+        # Keep the snapshots of the test directories out of the real cache
+        self.cache_dir = tempfile.mkdtemp()
+        self.environ = mock.patch.dict(os.environ,
+                                       {'XDG_CACHE_HOME': self.cache_dir})
+        self.environ.start()
+
+    def tearDown(self):
+        self.environ.stop()
+        shutil.rmtree(self.cache_dir)
+        GUITestCase.tearDown(self)
+
+    def spider_test_dir(self):
+        '''Display the test directory, waiting for the spider to finish
+        '''
+        self.app.set_root(self.test_dir)
+        self.app.spider.join()
+        self.app.tree_queue.flush()
+
+class TestRootSelect(SpiderTestCase):
+    test_dir_tree = {
+        'foo': { 'biz': 10 },
+        'bar': 20,
+    }
+
+    def test_set_root(self):
+        '''Check that selecting a root displays the tree under it
+        '''
+        self.app.set_root(self.test_dir)
+        self.app.spider.join()
+        self.app.tree_queue.flush()
+        model = self.objects.fstree_treeview.get_model()
+        self.assertEqual(['bar', 'foo', 'foo/biz'],
+                         [row[0] for row in model] +
+                         [row[0] for row in model[1].iterchildren()])
+
+    def test_change_root(self):
+        '''Check that selecting another root replaces the tree
+        '''
+        self.app.set_root(self.test_dir)
+        old_tree = self.app.tree
+        self.app.set_root(os.path.join(self.test_dir, 'foo'))
+        self.app.spider.join()
+        self.app.tree_queue.flush()
+        self.assertFalse(self.app.tree is old_tree)
+        self.assertEqual(['biz'], [row[0] for row in self.app.tree.store])
+
+
+class TestFilterPreview(SpiderTestCase):
+    test_dir_tree = {
+        'foo': { 'biz': 10 },
+        'bar': { 'biz': 20 },
+        'baz': 30,
+    }
+
+    def set_filter_text(self, text):
+        self.objects.filter_textview.get_buffer().set_text(text)
+
+    def get_included(self):
+        model = self.objects.fstree_treeview.get_model()
+        return [(row[COL_PATH], row[COL_INCLUDED]) for row in model]
+
+    def test_included_column(self):
+        '''Check that the tree shows what the edited filters include
+        '''
+        self.spider_test_dir()
+        self.set_filter_text('- /bar/\n- baz')
+        self.app.apply_filter_edits()
+        self.assertEqual([('bar', False), ('baz', False), ('foo', True)],
+                         self.get_included())
+        self.set_filter_text('- /foo/\n- baz')
+        self.app.apply_filter_edits()
+        self.assertEqual([('bar', True), ('baz', False), ('foo', False)],
+                         self.get_included())
+
+    def test_edits_delayed(self):
+        '''Check that edits are applied once editing pauses
+        '''
+        self.set_filter_text('- baz')
+        self.assertEqual('', str(self.app.filters))
+        with mock.patch('gobject.source_remove') as source_remove:
+            self.set_filter_text('- bar')
+            # The pending timeout is replaced
+            self.assertTrue(source_remove.called)
+        self.app.apply_filter_edits()
+        self.assertEqual('- bar', str(self.app.filters))
+
+    def test_root_selected_after_edits(self):
+        self.set_filter_text('- baz')
+        self.app.apply_filter_edits()
+        self.spider_test_dir()
+        self.assertEqual([('bar', True), ('baz', False), ('foo', True)],
+                         self.get_included())
+
+    def test_invalid_filter(self):
+        '''Check that filters which don't parse are reported and ignored
+        '''
+        self.set_filter_text('- baz')
+        self.app.apply_filter_edits()
+        with mock.patch.object(self.app.statusbar, 'push') as push:
+            self.set_filter_text('- [')
+            self.app.apply_filter_edits()
+            self.assertEqual(1, push.call_count)
+        self.assertEqual('- baz', str(self.app.filters))
+
+    def test_totals(self):
+        '''Check that the status bar shows what the filters would send
+        '''
+        self.spider_test_dir()
+        self.set_filter_text('- baz')
+        self.app.apply_filter_edits()
+        with mock.patch.object(self.app.statusbar, 'push') as push:
+            self.app.update_totals()
+            self.assertEqual('30 bytes in 2 files to transfer, 30 bytes '
+                             'excluded', push.call_args[0][1])
+            # Only shown again once the totals change
+            self.app.update_totals()
+            self.assertEqual(1, push.call_count)
+
+    def test_read(self):
+        '''Check that reading a filter file applies its filters at once
+        '''
+        self.app.filter_file = os.path.join(self.test_dir, 'filters')
+        with open(self.app.filter_file, 'wb') as f:
+            f.write('- baz\r\n- /foo/\n')
+        self.spider_test_dir()
+        self.app.read()
+        self.assertEqual('- baz\r\n- /foo/\n',
+                         self.get_filter_textview_contents())
+        self.assertEqual([('bar', True), ('baz', False), ('filters', True),
+                          ('foo', False)], self.get_included())
+
+    def test_read_keeps_text(self):
+        '''Check that the filter file is shown as it was written
+        '''
+        self.app.filter_file = os.path.join(self.test_dir, 'filters')
+        text = '# Generated\n\n- baz\n#comment\n'
+        with open(self.app.filter_file, 'wb') as f:
+            f.write(text)
+        self.app.read()
+        self.assertEqual(text, self.get_filter_textview_contents())
+        self.assertEqual('# Generated\n- baz', str(self.app.filters))
+
+    def test_read_invalid(self):
+        self.app.filter_file = os.path.join(self.test_dir, 'filters')
+        with open(self.app.filter_file, 'wb') as f:
+            f.write('- [\n')
+        self.app.read()
+        self.assertEqual('- [\n', self.get_filter_textview_contents())
+        self.assertEqual('', str(self.app.filters))
+
+    def test_save_as_typed(self):
+        '''Check that the filters are saved as they were typed
+        '''
+        self.app.filter_file = os.path.join(self.test_dir, 'filters')
+        text = '# Generated\n\n- baz\n#comment\n'
+        self.set_filter_text(text)
+        self.app.save()
+        with open(self.app.filter_file, 'rb') as f:
+            self.assertEqual(text, f.read())
+        self.assertEqual('# Generated\n- baz', str(self.app.filters))
+
+    def test_save_invalid(self):
+        '''Check that filters which don't parse aren't saved
+        '''
+        self.app.filter_file = os.path.join(self.test_dir, 'filters')
+        with open(self.app.filter_file, 'wb') as f:
+            f.write('- baz\n- /foo/\n')
+        self.set_filter_text('- baz\n- [')
+        with mock.patch.object(self.app.statusbar, 'push') as push:
+            self.app.save()
+            self.assertEqual(1, push.call_count)
+            # Still refused once the error has been shown
+            self.app.save()
+            self.assertEqual(2, push.call_count)
+        with open(self.app.filter_file, 'rb') as f:
+            self.assertEqual('- baz\n- /foo/\n', f.read(), 'File unchanged')
+
+
 class TestSpanishTranslation(unittest.TestCase):
     def setUp(self):
         '''Create the Application instance under test
@@ -281,5 +473,7 @@ def get_suite():
         loader.loadTestsFromTestCase(TestLoadGUI),
         loader.loadTestsFromTestCase(TestBasicGUIOperations),
         loader.loadTestsFromTestCase(TestFileMenus),
+        loader.loadTestsFromTestCase(TestRootSelect),
+        loader.loadTestsFromTestCase(TestFilterPreview),
         loader.loadTestsFromTestCase(TestSpanishTranslation),
     ])
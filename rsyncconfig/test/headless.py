@@ -0,0 +1,64 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Tests that the modules which run without a display don't need gtk
+
+This module must not import gtk itself, so that it can run on machines
+without it.
+'''
+
+import os
+import sys
+import subprocess
+import unittest
+
+import rsyncconfig
+
+'Imports the headless modules and checks that gtk has not been imported.'
+HEADLESS_SCRIPT = '''
+import sys
+from rsyncconfig import cli, filter, fstree, pathtable, snapshot, spider, \\
+    watch
+tree = fstree.FSTree()
+tree.add_path('foo', spider.EntryStat(0, 0, 0))
+tree.remove_path('foo')
+loaded = [name for name in ('pygtk', 'gtk', 'gobject') if name in sys.modules]
+sys.stdout.write(' '.join(loaded))
+'''
+
+
+class TestHeadless(unittest.TestCase):
+    def test_gtk_not_imported(self):
+        '''Check that nothing but the GUI imports gtk.
+        '''
+        env = dict(os.environ)
+        paths = [os.path.dirname(
+            os.path.dirname(os.path.abspath(rsyncconfig.__file__)))]
+        if env.get('PYTHONPATH'):
+            paths.append(env['PYTHONPATH'])
+        env['PYTHONPATH'] = os.pathsep.join(paths)
+        process = subprocess.Popen([sys.executable, '-c', HEADLESS_SCRIPT],
+                                   stdout=subprocess.PIPE, env=env)
+        output = process.communicate()[0]
+        self.assertEqual(0, process.returncode)
+        self.assertEqual('', output)
+
+
+def get_suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestHeadless),
+    ])
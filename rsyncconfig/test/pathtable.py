@@ -0,0 +1,99 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the rsyncconfig.pathtable module
+'''
+
+import unittest
+
+from rsyncconfig.pathtable import PathTable, ROOT
+
+
+class TestPathTable(unittest.TestCase):
+    def setUp(self):
+        self.table = PathTable()
+
+    def add_paths(self, paths):
+        nodes = {}
+        for path in paths:
+            parent, _, name = path.rpartition('/')
+            nodes[path] = self.table.add(self.table.lookup(parent), name)
+        return nodes
+
+    def test_root(self):
+        self.assertEqual(ROOT, self.table.lookup(''))
+        self.assertEqual('', self.table.get_path(ROOT))
+        self.assertEqual(0, len(self.table))
+
+    def test_lookup(self):
+        '''Check that every added path can be found and rebuilt.
+        '''
+        nodes = self.add_paths(['a', 'a/b', 'a/b/a', 'b', 'b/a', 'a/c'])
+        self.assertEqual(6, len(self.table))
+        for path, node in nodes.items():
+            self.assertEqual(node, self.table.lookup(path))
+            self.assertEqual(path, self.table.get_path(node))
+
+    def test_lookup_missing(self):
+        self.add_paths(['a', 'a/b'])
+        self.assertEqual(None, self.table.lookup('b'))
+        self.assertEqual(None, self.table.lookup('a/c'))
+        self.assertEqual(None, self.table.lookup('a/b/c'))
+        self.assertEqual(None, self.table.lookup('b/a'))
+
+    def test_names_interned(self):
+        '''Check that a name shared by several paths is only stored once.
+        '''
+        self.add_paths(['a', 'a/a', 'a/a/a', 'b', 'b/a'])
+        self.assertEqual(['', 'a', 'b'], self.table._names)
+
+    def test_many(self):
+        '''Check lookups after the edge table has been resized many times.
+        '''
+        paths = ['d{0}'.format(i) for i in range(100)]
+        paths += ['d{0}/f{1}'.format(i, j)
+                  for i in range(0, 100, 7) for j in range(50)]
+        nodes = self.add_paths(paths)
+        for path, node in nodes.items():
+            self.assertEqual(node, self.table.lookup(path))
+
+    def test_remove(self):
+        '''Check that the remaining paths survive many removals.
+        '''
+        paths = ['d{0}'.format(i) for i in range(200)]
+        nodes = self.add_paths(paths)
+        for path in paths[::3]:
+            self.table.remove(nodes.pop(path))
+        for path in paths[::3]:
+            self.assertEqual(None, self.table.lookup(path))
+        for path, node in nodes.items():
+            self.assertEqual(node, self.table.lookup(path))
+        self.assertEqual(len(nodes), len(self.table))
+
+    def test_reuse(self):
+        '''Check that the numbers of removed nodes are reused.
+        '''
+        nodes = self.add_paths(['a', 'b'])
+        self.table.remove(nodes['a'])
+        node = self.table.add(ROOT, 'c')
+        self.assertEqual(nodes['a'], node)
+        self.assertEqual('c', self.table.get_path(node))
+        self.assertEqual(None, self.table.lookup('a'))
+
+
+def get_suite():
+    loader = unittest.TestLoader()
+    return loader.loadTestsFromTestCase(TestPathTable)
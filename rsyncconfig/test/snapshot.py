@@ -0,0 +1,124 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the rsyncconfig.snapshot module
+'''
+
+import os
+import stat
+import shutil
+import tempfile
+import unittest
+
+from mock import patch
+
+from rsyncconfig.snapshot import Snapshot, get_snapshot_path
+from rsyncconfig.spider import EntryStat
+
+
+DIR_STAT = os.stat_result((stat.S_IFDIR | 0o755, 42, 1, 2, 0, 0, 4096,
+                           100, 200, 300))
+
+ENTRIES = {
+    'foo': EntryStat(stat.S_IFREG | 0o644, 10, 1000.5),
+    'bar': EntryStat(stat.S_IFDIR | 0o755, 4096, 2000.0),
+}
+
+
+class TestSnapshot(unittest.TestCase):
+    def setUp(self):
+        self.dir = tempfile.mkdtemp()
+        self.filename = os.path.join(self.dir, 'cache', 'snapshot')
+
+    def tearDown(self):
+        shutil.rmtree(self.dir)
+
+    def test_save_and_load(self):
+        snapshot = Snapshot('/root', self.filename)
+        snapshot.record('', DIR_STAT, ENTRIES)
+        snapshot.record('bar', DIR_STAT, {})
+        snapshot.save()
+        loaded = Snapshot('/root', self.filename)
+        loaded.load()
+        self.assertEqual(2, len(loaded))
+        self.assertEqual(ENTRIES, loaded.get(''))
+        self.assertEqual({}, loaded.get('bar'))
+        self.assertEqual(None, loaded.get('foo'))
+
+    def test_recorded_after_save(self):
+        '''Check that what is recorded only replaces the snapshot on save.
+        '''
+        snapshot = Snapshot('/root', self.filename)
+        snapshot.record('', DIR_STAT, ENTRIES)
+        self.assertEqual(None, snapshot.get(''))
+        snapshot.save()
+        self.assertEqual(ENTRIES, snapshot.get(''))
+
+    def test_keep(self):
+        '''Check that a kept directory is recorded as it was.
+        '''
+        snapshot = Snapshot('/root', self.filename)
+        snapshot.record('', DIR_STAT, ENTRIES)
+        snapshot.record('bar', DIR_STAT, {})
+        snapshot.save()
+        snapshot.keep('')
+        snapshot.save()
+        self.assertEqual(1, len(snapshot))
+        self.assertEqual(ENTRIES, snapshot.get(''))
+        self.assertTrue(snapshot.is_current('', DIR_STAT))
+
+    def test_is_current(self):
+        snapshot = Snapshot('/root', self.filename)
+        snapshot.record('', DIR_STAT, ENTRIES)
+        snapshot.save()
+        self.assertTrue(snapshot.is_current('', DIR_STAT))
+        changed = os.stat_result((stat.S_IFDIR | 0o755, 42, 1, 2, 0, 0, 4096,
+                                  100, 201, 300))
+        self.assertFalse(snapshot.is_current('', changed))
+        self.assertFalse(snapshot.is_current('bar', DIR_STAT))
+
+    def test_load_other_root(self):
+        snapshot = Snapshot('/root', self.filename)
+        snapshot.record('', DIR_STAT, ENTRIES)
+        snapshot.save()
+        other = Snapshot('/other', self.filename)
+        other.load()
+        self.assertEqual(0, len(other))
+
+    def test_load_missing(self):
+        snapshot = Snapshot('/root', self.filename)
+        snapshot.load()
+        self.assertEqual(0, len(snapshot))
+
+    def test_load_corrupt(self):
+        os.mkdir(os.path.dirname(self.filename))
+        with open(self.filename, 'w') as f:
+            f.write('garbage')
+        snapshot = Snapshot('/root', self.filename)
+        snapshot.load()
+        self.assertEqual(0, len(snapshot))
+
+    def test_cache_dir(self):
+        with patch.dict(os.environ, {'XDG_CACHE_HOME': self.dir}):
+            path = get_snapshot_path('/root')
+        self.assertEqual(os.path.join(self.dir, 'rsyncconfig', 'snapshots'),
+                         os.path.dirname(path))
+        self.assertNotEqual(path, get_snapshot_path('/other'))
+
+
+def get_suite():
+    loader = unittest.TestLoader()
+    return loader.loadTestsFromTestCase(TestSnapshot)
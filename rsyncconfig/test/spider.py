@@ -18,15 +18,24 @@ Tests for the rsyncconfig.spider module
 '''
 
 import os
+import stat
+import errno
 import time
 import posix
+import shutil
+import tempfile
+import threading
 import unittest
 from contextlib import nested
 from collections import deque
 
+import regex
 from mock import patch, sentinel, Mock
 
-from rsyncconfig.spider import Spider
+from rsyncconfig import spider as spider_module
+from rsyncconfig.filter import FilterRuleset
+from rsyncconfig.spider import Spider, ParallelSpider, ProcessSpider
+from rsyncconfig.snapshot import Snapshot
 
 
 def values(*vals):
@@ -40,6 +49,7 @@ class TestSpider(unittest.TestCase):
     def __init__(self, *args, **kwargs):
         unittest.TestCase.__init__(self, *args, **kwargs)
         self.os_mocks = nested(
+            patch.object(spider_module, 'scandir', None),
             patch('os.listdir'),
             patch('os.lstat'),
             patch('stat.S_ISDIR'),
@@ -54,7 +64,7 @@ class TestSpider(unittest.TestCase):
                            spec=['add_path', 'update_path', 'remove_path'])
 
     def test_empty(self):
-        with self.os_mocks as (listdir, lstat, _):
+        with self.os_mocks as (_, listdir, lstat, _):
             listdir.return_value = []
 
             spider = Spider(self.fstree, '.')
@@ -66,7 +76,7 @@ class TestSpider(unittest.TestCase):
             self.assertFalse(self.fstree.add_path.called)
 
     def test_one_file(self):
-        with self.os_mocks as (listdir, lstat, S_ISDIR):
+        with self.os_mocks as (_, listdir, lstat, S_ISDIR):
             listdir.return_value = ['foo']
             lstat.return_value = self.file_stat
             S_ISDIR.return_value = False
@@ -81,7 +91,7 @@ class TestSpider(unittest.TestCase):
             self.fstree.add_path.assert_called_with('./foo', self.file_stat)
 
     def test_recurse_into_dir(self):
-        with self.os_mocks as (listdir, lstat, S_ISDIR):
+        with self.os_mocks as (_, listdir, lstat, S_ISDIR):
             listdir.side_effect = values(['foo'], [])
             lstat.side_effect = values(self.dir_stat)
             S_ISDIR.side_effect = values(True)
@@ -101,6 +111,373 @@ class TestSpider(unittest.TestCase):
                 ((self.dir_stat.st_mode,), {}),
             ])
 
+    def test_add_dir_before_contents(self):
+        with self.os_mocks as (_, listdir, lstat, S_ISDIR):
+            listdir.side_effect = values(['foo'], ['bar'])
+            lstat.side_effect = values(self.dir_stat, self.file_stat)
+            S_ISDIR.side_effect = values(True, False)
+
+            spider = Spider(self.fstree, '.')
+            self.assertTrue(spider.join(5), 'Crawl finished')
+
+            self.assertEqual(self.fstree.add_path.call_args_list, [
+                (('./foo', self.dir_stat), {}),
+                (('./foo/bar', self.file_stat), {}),
+            ])
+
+    def test_prune_excluded_dir(self):
+        filters = Mock(name='filters', spec=['apply'])
+        filters.apply.side_effect = values(True, False)
+        with self.os_mocks as (_, listdir, lstat, S_ISDIR):
+            listdir.side_effect = values(['foo'], ['bar'])
+            lstat.side_effect = values(self.dir_stat, self.dir_stat)
+            S_ISDIR.side_effect = values(True, True)
+
+            spider = Spider(self.fstree, '.', filters)
+            self.assertTrue(spider.join(5), 'Crawl finished')
+
+            self.assertEqual(listdir.call_args_list, [
+                (('.',), {}),
+                (('./foo',), {}),
+            ])
+            self.assertEqual(filters.apply.call_args_list, [
+                (('foo', self.dir_stat), {}),
+                (('foo/bar', self.dir_stat), {}),
+            ])
+            self.assertEqual(self.fstree.add_path.call_args_list, [
+                (('./foo', self.dir_stat), {}),
+                (('./foo/bar', self.dir_stat, False), {}),
+            ])
+
+
+class TestScandirSpider(unittest.TestCase):
+    '''Test the scandir-based walker against a real directory tree
+    '''
+    def setUp(self):
+        if spider_module.scandir is None:
+            self.skipTest('scandir is not available')
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'dir'))
+        with open(os.path.join(self.root, 'dir', 'file'), 'w') as f:
+            f.write('contents')
+        os.symlink('dir', os.path.join(self.root, 'link'))
+        self.fstree = Mock(name='fstree',
+                           spec=['add_path', 'update_path', 'remove_path'])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def crawl(self, lazy_stat):
+        spider = Spider(self.fstree, self.root, lazy_stat=lazy_stat)
+        spider.join()
+        return dict((args[0][len(self.root) + 1:], args[1])
+                    for args, _ in self.fstree.add_path.call_args_list)
+
+    def test_crawl(self):
+        stats = self.crawl(False)
+        self.assertEqual(['dir', 'dir/file', 'link'], sorted(stats))
+        self.assertTrue(stat.S_ISDIR(stats['dir'].st_mode))
+        self.assertTrue(stat.S_ISREG(stats['dir/file'].st_mode))
+        self.assertTrue(stat.S_ISLNK(stats['link'].st_mode))
+        self.assertEqual(8, stats['dir/file'].st_size)
+
+    def test_crawl_lazy_stat(self):
+        stats = self.crawl(True)
+        self.assertEqual(['dir', 'dir/file', 'link'], sorted(stats))
+        self.assertTrue(isinstance(stats['dir/file'], spider_module.LazyStat))
+        self.assertTrue(stat.S_ISDIR(stats['dir'].st_mode))
+        self.assertTrue(stat.S_ISREG(stats['dir/file'].st_mode))
+        self.assertTrue(stat.S_ISLNK(stats['link'].st_mode))
+        self.assertEqual(8, stats['dir/file'].st_size)
+
+
+class _TreeTestCase(unittest.TestCase):
+    '''Base class for tests which crawl a small real directory tree
+    '''
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for d in ['a', 'a/b', 'a/b/c', 'd', 'e']:
+            os.mkdir(os.path.join(self.root, d))
+        for f in ['a/f', 'a/b/f', 'a/b/c/f', 'd/f', 'g']:
+            open(os.path.join(self.root, f), 'w').close()
+        self.fstree = Mock(name='fstree',
+                           spec=['add_path', 'update_path', 'remove_path'])
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def crawl(self, spider_class, **kwargs):
+        spider = spider_class(self.fstree, self.root, **kwargs)
+        spider.join()
+        return [args[0][len(self.root) + 1:]
+                for args, _ in self.fstree.add_path.call_args_list]
+
+    def unreadable(self, rel_path):
+        '''Patch Spider so that the directory at rel_path can't be listed.
+        '''
+        dir_iter = Spider._dir_iter
+        unreadable = os.path.join(self.root, rel_path)
+        def failing_dir_iter(spider, dir_path):
+            if dir_path == unreadable:
+                raise OSError(errno.EACCES, os.strerror(errno.EACCES),
+                              dir_path)
+            return dir_iter(spider, dir_path)
+        return patch.object(Spider, '_dir_iter', failing_dir_iter)
+
+
+class TestCrawl(_TreeTestCase):
+    '''Test crawling in the calling thread
+    '''
+    def test_not_started(self):
+        spider = Spider(self.fstree, self.root, start=False)
+        self.assertTrue(spider.thread is None)
+        self.assertTrue(spider.join(0))
+        self.assertFalse(self.fstree.add_path.called)
+
+    def test_crawl(self):
+        Spider(self.fstree, self.root, filters=FilterRuleset('- c/'),
+               start=False).crawl()
+        paths = [args[0][len(self.root) + 1:]
+                 for args, _ in self.fstree.add_path.call_args_list]
+        self.assertEqual(['a', 'a/b', 'a/b/c', 'a/b/f', 'a/f', 'd', 'd/f',
+                          'e', 'g'], sorted(paths))
+
+    def test_unreadable_dir(self):
+        '''Check that a directory which can't be listed is skipped, and the
+        rest of the tree crawled.
+        '''
+        spider = Spider(self.fstree, self.root, start=False)
+        with nested(self.unreadable('a/b'),
+                    patch.object(spider, '_skip_dir')) as (_, skip_dir):
+            spider.crawl()
+        self.assertEqual(os.path.join(self.root, 'a/b'),
+                         skip_dir.call_args[0][0])
+        paths = [args[0][len(self.root) + 1:]
+                 for args, _ in self.fstree.add_path.call_args_list]
+        self.assertEqual(['a', 'a/b', 'a/f', 'd', 'd/f', 'e', 'g'],
+                         sorted(paths))
+
+
+class TestParallelSpider(_TreeTestCase):
+    def test_same_paths_as_spider(self):
+        expected = sorted(self.crawl(Spider))
+        self.fstree.reset_mock()
+        self.assertEqual(expected, sorted(self.crawl(ParallelSpider,
+                                                     workers=3)))
+
+    def test_dirs_added_before_contents(self):
+        paths = self.crawl(ParallelSpider, workers=3)
+        for i, path in enumerate(paths):
+            parent = os.path.dirname(path)
+            if parent:
+                self.assertTrue(parent in paths[:i],
+                                '{0} added before {1}'.format(path, parent))
+
+    def test_unreadable_dir(self):
+        with self.unreadable('a/b'):
+            paths = self.crawl(ParallelSpider, workers=3)
+        self.assertEqual(['a', 'a/b', 'a/f', 'd', 'd/f', 'e', 'g'],
+                         sorted(paths))
+
+    def test_prune(self):
+        paths = self.crawl(ParallelSpider, filters=FilterRuleset('- b/'))
+        self.assertEqual(['a', 'a/b', 'a/f', 'd', 'd/f', 'e', 'g'],
+                         sorted(paths))
+
+    def test_dir_merge(self):
+        '''Check that per-directory filter files are read by each worker
+        '''
+        with open(os.path.join(self.root, 'a', '.rsync-filter'), 'w') as f:
+            f.write('- /b/\n')
+        filters = FilterRuleset(':e .rsync-filter').for_tree(self.root)
+        paths = self.crawl(ParallelSpider, filters=filters, workers=3)
+        self.assertEqual(['a', 'a/.rsync-filter', 'a/b', 'a/f', 'd', 'd/f',
+                          'e', 'g'], sorted(paths))
+
+    def test_worker_error(self):
+        '''Check that an error in a worker isn't lost, and doesn't leave the
+        crawl waiting forever
+        '''
+        with open(os.path.join(self.root, 'a', '.rsync-filter'), 'w') as f:
+            f.write('- [\n')
+        filters = FilterRuleset(': .rsync-filter').for_tree(self.root)
+        spider = ParallelSpider(self.fstree, self.root, filters=filters,
+                                workers=3, start=False)
+        self.assertRaises(regex.error, spider.crawl)
+
+
+class TestProcessSpider(_TreeTestCase):
+    def test_same_paths_as_spider(self):
+        expected = sorted(self.crawl(Spider))
+        self.fstree.reset_mock()
+        self.assertEqual(expected, sorted(self.crawl(ProcessSpider,
+                                                     processes=2,
+                                                     batch_size=2)))
+
+    def test_dirs_added_before_contents(self):
+        paths = self.crawl(ProcessSpider, processes=2, batch_size=2)
+        for i, path in enumerate(paths):
+            parent = os.path.dirname(path)
+            if parent:
+                self.assertTrue(parent in paths[:i],
+                                '{0} added before {1}'.format(path, parent))
+
+    def test_included(self):
+        paths = self.crawl(ProcessSpider, filters=FilterRuleset('- b/\n- f'),
+                           processes=2)
+        self.assertEqual(['a', 'a/b', 'a/f', 'd', 'd/f', 'e', 'g'],
+                         sorted(paths))
+        included = dict((args[0][len(self.root) + 1:], args[1].included)
+                        for args, _ in self.fstree.add_path.call_args_list)
+        self.assertEqual({'a': True, 'a/b': False, 'a/f': False, 'd': True,
+                          'd/f': False, 'e': True, 'g': True}, included)
+
+    def test_worker_error(self):
+        '''Check that an error in a worker isn't lost
+        '''
+        with open(os.path.join(self.root, 'a', '.rsync-filter'), 'w') as f:
+            f.write('- [\n')
+        filters = FilterRuleset(': .rsync-filter').for_tree(self.root)
+        spider = ProcessSpider(self.fstree, self.root, filters=filters,
+                               processes=2, start=False)
+        self.assertRaises(regex.error, spider.crawl)
+
+
+class TestSnapshotSpider(_TreeTestCase):
+    def setUp(self):
+        _TreeTestCase.setUp(self)
+        self.cache = tempfile.mkdtemp()
+
+    def tearDown(self):
+        _TreeTestCase.tearDown(self)
+        shutil.rmtree(self.cache)
+
+    def rescan(self, **kwargs):
+        self.fstree.reset_mock()
+        snapshot = Snapshot(self.root, os.path.join(self.cache, 'snapshot'))
+        with patch.object(Spider, '_dir_iter',
+                          autospec=True, side_effect=Spider._dir_iter) as \
+                dir_iter:
+            spider = Spider(self.fstree, self.root, snapshot=snapshot,
+                            **kwargs)
+            spider.join()
+        self.listed = sorted(args[1][len(self.root) + 1:]
+                             for args, _ in dir_iter.call_args_list)
+        return self.crawl_calls()
+
+    def crawl_calls(self):
+        def rel(calls):
+            return sorted(args[0][len(self.root) + 1:]
+                          for args, _ in calls)
+        return (rel(self.fstree.add_path.call_args_list),
+                rel(self.fstree.update_path.call_args_list),
+                rel(self.fstree.remove_path.call_args_list))
+
+    def touch_dir(self, rel_path):
+        '''Move the mtime of a directory on, as filesystem timestamps can be
+        too coarse to tell changes made in quick succession apart.
+        '''
+        path = os.path.join(self.root, rel_path)
+        st = os.lstat(path)
+        os.utime(path, (st.st_atime, st.st_mtime + 10))
+
+    def test_first_crawl(self):
+        expected = sorted(self.crawl(Spider))
+        self.assertEqual((expected, [], []), self.rescan())
+        self.assertTrue(os.path.exists(os.path.join(self.cache, 'snapshot')))
+
+    def test_unchanged(self):
+        '''Check that nothing is listed if nothing has changed.
+        '''
+        first = self.rescan()
+        self.assertEqual(first, self.rescan())
+        self.assertEqual([], self.listed)
+
+    def test_changes(self):
+        '''Check that only changed directories are listed, and that the tree
+        is added as it is now, rather than as the snapshot recorded it.
+        '''
+        self.rescan()
+        open(os.path.join(self.root, 'a/b/new'), 'w').close()
+        os.mkdir(os.path.join(self.root, 'e/sub'))
+        open(os.path.join(self.root, 'e/sub/f'), 'w').close()
+        os.remove(os.path.join(self.root, 'd/f'))
+        shutil.rmtree(os.path.join(self.root, 'a/b/c'))
+        for rel_path in ['a/b', 'd', 'e']:
+            self.touch_dir(rel_path)
+        added, updated, removed = self.rescan()
+        self.assertEqual(['a/b', 'd', 'e', 'e/sub'], self.listed)
+        self.assertEqual(([], []), (updated, removed))
+        self.fstree.reset_mock()
+        self.assertEqual(sorted(self.crawl(Spider)), added)
+        # The unchanged directories were recorded again
+        self.assertEqual((added, [], []), self.rescan())
+        self.assertEqual([], self.listed)
+
+    def test_filters(self):
+        '''Check that excluded directories are neither replayed nor listed.
+        '''
+        self.rescan()
+        added, updated, removed = self.rescan(filters=FilterRuleset('- b/'))
+        self.assertEqual(['a', 'a/b', 'a/f', 'd', 'd/f', 'e', 'g'], added)
+        self.assertEqual([], self.listed)
+
+
+class TestStop(unittest.TestCase):
+    '''Check that stopping a spider cancels the crawl promptly
+    '''
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        for d in range(5):
+            path = os.path.join(self.root, 'dir{0}'.format(d))
+            os.mkdir(path)
+            for f in range(100):
+                open(os.path.join(path, 'file{0}'.format(f)), 'w').close()
+        self.fstree = Mock(name='fstree',
+                           spec=['add_path', 'update_path', 'remove_path'])
+        self.started = threading.Event()
+        def add_path(*args):
+            self.started.set()
+            time.sleep(0.001)
+        self.fstree.add_path.side_effect = add_path
+
+    def tearDown(self):
+        shutil.rmtree(self.root)
+
+    def check_stop(self, spider):
+        self.started.wait(5)
+        spider.stop()
+        calls = self.fstree.add_path.call_count
+        self.assertTrue(spider.join(5), 'Crawl terminated')
+        self.assertEqual(calls, self.fstree.add_path.call_count,
+                         'No calls after stop() returned')
+        self.assertTrue(calls < 505, 'Crawl was cancelled')
+
+    def test_spider(self):
+        self.check_stop(Spider(self.fstree, self.root))
+
+    def test_parallel_spider(self):
+        self.check_stop(ParallelSpider(self.fstree, self.root, workers=3))
+
+    def test_process_spider(self):
+        self.check_stop(ProcessSpider(self.fstree, self.root, processes=2,
+                                      batch_size=10))
+
+    def test_join_timeout(self):
+        spider = Spider(self.fstree, self.root)
+        self.assertFalse(spider.join(0.001))
+        spider.stop()
+        self.assertTrue(spider.join(5))
+
 
 def get_suite():
-    return unittest.TestLoader().loadTestsFromTestCase(TestSpider)
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestSpider),
+        loader.loadTestsFromTestCase(TestScandirSpider),
+        loader.loadTestsFromTestCase(TestCrawl),
+        loader.loadTestsFromTestCase(TestParallelSpider),
+        loader.loadTestsFromTestCase(TestProcessSpider),
+        loader.loadTestsFromTestCase(TestSnapshotSpider),
+        loader.loadTestsFromTestCase(TestStop),
+    ])
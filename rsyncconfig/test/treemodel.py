@@ -0,0 +1,122 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the rsyncconfig.treemodel module
+'''
+
+import unittest
+
+from rsyncconfig.filter import FilterRuleset
+from rsyncconfig.fstree import FSTree, COL_PATH, COL_INCLUDED, COL_TOTALS
+from rsyncconfig.treemodel import QueuedFSTree
+from rsyncconfig.test.fstree import FILE_STAT, DIR_STAT, store_to_list
+
+class TestFSTreeModel(unittest.TestCase):
+    def test_created_lazily(self):
+        '''Check that a store created after paths were added shows them.
+        '''
+        fstree = FSTree()
+        fstree.add_path('dir', DIR_STAT)
+        fstree.add_path('dir/foo', FILE_STAT, False)
+        self.assertEqual([('dir', DIR_STAT, True, [
+            ('dir/foo', FILE_STAT, False, []),
+        ])], store_to_list(fstree.store))
+
+    def test_included(self):
+        fstree = FSTree()
+        fstree.add_path('dir', DIR_STAT)
+        fstree.add_path('dir/foo', FILE_STAT, False)
+        fstree.add_path('foo', FILE_STAT, False)
+        fstree.set_filters(FilterRuleset('- /dir/'))
+        self.assertEqual([('dir', False, [('dir/foo', False, [])]),
+                          ('foo', True, [])],
+                         store_to_list(fstree.store, (COL_PATH, COL_INCLUDED)))
+
+    def test_totals(self):
+        fstree = FSTree()
+        fstree.add_path('dir', DIR_STAT)
+        fstree.add_path('dir/foo', FILE_STAT, False)
+        fstree.add_path('foo', FILE_STAT, False)
+        fstree.set_filters(FilterRuleset('- /foo'))
+        size = FILE_STAT.st_size
+        self.assertEqual([('dir', (size, 1, 0), [('dir/foo', (size, 1, 0),
+                                                  [])]),
+                          ('foo', (0, 0, size), [])],
+                         store_to_list(fstree.store, (COL_PATH, COL_TOTALS)))
+
+
+class TestQueuedFSTree(unittest.TestCase):
+    def setUp(self):
+        self.fstree = FSTree()
+        self.queued = QueuedFSTree(self.fstree, '/root')
+
+    def tearDown(self):
+        self.queued.close()
+
+    def test_queued_until_flushed(self):
+        '''Check that changes only reach the FSTree from the main loop.
+        '''
+        self.queued.add_path('/root/foo', FILE_STAT, False)
+        self.assertEqual([], store_to_list(self.fstree.store))
+        self.queued.flush()
+        self.assertEqual([('foo', FILE_STAT, False, [])],
+                         store_to_list(self.fstree.store))
+
+    def test_sorted_after_flush(self):
+        '''Check that the store is sorted once the queue has been drained.
+        '''
+        self.queued.add_path('/root/dir', DIR_STAT)
+        self.queued.add_path('/root/foo', FILE_STAT, False)
+        self.queued.add_path('/root/dir/foo', FILE_STAT, False)
+        self.queued.add_path('/root/bar', FILE_STAT, False)
+        self.queued.add_path('/root/dir/bar', FILE_STAT, False)
+        self.queued.flush()
+        self.assertEqual([
+            ('bar', FILE_STAT, False, []),
+            ('dir', DIR_STAT, True, [
+                ('dir/bar', FILE_STAT, False, []),
+                ('dir/foo', FILE_STAT, False, []),
+            ]),
+            ('foo', FILE_STAT, False, []),
+        ], store_to_list(self.fstree.store))
+
+    def test_parent_removed(self):
+        '''Check that an entry queued after its directory was removed
+        doesn't stop the queue from draining.
+        '''
+        self.queued.add_path('/root/dir', DIR_STAT)
+        self.queued.remove_path('/root/dir')
+        self.queued.add_path('/root/dir/foo', FILE_STAT, False)
+        self.queued.add_path('/root/bar', FILE_STAT, False)
+        self.assertTrue(self.queued._drain())
+        self.queued.flush()
+        self.assertEqual([('bar', FILE_STAT, False, [])],
+                         store_to_list(self.fstree.store))
+
+    def test_close_discards(self):
+        self.queued.add_path('/root/foo', FILE_STAT, False)
+        self.queued.close()
+        self.queued.add_path('/root/bar', FILE_STAT, False)
+        self.queued.flush()
+        self.assertEqual([], store_to_list(self.fstree.store))
+
+
+def get_suite():
+    loader = unittest.TestLoader()
+    return unittest.TestSuite([
+        loader.loadTestsFromTestCase(TestFSTreeModel),
+        loader.loadTestsFromTestCase(TestQueuedFSTree),
+    ])
@@ -0,0 +1,152 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Tests for the rsyncconfig.watch module
+'''
+
+import os
+import time
+import errno
+import ctypes
+import shutil
+import tempfile
+import unittest
+
+from mock import patch, Mock
+
+from rsyncconfig import watch
+from rsyncconfig.filter import FilterRuleset
+from rsyncconfig.spider import Spider
+from rsyncconfig.watch import Watcher
+
+
+class _OutOfWatches(object):
+    '''Stands in for libc when every inotify watch has been used up
+    '''
+    def __init__(self, libc):
+        self.inotify_init1 = libc.inotify_init1
+        self.inotify_rm_watch = libc.inotify_rm_watch
+
+    def inotify_add_watch(self, fd, path, mask):
+        ctypes.set_errno(errno.ENOSPC)
+        return -1
+
+
+@unittest.skipUnless(watch.is_supported(), 'inotify is not available')
+class TestWatcher(unittest.TestCase):
+    def setUp(self):
+        self.root = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.root, 'dir'))
+        open(os.path.join(self.root, 'dir/foo'), 'w').close()
+        open(os.path.join(self.root, 'bar'), 'w').close()
+        self.fstree = Mock(name='fstree',
+                           spec=['add_path', 'update_path', 'remove_path'])
+        self.watcher = None
+
+    def tearDown(self):
+        if self.watcher is not None:
+            self.watcher.stop()
+            self.watcher.join()
+        shutil.rmtree(self.root)
+
+    def watch(self, **kwargs):
+        kwargs.setdefault('delay', 0.02)
+        self.watcher = Watcher(self.fstree, self.root, **kwargs)
+        Spider(self.watcher, self.root, kwargs.get('filters')).join()
+        self.fstree.reset_mock()
+
+    def path(self, rel_path):
+        return os.path.join(self.root, rel_path)
+
+    def calls(self, method):
+        return sorted(args[0][len(self.root) + 1:]
+                      for args, _ in method.call_args_list)
+
+    def wait_for(self, method, expected, timeout=5):
+        deadline = time.time() + timeout
+        while self.calls(method) != expected:
+            if time.time() > deadline:
+                self.assertEqual(expected, self.calls(method))
+            time.sleep(0.01)
+
+    def test_create_file(self):
+        self.watch()
+        open(self.path('dir/new'), 'w').close()
+        self.wait_for(self.fstree.add_path, ['dir/new'])
+
+    def test_remove_file(self):
+        self.watch()
+        os.remove(self.path('dir/foo'))
+        self.wait_for(self.fstree.remove_path, ['dir/foo'])
+
+    def test_coalesce(self):
+        '''Check that a burst of writes becomes a single update.
+        '''
+        self.watch(delay=0.2)
+        with open(self.path('bar'), 'w') as f:
+            for i in range(20):
+                f.write('x')
+                f.flush()
+        self.wait_for(self.fstree.update_path, ['bar'])
+        time.sleep(0.3)
+        self.assertEqual(['bar'], self.calls(self.fstree.update_path))
+
+    def test_new_dir(self):
+        '''Check that new directories are crawled and watched.
+        '''
+        self.watch()
+        os.mkdir(self.path('new'))
+        os.mkdir(self.path('new/sub'))
+        open(self.path('new/sub/f'), 'w').close()
+        self.wait_for(self.fstree.add_path, ['new', 'new/sub', 'new/sub/f'])
+        self.fstree.reset_mock()
+        open(self.path('new/sub/g'), 'w').close()
+        self.wait_for(self.fstree.add_path, ['new/sub/g'])
+
+    def test_excluded_dir(self):
+        '''Check that excluded directories aren't watched.
+        '''
+        self.watch(filters=FilterRuleset('- dir/'))
+        open(self.path('dir/new'), 'w').close()
+        open(self.path('new'), 'w').close()
+        self.wait_for(self.fstree.add_path, ['new'])
+        self.assertEqual([self.root], self.watcher._watched.keys())
+
+    def test_out_of_watches(self):
+        '''Check that directories which can't be watched are rescanned.
+        '''
+        with patch.object(watch, '_libc', _OutOfWatches(watch._libc)):
+            self.watch(rescan_interval=0.05)
+        self.assertEqual({}, self.watcher._watched)
+        # Let the first rescan take in the tree as it is.
+        time.sleep(0.2)
+        self.fstree.reset_mock()
+        os.remove(self.path('dir/foo'))
+        open(self.path('dir/new'), 'w').close()
+        os.utime(self.path('dir'), (0, 0))
+        self.wait_for(self.fstree.remove_path, ['dir/foo'])
+        self.wait_for(self.fstree.add_path, ['dir/new'])
+
+    def test_stop(self):
+        self.watch()
+        self.watcher.stop()
+        self.assertTrue(self.watcher.join(5))
+        self.watcher = None
+
+
+def get_suite():
+    loader = unittest.TestLoader()
+    return loader.loadTestsFromTestCase(TestWatcher)
@@ -0,0 +1,220 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+The GTK+ side of an FSTree: a tree model presenting it, and a queue which
+feeds it from other threads through the main loop
+
+This is the only module besides rsyncconfig.gui which imports gtk, and
+nothing else imports it until a GUI is needed.
+'''
+
+import os
+import time
+import Queue
+
+import pygtk
+pygtk.require('2.0')
+import gobject
+import gtk
+
+from rsyncconfig.fstree import (COL_PATH, COL_STAT, COL_SPIDERING,
+                                COL_INCLUDED, COL_TOTALS)
+from rsyncconfig.pathtable import ROOT
+
+'The types of the columns of an FSTree store.'
+COLUMN_TYPES = (gobject.TYPE_STRING, object, gobject.TYPE_BOOLEAN,
+                gobject.TYPE_BOOLEAN, object)
+
+'The most changes a QueuedFSTree applies per main loop iteration.'
+BATCH_ROWS = 2000
+'The most time in seconds a QueuedFSTree spends per main loop iteration.'
+BATCH_SECONDS = 0.016
+
+class FSTreeModel(gtk.GenericTreeModel):
+    '''
+    A gtk.TreeModel presenting an FSTree, with columns COL_PATH, COL_STAT,
+    COL_SPIDERING, COL_INCLUDED and COL_TOTALS.  Its row references are the
+    FSTree's node numbers.
+    '''
+    def __init__(self, fstree):
+        gtk.GenericTreeModel.__init__(self)
+        self.fstree = fstree
+
+    def node_inserted(self, node):
+        path = self.fstree.tree_path(node)
+        self.row_inserted(path, self.get_iter(path))
+
+    def node_changed(self, node):
+        path = self.fstree.tree_path(node)
+        self.row_changed(path, self.get_iter(path))
+
+    def node_deleted(self, path):
+        self.row_deleted(path)
+
+    def node_has_child_toggled(self, node):
+        path = self.fstree.tree_path(node)
+        self.row_has_child_toggled(path, self.get_iter(path))
+
+    def on_get_flags(self):
+        return gtk.TREE_MODEL_ITERS_PERSIST
+
+    def on_get_n_columns(self):
+        return len(COLUMN_TYPES)
+
+    def on_get_column_type(self, index):
+        return COLUMN_TYPES[index]
+
+    def on_get_iter(self, path):
+        node = ROOT
+        for index in path:
+            children = self.fstree.sorted_children(node)
+            if index >= len(children):
+                return None
+            node = children[index]
+        return node
+
+    def on_get_path(self, node):
+        return self.fstree.tree_path(node)
+
+    def on_get_value(self, node, column):
+        if column == COL_PATH:
+            return self.fstree.get_path(node)
+        elif column == COL_STAT:
+            return self.fstree.get_stat(node)
+        elif column == COL_SPIDERING:
+            return self.fstree.is_spidering(node)
+        elif column == COL_INCLUDED:
+            return self.fstree.is_included(node)
+        elif column == COL_TOTALS:
+            return self.fstree.get_totals(node)
+
+    def on_iter_next(self, node):
+        siblings = self.fstree.sorted_children(self.fstree.get_parent(node))
+        index = self.fstree.child_index(node) + 1
+        if index < len(siblings):
+            return siblings[index]
+        return None
+
+    def on_iter_children(self, node):
+        return self.on_iter_nth_child(node, 0)
+
+    def on_iter_has_child(self, node):
+        return self.fstree.has_children(node)
+
+    def on_iter_n_children(self, node):
+        if node is None:
+            node = ROOT
+        return self.fstree.count_children(node)
+
+    def on_iter_nth_child(self, node, n):
+        if node is None:
+            node = ROOT
+        children = self.fstree.sorted_children(node)
+        if 0 <= n < len(children):
+            return children[n]
+        return None
+
+    def on_iter_parent(self, node):
+        parent = self.fstree.get_parent(node)
+        if parent == ROOT:
+            return None
+        return parent
+
+class QueuedFSTree(object):
+    '''
+    Passes changes to an FSTree from other threads, such as a Spider's.
+
+    The add_path, update_path and remove_path methods may be called from any
+    thread.  Calls are placed in a bounded queue, which is drained in batches
+    by a timeout on the GTK+ main loop, so the FSTree is only touched from the
+    main thread.  Callers block while the queue is full.
+    '''
+    def __init__(self, fstree, root=None, maxsize=10000, interval=16):
+        '''Create a QueuedFSTree feeding fstree.
+
+        If root is given, paths are made relative to it before being passed to
+        the fstree, as a Spider passes paths joined to its root.  interval is
+        the time in milliseconds between batches.
+        '''
+        self.fstree = fstree
+        if root is None:
+            self._prefix = 0
+        else:
+            self._prefix = len(os.path.join(root, ''))
+        self.queue = Queue.Queue(maxsize)
+        self._closed = False
+        self._source = gobject.timeout_add(interval, self._drain)
+
+    def add_path(self, path, stat_t, scanning=True):
+        self._put((self.fstree.add_path, path[self._prefix:], stat_t, scanning))
+
+    def update_path(self, path, stat_t, scanning=False):
+        self._put((self.fstree.update_path, path[self._prefix:], stat_t,
+                   scanning))
+
+    def remove_path(self, path):
+        self._put((self.fstree.remove_path, path[self._prefix:]))
+
+    def _put(self, item):
+        while not self._closed:
+            try:
+                self.queue.put(item, timeout=0.1)
+                return
+            except Queue.Full:
+                pass
+
+    def close(self):
+        '''Discard queued changes and stop accepting new ones.
+
+        Callers blocked on a full queue return, discarding their change.  This
+        must be called from the main thread.
+        '''
+        if self._closed:
+            return
+        self._closed = True
+        gobject.source_remove(self._source)
+        try:
+            while True:
+                self.queue.get_nowait()
+        except Queue.Empty:
+            pass
+
+    def flush(self):
+        '''Apply all queued changes now.
+        '''
+        while self._apply(BATCH_ROWS, BATCH_SECONDS):
+            pass
+
+    def _drain(self):
+        self._apply(BATCH_ROWS, BATCH_SECONDS)
+        return True
+
+    def _apply(self, rows, seconds):
+        '''Apply up to rows queued changes, stopping early after seconds.
+
+        Returns True if there may be more changes queued.
+        '''
+        deadline = time.time() + seconds
+        get = self.queue.get_nowait
+        try:
+            for _ in xrange(rows):
+                item = get()
+                item[0](*item[1:])
+                if time.time() > deadline:
+                    break
+        except Queue.Empty:
+            return False
+        return True
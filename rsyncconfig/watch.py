@@ -0,0 +1,345 @@
+# Copyright (C) 2011 Thomas W. Most
+#
+# This program is free software: you can redistribute it and/or modify
+# it under the terms of the GNU General Public License as published by
+# the Free Software Foundation, either version 3 of the License, or
+# (at your option) any later version.
+#
+# This program is distributed in the hope that it will be useful,
+# but WITHOUT ANY WARRANTY; without even the implied warranty of
+# MERCHANTABILITY or FITNESS FOR A PARTICULAR PURPOSE.  See the
+# GNU General Public License for more details.
+#
+# You should have received a copy of the GNU General Public License
+# along with this program.  If not, see <http://www.gnu.org/licenses/>.
+
+'''
+Keeps an fstree up to date with changes to the filesystem, using Linux inotify
+'''
+
+import os
+import time
+import stat
+import errno
+import select
+import struct
+import ctypes
+import ctypes.util
+import threading
+
+from rsyncconfig.spider import Spider
+
+IN_MODIFY = 0x00000002
+IN_ATTRIB = 0x00000004
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_DONT_FOLLOW = 0x02000000
+IN_EXCL_UNLINK = 0x04000000
+IN_ISDIR = 0x40000000
+IN_NONBLOCK = 0o4000
+IN_CLOEXEC = 0o2000000
+
+'The events watched for in each directory.'
+WATCH_MASK = (IN_MODIFY | IN_ATTRIB | IN_CLOSE_WRITE | IN_MOVED_FROM |
+              IN_MOVED_TO | IN_CREATE | IN_DELETE | IN_ONLYDIR |
+              IN_DONT_FOLLOW | IN_EXCL_UNLINK)
+
+'The fixed-size header of a struct inotify_event.'
+_EVENT = struct.Struct('=iIII')
+
+def _load_libc():
+    try:
+        libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                           use_errno=True)
+        libc.inotify_init1
+        libc.inotify_add_watch
+        libc.inotify_rm_watch
+    except (OSError, AttributeError):
+        return None
+    return libc
+
+_libc = _load_libc()
+
+def is_supported():
+    '''Return whether inotify is available on this system.
+    '''
+    return _libc is not None
+
+
+class Watcher(object):
+    '''
+    An fstree which passes everything on to another fstree, watching each
+    directory it is told will be descended into for changes.
+
+    Pass a Watcher to a Spider in place of its fstree.  Once a directory has
+    been added, changes to its entries are read from inotify in a background
+    thread.  A burst of events is coalesced into one change per path, which
+    is passed on as an add_path, update_path or remove_path call once there
+    have been no new events for delay seconds, or at most max_delay seconds
+    after the first.  The fstree must be thread-safe, as a QueuedFSTree is.
+    New directories are crawled and watched in turn.
+
+    When the system's limit on inotify watches is reached, directories which
+    can't be watched are instead checked every rescan_interval seconds, and
+    listed again if their mtime has changed.
+
+    If the kernel's event queue overflows, events have been lost, and the
+    overflow callback is called from the background thread.  Re-spidering
+    the tree is the only way to recover.
+    '''
+    def __init__(self, fstree, root, filters=None, delay=0.1, max_delay=1.0,
+                 rescan_interval=60, overflow=None):
+        self.fstree = fstree
+        self.root = root
+        self.filters = filters
+        self.delay = delay
+        self.max_delay = max_delay
+        self.rescan_interval = rescan_interval
+        self.overflow = overflow
+        self.running = True
+        self._prefix = len(os.path.join(root, ''))
+        self._walker = _Walker(self, root, filters)
+        # Watched directories by watch descriptor, and the reverse
+        self._watches = {}
+        self._watched = {}
+        # Unwatched directories, each with its (inode, mtime, ctime) and
+        # entries when it was last listed, or None if it hasn't been
+        self._unwatched = {}
+        self._lock = threading.Lock()
+        # Coalesced events by path, accumulated by the background thread
+        self._pending = {}
+
+        if _libc is None:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._fd = _libc.inotify_init1(IN_NONBLOCK | IN_CLOEXEC)
+        if self._fd < 0:
+            e = ctypes.get_errno()
+            raise OSError(e, os.strerror(e))
+        # A spider never adds the root itself.
+        self._watch(root)
+        self.thread = threading.Thread(name=repr(self), target=self.run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __repr__(self):
+        return '{0}({1!r}, {2!r})'.format(self.__class__.__name__,
+                                          self.fstree, self.root)
+
+    def add_path(self, path, stat_t, scanning=True):
+        self.fstree.add_path(path, stat_t, scanning)
+        if scanning and stat.S_ISDIR(stat_t.st_mode):
+            self._watch(path)
+
+    def update_path(self, path, stat_t, scanning=False):
+        self.fstree.update_path(path, stat_t, scanning)
+
+    def remove_path(self, path):
+        self.fstree.remove_path(path)
+
+    def stop(self):
+        '''Stop watching.  Use join() to wait for the background thread.
+        '''
+        self.running = False
+
+    def join(self, timeout=None):
+        '''Wait up to timeout seconds (or forever, if None) for the background
+        thread to finish after stop().
+
+        Returns True if it has.
+        '''
+        self.thread.join(timeout)
+        return not self.thread.is_alive()
+
+    def _watch(self, path):
+        with self._lock:
+            if not self.running:
+                return
+            wd = _libc.inotify_add_watch(self._fd, path, WATCH_MASK)
+            if wd < 0:
+                e = ctypes.get_errno()
+                if e == errno.ENOSPC:
+                    # Out of watches
+                    self._unwatched.setdefault(path, None)
+                # Otherwise the directory has gone, or can't be read.
+                return
+            self._watches[wd] = path
+            self._watched[path] = wd
+
+    def _unwatch_tree(self, path):
+        '''Stop watching a directory and everything beneath it.
+        '''
+        prefix = os.path.join(path, '')
+        with self._lock:
+            for dir_path in list(self._watched):
+                if dir_path == path or dir_path.startswith(prefix):
+                    wd = self._watched.pop(dir_path)
+                    del self._watches[wd]
+                    _libc.inotify_rm_watch(self._fd, wd)
+            for dir_path in list(self._unwatched):
+                if dir_path == path or dir_path.startswith(prefix):
+                    del self._unwatched[dir_path]
+
+    def run(self):
+        poller = select.poll()
+        poller.register(self._fd, select.POLLIN)
+        first_event = last_event = None
+        next_rescan = time.time() + self.rescan_interval
+        try:
+            while self.running:
+                if poller.poll(self.delay * 1000):
+                    if self._read_events():
+                        last_event = time.time()
+                        if first_event is None:
+                            first_event = last_event
+                now = time.time()
+                if first_event is not None and (
+                        now - last_event >= self.delay or
+                        now - first_event >= self.max_delay):
+                    self._flush()
+                    first_event = last_event = None
+                if now >= next_rescan:
+                    self._rescan_unwatched()
+                    next_rescan = now + self.rescan_interval
+        finally:
+            with self._lock:
+                self.running = False
+                os.close(self._fd)
+
+    def _read_events(self):
+        '''Read the available events, adding them to the pending changes.
+
+        Returns True if any changes are pending as a result.
+        '''
+        try:
+            data = os.read(self._fd, 65536)
+        except EnvironmentError, e:
+            if e.errno == errno.EAGAIN:
+                return False
+            raise e
+        changed = False
+        offset = 0
+        while offset < len(data):
+            wd, mask, _, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip('\0')
+            offset += length
+            if mask & IN_Q_OVERFLOW:
+                if self.overflow is not None:
+                    self.overflow()
+                continue
+            with self._lock:
+                if mask & IN_IGNORED:
+                    path = self._watches.pop(wd, None)
+                    if path is not None and self._watched.get(path) == wd:
+                        del self._watched[path]
+                    continue
+                dir_path = self._watches.get(wd)
+            if dir_path is None or not name:
+                continue
+            path = os.path.join(dir_path, name)
+            if mask & IN_MOVED_FROM and mask & IN_ISDIR:
+                # The watches beneath it now have the wrong paths.
+                self._unwatch_tree(path)
+            self._pending[path] = self._pending.get(path, 0) | mask
+            changed = True
+        return changed
+
+    def _flush(self):
+        '''Pass the pending changes on to the fstree.
+        '''
+        pending = self._pending
+        self._pending = {}
+        # Parents sort before their children.
+        for path in sorted(pending):
+            if not self.running:
+                return
+            try:
+                st = os.lstat(path)
+            except EnvironmentError, e:
+                if e.errno not in (errno.ENOENT, errno.ENOTDIR):
+                    raise e
+                self.fstree.remove_path(path)
+                continue
+            self._refresh(path, st, pending[path] & (IN_CREATE | IN_MOVED_TO))
+
+    def _refresh(self, path, st, created):
+        '''Pass the current stat of path on to the fstree, crawling it if it
+        is a new directory.
+        '''
+        rel_path = path[self._prefix:]
+        descend = stat.S_ISDIR(st.st_mode) and (
+            self.filters is None or self.filters.apply(rel_path, st))
+        scanning = descend or not stat.S_ISDIR(st.st_mode)
+        if not created:
+            self.fstree.update_path(path, st, scanning)
+        elif descend:
+            self.add_path(path, st)
+            self._walker.walk(path, rel_path)
+        else:
+            self.fstree.add_path(path, st, scanning)
+
+    def _rescan_unwatched(self):
+        '''List any unwatched directories which have changed, passing the
+        differences on to the fstree.
+        '''
+        with self._lock:
+            unwatched = list(self._unwatched.items())
+        for path, state in unwatched:
+            if not self.running:
+                return
+            try:
+                st = os.lstat(path)
+                key = (st.st_ino, st.st_mtime, st.st_ctime)
+                if state is not None and state[0] == key:
+                    continue
+                entries = dict((name, entry_st) for name, _, entry_st
+                               in self._walker._dir_iter(path))
+            except EnvironmentError:
+                # Gone; the rescan of its parent will notice.
+                with self._lock:
+                    self._unwatched.pop(path, None)
+                continue
+            old = state[1] if state is not None else {}
+            for name in old:
+                if name not in entries:
+                    self.fstree.remove_path(os.path.join(path, name))
+            for name, entry_st in entries.iteritems():
+                entry_path = os.path.join(path, name)
+                prev = old.get(name)
+                if prev is None:
+                    # The first listing of a directory may find
+                    # subdirectories the spider has already reported.
+                    self._refresh(entry_path, entry_st,
+                                  state is not None or
+                                  not self._is_known(entry_path))
+                elif (prev.st_mode, prev.st_size, prev.st_mtime) != (
+                        entry_st.st_mode, entry_st.st_size,
+                        entry_st.st_mtime):
+                    self._refresh(entry_path, entry_st, False)
+            with self._lock:
+                if path in self._unwatched:
+                    self._unwatched[path] = (key, entries)
+
+    def _is_known(self, path):
+        '''Whether path is a directory which is watched or rescanned.
+        '''
+        with self._lock:
+            return path in self._watched or path in self._unwatched
+
+
+class _Walker(Spider):
+    '''Crawls new directories for a Watcher, in the calling thread.
+    '''
+    def __init__(self, watcher, root, filters):
+        Spider.__init__(self, watcher, root, filters, start=False)
+
+    def walk(self, path, rel_path):
+        '''Crawl the directory at path, rel_path beneath the root.
+        '''
+        self._process_dir(path, rel_path)
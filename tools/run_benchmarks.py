@@ -0,0 +1,71 @@
+#!/usr/bin/env python
+'''Run the benchmarks
+
+Each benchmark's best time is written out as it finishes, or with --json, the
+results are written at the end as a JSON object, for comparing runs.  Names
+given on the command line select the benchmarks whose names contain any of
+them.  The exit status is 1 if a benchmark took longer, relative to another,
+than expected; expectations are only checked when both were run.
+
+This script is assumed to be run from a development tree, so it mucks with
+sys.path to make imports work.
+'''
+
+import os
+import sys
+import json
+import time
+import platform
+import optparse
+# Remove the tools directory from the path
+sys.path[0] = os.path.join(sys.path[0], '..')
+
+from rsyncconfig.bench import get_benchmarks, get_sizes, \
+    get_expectations, run_benchmark
+
+def selected(name, patterns):
+    return not patterns or any(pattern in name for pattern in patterns)
+
+if __name__ == '__main__':
+    parser = optparse.OptionParser(usage='%prog [options] [NAME...]')
+    parser.add_option('--json', action='store_true', default=False,
+                      help='write the results as JSON')
+    parser.add_option('-r', '--repeat', type='int', default=3,
+                      help='take the best of REPEAT runs of each benchmark')
+    options, patterns = parser.parse_args()
+
+    results = {}
+    for name, setup, func in get_benchmarks():
+        if not selected(name, patterns):
+            continue
+        seconds = run_benchmark(setup, func, repeat=options.repeat)
+        results[name] = seconds
+        if not options.json:
+            sys.stdout.write('{0}: {1:.3f} ms\n'.format(name, seconds * 1000))
+    sizes = {}
+    for name, size in get_sizes():
+        if not selected(name, patterns):
+            continue
+        sizes[name] = size
+        if not options.json:
+            sys.stdout.write('{0}: {1} bytes\n'.format(name, size))
+    if options.json:
+        json.dump({
+            'time': time.strftime('%Y-%m-%dT%H:%M:%SZ', time.gmtime()),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'repeat': options.repeat,
+            'seconds': results,
+            'bytes': sizes,
+        }, sys.stdout, indent=2, sort_keys=True)
+        sys.stdout.write('\n')
+    failed = False
+    for faster, slower, ratio in get_expectations():
+        if faster in results and slower in results and \
+                results[faster] > ratio * results[slower]:
+            failed = True
+            sys.stderr.write('{0} took {1:.2f} times as long as {2}, '
+                             'expected at most {3:.2f}\n'.format(
+                                 faster, results[faster] / results[slower],
+                                 slower, ratio))
+    sys.exit(1 if failed else 0)